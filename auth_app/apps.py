@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class AuthAppConfig(AppConfig):
     name = 'auth_app'
+
+    def ready(self):
+        from utils.common_functions import preload_templates
+        preload_templates(self)
@@ -0,0 +1,53 @@
+from django.http import HttpResponse
+from iDjango.settings import TOKEN_MAX_BODY_SIZE
+from utils import json_fast
+from utils.instrumentation import render
+from utils.concurrency import AsyncView, run_upstream, session_get, session_set
+from .views import LinkTokenView, AccessTokenView, AccountsView, json_response, LINK_TOKEN_BODY, \
+    ACCESS_TOKEN_BODY, TOKEN_FAILED_BODY
+
+
+class AsyncLinkTokenView(AsyncView, LinkTokenView):
+    """ LinkTokenView for ASGI workers, a live link token is created in the upstream thread pool """
+
+    async def post(self, request):
+        link_token = self.take_pooled_link_token() or await run_upstream(self.create_link_token)
+        if 'error' in link_token:
+            return json_response(TOKEN_FAILED_BODY, status=400)
+        await session_set(request, link_token=link_token.get('link_token'))
+        return json_response(LINK_TOKEN_BODY.render(link_token.get('link_token')))
+
+
+class AsyncAccessTokenView(AsyncView, AccessTokenView):
+    """ AccessTokenView for ASGI workers, Plaid is called from the upstream thread pool """
+
+    async def post(self, request):
+        try:
+            payload = json_fast.extract(request.body, self._payload_fields, max_size=TOKEN_MAX_BODY_SIZE)
+        except ValueError:
+            return HttpResponse(status=400)
+        access_token = await run_upstream(self.exchange_public_token, payload.get('public_token'))
+        if 'error' in access_token:
+            return HttpResponse(status=400)
+        await session_set(request, access_token=access_token.get('access_token'))
+        return json_response(ACCESS_TOKEN_BODY.render(access_token.get('access_token')))
+
+
+class AsyncAccountsView(AsyncView, AccountsView):
+    """ AccountsView for ASGI workers, Plaid is called from the upstream thread pool """
+
+    async def get(self, request):
+        access_token, invoice_id = await session_get(request, 'access_token', 'invoice_id')
+        if not access_token or not invoice_id:
+            return self.not_linked(request)
+        accounts = await run_upstream(self.get_accounts, access_token=access_token)
+        if 'error' in accounts:
+            return render(request, 'auth_app/error.html', {
+                'accounts': accounts.get('error'),
+                'invoice_id': invoice_id
+            })
+        return render(request, 'auth_app/accounts.html', {
+            'accounts': accounts.get('accounts'),
+            'stale': accounts.get('stale'),
+            'invoice_id': invoice_id
+        })
@@ -0,0 +1,15 @@
+from iDjango.settings import PLAID_CLIENT_ID, PLAID_SECRET, PLAID_ENV, PLAID_VERSION
+from utils.transport import PooledPlaidClient
+from utils.upstream import LazyUpstreamProxy
+
+
+def build_client() -> PooledPlaidClient:
+    return PooledPlaidClient(client_id=PLAID_CLIENT_ID,
+                             secret=PLAID_SECRET,
+                             environment=PLAID_ENV,
+                             api_version=PLAID_VERSION)
+
+
+# Plaid API calls go through this proxy, so they are timed like every other upstream call. The client and
+# its connection pool are built by the first call, not when the views are imported
+client = LazyUpstreamProxy(build_client, upstream='plaid')
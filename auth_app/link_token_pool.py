@@ -0,0 +1,141 @@
+import logging
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+from utils.rate_limit import lane, BACKGROUND
+from iDjango.settings import PLAID_LINK_TOKEN_POOL_SIZE, PLAID_LINK_TOKEN_MIN_TTL, PLAID_LINK_TOKEN_TTL, \
+    PLAID_LINK_TOKEN_REFILL_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+
+def expiration_timestamp(expiration, default_ttl: float = PLAID_LINK_TOKEN_TTL) -> float:
+    """ Plaid's ISO 8601 expiration ('2020-12-01T12:00:00Z') as a unix timestamp """
+    try:
+        return datetime.fromisoformat(expiration.replace('Z', '+00:00')).timestamp()
+    except (AttributeError, ValueError):
+        return time.time() + default_ttl
+
+
+class LinkTokenPool:
+    """
+    Link tokens created ahead of time by a background thread, started by auth_app.views.start_link_token_pool().
+    The link token request does not depend on the customer, so any pooled token can be handed out. Tokens
+    expiring within min_ttl seconds are dropped (the customer still has to go through Link with them).
+    """
+
+    def __init__(self, create, size: int = PLAID_LINK_TOKEN_POOL_SIZE, min_ttl: float = PLAID_LINK_TOKEN_MIN_TTL,
+                 refill_interval: float = PLAID_LINK_TOKEN_REFILL_INTERVAL):
+        # create() -> {'link_token': ..., 'expiration': ...} or {'error': ...}
+        self.create = create
+        self.size = size
+        self.min_ttl = min_ttl
+        self.refill_interval = refill_interval
+        self._tokens = deque()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.created = 0
+        self.errors = 0
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def take(self):
+        """ A pooled link token or None """
+        if not self.size:
+            return None
+        deadline = time.time() + self.min_ttl
+        with self._lock:
+            while self._tokens:
+                link_token, expires_at = self._tokens.popleft()
+                if expires_at > deadline:
+                    self.hits += 1
+                    break
+                self.expired += 1
+            else:
+                link_token = None
+                self.misses += 1
+        self._wakeup.set()
+        return link_token
+
+    def _drop_expired(self) -> None:
+        deadline = time.time() + self.min_ttl
+        with self._lock:
+            while self._tokens and self._tokens[0][1] <= deadline:
+                self._tokens.popleft()
+                self.expired += 1
+
+    def refill(self) -> int:
+        """ Creates tokens until the pool is full, returns how many were added """
+        self._drop_expired()
+        added = 0
+        while len(self._tokens) < self.size and not self._stopped.is_set():
+            with lane(BACKGROUND):
+                response = self.create()
+            if 'error' in response:
+                self.errors += 1
+                break
+            with self._lock:
+                self._tokens.append((response.get('link_token'), expiration_timestamp(response.get('expiration'))))
+                self.created += 1
+            added += 1
+        return added
+
+    def run(self) -> None:
+        while not self._stopped.is_set():
+            errors = self.errors
+            try:
+                self.refill()
+            except Exception:
+                logger.exception('link_token_pool.refill_failed')
+                self.errors += 1
+            if self.errors > errors:
+                # takes do not wake the thread up while Plaid is failing
+                self._stopped.wait(self.refill_interval)
+                continue
+            self._wakeup.wait(self.refill_interval)
+            self._wakeup.clear()
+
+    def start(self) -> None:
+        if not self.size or self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self.run, name='link-token-pool', daemon=True)
+                self._thread.start()
+
+    def _after_fork(self) -> None:
+        # a worker forked from a preloading master (gunicorn --preload) gets no refill thread, and its copy of
+        # the pooled tokens is shared with its siblings: one link token must not go to two customers
+        started = self._thread is not None
+        self._tokens = deque()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        if started and not self._stopped.is_set():
+            self.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def stats(self) -> dict:
+        taken = self.hits + self.misses
+        return {
+            'size': self.size,
+            'available': len(self._tokens),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / taken, 3) if taken else 0.0,
+            'expired_unused': self.expired,
+            'created': self.created,
+            'errors': self.errors,
+        }
@@ -1,3 +1,124 @@
-from django.test import TestCase
+import asyncio
+import json
+import re
+import time
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.apps import apps
+from django.test import RequestFactory, SimpleTestCase
+
+from . import async_views, views
+from .link_token_pool import LinkTokenPool
+
+
+def iso(timestamp: float) -> str:
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(timestamp))
+
+
+class LinkTokenPoolTests(SimpleTestCase):
+    def setUp(self):
+        self.created = 0
+        self.ttl = 4 * 60 * 60
+
+    def create(self) -> dict:
+        self.created += 1
+        return {'link_token': f'link-{self.created}', 'expiration': iso(time.time() + self.ttl)}
+
+    def test_refill_fills_the_pool_and_take_hands_out_each_token_once(self):
+        pool = LinkTokenPool(self.create, size=3, min_ttl=60)
+        self.assertEqual(pool.refill(), 3)
+        self.assertEqual([pool.take() for _ in range(4)], ['link-1', 'link-2', 'link-3', None])
+        stats = pool.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (3, 1))
+
+    def test_tokens_expiring_within_min_ttl_are_dropped(self):
+        self.ttl = 30
+        pool = LinkTokenPool(self.create, size=2, min_ttl=60)
+        pool.refill()
+        self.assertIsNone(pool.take())
+        self.assertEqual(pool.stats()['expired_unused'], 2)
+
+    def test_failing_create_stops_the_refill(self):
+        pool = LinkTokenPool(mock.Mock(return_value={'error': 'plaid down'}), size=3)
+        self.assertEqual(pool.refill(), 0)
+        self.assertEqual(pool.stats()['errors'], 1)
+
+    def test_forked_worker_drops_the_tokens_of_its_parent(self):
+        pool = LinkTokenPool(self.create, size=2, refill_interval=60)
+        pool.refill()
+        with mock.patch.object(LinkTokenPool, 'start') as start:
+            pool._thread = mock.Mock()
+            pool._after_fork()
+        start.assert_called_once()
+        self.assertEqual((pool.stats()['available'], pool._thread), (0, None))
+
+    def test_pool_is_started_by_the_server_only_when_enabled(self):
+        from . import views
+        with mock.patch.object(views.link_token_pool, 'start') as start:
+            apps.get_app_config('auth_app').ready()
+            start.assert_not_called()
+            with mock.patch.object(views, 'PLAID_LINK_TOKEN_POOL_ENABLED', False):
+                views.start_link_token_pool()
+            start.assert_not_called()
+            with mock.patch.object(views, 'PLAID_LINK_TOKEN_POOL_ENABLED', True):
+                views.start_link_token_pool()
+        start.assert_called_once()
+
+
+class AsyncViewsTests(SimpleTestCase):
+    """ The ASGI views answer like the views they stand in for """
+    accounts = {'accounts': [{'account_id': 'acc_1', 'name': 'Checking', 'mask': '0000'}], 'stale': False}
+
+    def respond(self, view_class, method: str, session: dict, body: str = ''):
+        request = getattr(RequestFactory(), method)('/user/', body, content_type='application/json')
+        request.session = session
+        view = view_class.as_view()
+        return async_to_sync(view)(request) if asyncio.iscoroutinefunction(view) else view(request)
+
+    def both(self, sync_view, async_view, method: str, session: dict, body: str = '') -> list:
+        """ [(status, content, session)] of the sync and the async view """
+        answers = []
+        for view_class in (sync_view, async_view):
+            view_session = dict(session)
+            response = self.respond(view_class, method, view_session, body)
+            # the CSRF token of a form is masked anew on every render
+            content = re.sub(rb'name="csrfmiddlewaretoken" value="\w+"', b'', response.content)
+            answers.append((response.status_code, content, view_session))
+        self.assertEqual(answers[0], answers[1])
+        return answers
+
+    def test_accounts_are_rendered(self):
+        with mock.patch.object(views.AccountsMixin, 'get_accounts', return_value=self.accounts) as get_accounts:
+            (status, content, _), _ = self.both(views.AccountsView, async_views.AsyncAccountsView, 'get',
+                                                {'access_token': 'access-1', 'invoice_id': 'in_1'})
+        self.assertEqual(status, 200)
+        self.assertIn(b'Checking', content)
+        self.assertEqual(get_accounts.call_args_list, [mock.call(access_token='access-1')] * 2)
+
+    def test_accounts_without_access_token_do_not_ask_plaid(self):
+        with mock.patch.object(views.AccountsMixin, 'get_accounts', return_value=self.accounts) as get_accounts:
+            for session in ({'invoice_id': 'in_1'}, {'access_token': 'access-1'}):
+                (status, content, _), _ = self.both(views.AccountsView, async_views.AsyncAccountsView, 'get', session)
+                self.assertEqual(status, 200)
+                self.assertIn(b'Something was wrong', content)
+        get_accounts.assert_not_called()
+
+    def test_public_token_is_exchanged(self):
+        with mock.patch.object(views.AccessTokenMixin, 'exchange_public_token',
+                               return_value={'access_token': 'access-1'}):
+            (status, content, session), _ = self.both(views.AccessTokenView, async_views.AsyncAccessTokenView,
+                                                      'post', {}, json.dumps({'public_token': 'public-1'}))
+        self.assertEqual((status, session), (200, {'access_token': 'access-1'}))
+        self.assertEqual(json.loads(content), {'access_token': 'access-1'})
+        self.assertEqual(self.both(views.AccessTokenView, async_views.AsyncAccessTokenView, 'post', {}, '[')[0][0],
+                         400)
+
+    def test_link_token_is_taken_from_the_pool_first(self):
+        with mock.patch.object(views.link_token_pool, 'take', side_effect=['link-pooled', 'link-pooled', None, None]), \
+                mock.patch.object(views.LinkTokenMixin, 'create_link_token',
+                                  return_value={'link_token': 'link-live'}) as create_link_token:
+            for link_token in ('link-pooled', 'link-live'):
+                (status, _, session), _ = self.both(views.LinkTokenView, async_views.AsyncLinkTokenView, 'post', {})
+                self.assertEqual((status, session), (200, {'link_token': link_token}))
+        self.assertEqual(create_link_token.call_count, 2)
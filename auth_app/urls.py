@@ -1,11 +1,19 @@
 from django.urls import path
-from .views import LinkTokenView, AccessTokenView, AccountsView
+from iDjango.settings import USE_ASYNC_VIEWS
+from utils.lean_endpoints import lean_endpoint
+
+if USE_ASYNC_VIEWS:
+    from .async_views import AsyncLinkTokenView as LinkTokenView, AsyncAccessTokenView as AccessTokenView, \
+        AsyncAccountsView as AccountsView
+else:
+    from .views import LinkTokenView, AccessTokenView, AccountsView
 
 
 app_name = "auth_app"
 
 urlpatterns = [
-    path('get_link_token/', LinkTokenView.as_view(), name='get_link_token'),
-    path('get_access_token/', AccessTokenView.as_view(), name='get_access_token'),
+    # the token endpoints only answer the Link script of the invoice page, they skip most of the middleware
+    path('get_link_token/', lean_endpoint(LinkTokenView.as_view()), name='get_link_token'),
+    path('get_access_token/', lean_endpoint(AccessTokenView.as_view()), name='get_access_token'),
     path('accounts/', AccountsView.as_view(), name='accounts'),
 ]
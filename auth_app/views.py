@@ -1,22 +1,46 @@
 import json
-import plaid
-from django.shortcuts import render
+import logging
 from django.views import View
-from django.http import JsonResponse, HttpResponse
+from django.http import HttpResponse
+from utils import json_fast
+from utils.cache import TTLLRUCache, SingleFlight
+from utils.circuit_breaker import is_outage
 from utils.common_functions import reduce_info
-from iDjango.settings import PLAID_CLIENT_ID, PLAID_SECRET, PLAID_ENV, PLAID_VERSION, PLAID_COUNTRY_CODES, \
-    PLAID_PRODUCTS, PLAID_REDIRECT_URI
+from utils.instrumentation import register_collector, render
+from iDjango.settings import PLAID_COUNTRY_CODES, PLAID_PRODUCTS, PLAID_REDIRECT_URI, ACCOUNTS_CACHE_TTL, \
+    ACCOUNTS_CACHE_MAX_SIZE, ACCOUNTS_CACHE_BACKEND, TOKEN_MAX_BODY_SIZE, STALE_CONTEXT_TTL, \
+    PLAID_LINK_TOKEN_POOL_ENABLED
+from .client import client
+from .link_token_pool import LinkTokenPool
 
-client = plaid.Client(client_id=PLAID_CLIENT_ID,
-                      secret=PLAID_SECRET,
-                      environment=PLAID_ENV,
-                      api_version=PLAID_VERSION)
+logger = logging.getLogger(__name__)
 
+# In process memory by default; access tokens are secrets, a shared tier (if configured) is keyed by digests
+accounts_cache = TTLLRUCache(
+    namespace='accounts',
+    max_size=ACCOUNTS_CACHE_MAX_SIZE,
+    ttl=ACCOUNTS_CACHE_TTL,
+    backend_alias=ACCOUNTS_CACHE_BACKEND,
+    stale_ttl=STALE_CONTEXT_TTL,
+    hash_keys=True,
+)
+accounts_flight = SingleFlight()
+register_collector('accounts_cache', lambda: {**accounts_cache.stats(), 'coalesced': accounts_flight.coalesced})
 
-class LinkTokenView(View):
-    """ Creates a link_token, which is required as a parameter when initializing Link """
+# Bodies of the token endpoints, serialised once
+LINK_TOKEN_BODY = json_fast.JsonTemplate('link_token')
+ACCESS_TOKEN_BODY = json_fast.JsonTemplate('access_token')
+TOKEN_FAILED_BODY = json.dumps({'status': 'false', 'message': 'something went wrong'}).encode()
 
-    def post(self, request):
+
+def json_response(body: bytes, status: int = 200) -> HttpResponse:
+    return HttpResponse(body, content_type='application/json', status=status)
+
+
+class LinkTokenMixin:
+    """ Class for handling link token's views """
+
+    def create_link_token(self) -> dict:
         try:
             response = client.LinkToken.create(
                 {
@@ -35,30 +59,67 @@ class LinkTokenView(View):
                     },
                 }
             )
-            link_token = response.get('link_token')
-            request.session['link_token'] = link_token
-            return JsonResponse({'link_token': link_token})
+            return {'link_token': response.get('link_token'), 'expiration': response.get('expiration')}
         except Exception as e:
-            import traceback
-            traceback.print_exc()
-            return JsonResponse({'status': 'false', 'message': 'something went wrong'}, status=400)
+            logger.exception('plaid.link_token_failed')
+            return {'error': e}
 
+    def take_pooled_link_token(self):
+        """ {'link_token': ...} from the pool, None when it is empty """
+        link_token = link_token_pool.take()
+        return {'link_token': link_token} if link_token else None
 
-class AccessTokenView(View):
-    """ Exchange a Link public_token and access_token. """
+    def get_link_token(self) -> dict:
+        return self.take_pooled_link_token() or self.create_link_token()
+
+
+link_token_pool = LinkTokenPool(LinkTokenMixin().create_link_token)
+register_collector('link_token_pool', link_token_pool.stats)
+
+
+def start_link_token_pool() -> None:
+    """ Called by iDjango.wsgi and iDjango.asgi, the pool is full by the time the first customer asks for a token """
+    if PLAID_LINK_TOKEN_POOL_ENABLED:
+        link_token_pool.start()
+
+
+class LinkTokenView(View, LinkTokenMixin):
+    """ Creates a link_token, which is required as a parameter when initializing Link """
 
     def post(self, request):
-        payload = json.loads(request.body)
-        public_token = payload.get('public_token')
+        link_token = self.get_link_token()
+        if 'error' in link_token:
+            return json_response(TOKEN_FAILED_BODY, status=400)
+        request.session['link_token'] = link_token.get('link_token')
+        return json_response(LINK_TOKEN_BODY.render(link_token.get('link_token')))
+
+
+class AccessTokenMixin:
+    """ Class for handling access token's views """
+
+    def exchange_public_token(self, public_token: str) -> dict:
         try:
             exchange_response = client.Item.public_token.exchange(public_token)
-            access_token = exchange_response.get('access_token')
-            request.session['access_token'] = access_token
-            return JsonResponse({'access_token': access_token})
+            return {'access_token': exchange_response.get('access_token')}
         except Exception as e:
-            import traceback
-            traceback.print_exc()
+            logger.exception('plaid.public_token_exchange_failed')
+            return {'error': e}
+
+
+class AccessTokenView(View, AccessTokenMixin):
+    """ Exchange a Link public_token and access_token. """
+    _payload_fields = {'public_token': ('public_token',)}
+
+    def post(self, request):
+        try:
+            payload = json_fast.extract(request.body, self._payload_fields, max_size=TOKEN_MAX_BODY_SIZE)
+        except ValueError:
             return HttpResponse(status=400)
+        access_token = self.exchange_public_token(payload.get('public_token'))
+        if 'error' in access_token:
+            return HttpResponse(status=400)
+        request.session['access_token'] = access_token.get('access_token')
+        return json_response(ACCESS_TOKEN_BODY.render(access_token.get('access_token')))
 
 
 class AccountsMixin:
@@ -66,33 +127,46 @@ class AccountsMixin:
     _acceptable_type = 'depository'
     _acceptable_subtypes = ('checking', 'savings')
     _fields_to_represent = ('account_id', 'name', 'mask')
-    _options = {}
+
+    def load_accounts(self, access_token: str) -> dict:
+        """ Acceptable accounts of the item and their account_id index, cached per access token """
+        response = client.Accounts.get(access_token)
+        accounts = reduce_info(
+            needed_keys=self._fields_to_represent,
+            data_to_reduce=[account for account in response['accounts']
+                            if account.get('type') == self._acceptable_type
+                            and account.get('subtype') in self._acceptable_subtypes]
+        )
+        entry = {'accounts': accounts, 'index': {account['account_id']: account for account in accounts}}
+        accounts_cache.set(access_token, entry)
+        return entry
 
     def get_accounts(self, access_token: str, account_id: str = None) -> dict:
+        """ Accounts of the item, the last known ones marked as stale while Plaid is down """
+        stale = {}
         try:
-            if account_id:
-                self._options = {'account_ids': [account_id]}
-            response = client.Accounts.get(access_token, _options=self._options)
-            raw_accounts = response['accounts']
-            accounts = reduce_info(
-                needed_keys=self._fields_to_represent,
-                data_to_reduce=[account for account in raw_accounts
-                                if account.get('type') == self._acceptable_type
-                                and account.get('subtype') in self._acceptable_subtypes]
+            entry = accounts_cache.get(access_token) or accounts_flight.do(
+                access_token, lambda: self.load_accounts(access_token)
             )
-            return {'accounts': accounts}
         except Exception as e:
-            import traceback
-            traceback.print_exc()
-            return {'error': e}
+            entry = accounts_cache.get_stale(access_token) if is_outage(e) else None
+            if entry is None:
+                logger.exception('plaid.accounts_failed')
+                return {'error': e}
+            stale = {'stale': True}
+        if not account_id:
+            return {'accounts': entry['accounts'], **stale}
+        account = entry['index'].get(account_id)
+        if account is None:
+            return {'error': 'account_id does not belong to a checking or savings account of this item'}
+        return {'accounts': [account], **stale}
 
     def create_bank_account_token(self, access_token: str, account_id: str) -> dict:
         try:
             stripe_response = client.Processor.stripeBankAccountTokenCreate(access_token, account_id)
             return stripe_response
         except Exception as e:
-            import traceback
-            traceback.print_exc()
+            logger.exception('plaid.bank_account_token_failed', extra={'account_id': account_id})
             # TODO beautiful error
             return {'error': e}
 
@@ -101,8 +175,10 @@ class AccountsView(View, AccountsMixin):
     """ Detail view of bank accounts """
 
     def get(self, request):
-        access_token = request.session['access_token']
-        invoice_id = request.session['invoice_id']
+        access_token = request.session.get('access_token')
+        invoice_id = request.session.get('invoice_id')
+        if not access_token or not invoice_id:
+            return self.not_linked(request)
         accounts = self.get_accounts(
             access_token=access_token
         )
@@ -114,9 +190,15 @@ class AccountsView(View, AccountsMixin):
             })
         return render(request, 'auth_app/accounts.html', {
             'accounts': accounts.get('accounts'),
+            'stale': accounts.get('stale'),
             'invoice_id': invoice_id
         })
 
+    @staticmethod
+    def not_linked(request):
+        """ The checkout was not started from an invoice or Link was not finished, Plaid is not asked """
+        return render(request, 'stripe_app/error.html')
+
 
 
 
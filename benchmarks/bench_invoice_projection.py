@@ -0,0 +1,49 @@
+"""
+Line item projection of invoice contexts: the former recursive InvoiceMixin.search against FieldProjection
+
+    python -m benchmarks.bench_invoice_projection [--lines 20 100 500] [--repeat 200]
+"""
+import argparse
+import os
+import timeit
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'iDjango.settings')
+
+import django  # noqa: E402
+django.setup()
+
+import stripe  # noqa: E402
+from benchmarks.payloads import invoice  # noqa: E402
+from stripe_app.views import InvoiceMixin  # noqa: E402
+
+FIELDS = InvoiceMixin._fields_to_represent_line_invoice
+
+
+def search(line) -> dict:
+    result = {}
+    for item in line.items():
+        if isinstance(item[1], dict):
+            result.update(search(item[1]))
+        elif item[0] in FIELDS:
+            result.update({item[0]: item[1]})
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lines', type=int, nargs='+', default=[20, 100, 500])
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    projection = InvoiceMixin._line_projection
+    for count in args.lines:
+        lines = stripe.Invoice.construct_from(invoice(lines=count), 'sk_test')['lines']['data']
+        assert [search(line) for line in lines] == projection.project(lines)
+        recursive = min(timeit.repeat(lambda: [search(line) for line in lines], number=args.repeat, repeat=3))
+        projected = min(timeit.repeat(lambda: projection.project(lines), number=args.repeat, repeat=3))
+        print(f'{count:5d} lines: recursive search {recursive / args.repeat * 1e6:9.1f} us, '
+              f'FieldProjection {projected / args.repeat * 1e6:9.1f} us')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""
+Rendering of invoice_detail.html: template loading and compiling on every render, the cached loader, and the
+cached loader with the invoice description fragment served from the invoice_fragments cache
+
+    python -m benchmarks.bench_invoice_render [--lines 20 100 500] [--repeat 200]
+"""
+import argparse
+import os
+import timeit
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'iDjango.settings')
+
+import django  # noqa: E402
+django.setup()
+
+from django.core.cache import caches  # noqa: E402
+from django.template import Context  # noqa: E402
+from django.template.backends.django import DjangoTemplates  # noqa: E402
+from iDjango.settings import TEMPLATE_LOADERS  # noqa: E402
+from benchmarks.payloads import invoice  # noqa: E402
+from stripe_app.views import InvoiceMixin  # noqa: E402
+
+TEMPLATE = 'stripe_app/invoice_detail.html'
+
+
+def engine(loaders):
+    """ A template engine of the project (with its tag libraries) using loaders """
+    backend = DjangoTemplates({'NAME': 'bench', 'DIRS': [], 'APP_DIRS': False, 'OPTIONS': {'loaders': loaders}})
+    return backend.engine
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lines', type=int, nargs='+', default=[20, 100, 500])
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    uncached = engine(TEMPLATE_LOADERS)
+    cached = engine([('django.template.loaders.cached.Loader', TEMPLATE_LOADERS)])
+    fragments = caches['invoice_fragments']
+
+    def render(engine, context, clear_fragments):
+        if clear_fragments:
+            fragments.clear()
+        return engine.get_template(TEMPLATE).render(Context(context))
+
+    for count in args.lines:
+        context = InvoiceMixin().project_invoice(invoice(f'in_1HxRender{count:06d}', lines=count))
+        assert render(uncached, context, True) == render(cached, context, False) == render(cached, context, False)
+        timings = {
+            'compiled per render': lambda: render(uncached, context, True),
+            'cached loader': lambda: render(cached, context, True),
+            'cached loader + fragment': lambda: render(cached, context, False),
+        }
+        results = ', '.join(
+            f'{name} {min(timeit.repeat(run, number=args.repeat, repeat=3)) / args.repeat * 1e6:9.1f} us'
+            for name, run in timings.items()
+        )
+        print(f'{count:5d} lines: {results}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""
+Webhook body decoding: json.loads + stripe.Event.construct_from against utils.json_fast.extract
+
+    python -m benchmarks.bench_json_decoding [--lines 20 100 500] [--repeat 200]
+"""
+import argparse
+import json
+import os
+import timeit
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'iDjango.settings')
+
+import django  # noqa: E402
+django.setup()
+
+import stripe  # noqa: E402
+from benchmarks.payloads import invoice_event  # noqa: E402
+from stripe_app.views import InsertLinkView  # noqa: E402
+from utils import json_fast  # noqa: E402
+
+
+def current_path(raw: bytes):
+    payload = json.loads(raw)
+    event = stripe.Event.construct_from(payload, 'sk_test')
+    return event.type, payload.get('data', {}).get('object', {}).get('id')
+
+
+def fast_path(backend: str):
+    def decode(raw: bytes):
+        event = json_fast.extract(raw, InsertLinkView._event_fields, max_size=len(raw), backend=backend)
+        return event['type'], event['object_id']
+    return decode
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lines', type=int, nargs='+', default=[20, 100, 500])
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    candidates = {'construct_from': current_path}
+    candidates.update({f'extract[{backend}]': fast_path(backend) for backend in json_fast.available_backends()})
+    for lines in args.lines:
+        raw = json.dumps(invoice_event(lines=lines)).encode()
+        expected = current_path(raw)
+        print(f'invoice.created with {lines} lines ({len(raw) / 1024:.1f} KiB)')
+        for name, decode in candidates.items():
+            assert decode(raw) == expected, name
+            seconds = min(timeit.repeat(lambda: decode(raw), number=args.repeat, repeat=3)) / args.repeat
+            print(f'  {name:<20} {seconds * 1e6:10.1f} us')
+
+
+if __name__ == '__main__':
+    main()
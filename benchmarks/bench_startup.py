@@ -0,0 +1,74 @@
+"""
+Cold start of a worker per settings profile: time to load the WSGI application (django.setup, app loading,
+template preloading) and latency of the first and second checkout request against the local fake upstreams.
+Every sample is a fresh interpreter.
+
+    python -m benchmarks.bench_startup [--settings iDjango.settings iDjango.settings_payment] [--runs 5]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.fake_upstreams import start_fake_upstreams
+
+INVOICE_PATH = '/payment/invoice/in_1HxStartup000001/'
+
+
+def measure() -> dict:
+    """ Runs in the child interpreter, the environment points Django at the fake upstreams """
+    started = time.perf_counter()
+    from iDjango.wsgi import application  # noqa: F401
+    loaded = time.perf_counter()
+    from django.test import Client
+    client = Client()
+    timings = {'import_ms': (loaded - started) * 1000}
+    for name in ('first_request_ms', 'second_request_ms'):
+        request_started = time.perf_counter()
+        response = client.get(INVOICE_PATH)
+        assert response.status_code == 200, response.status_code
+        timings[name] = (time.perf_counter() - request_started) * 1000
+    return timings
+
+
+def sample(settings_module: str, plaid_url: str, stripe_url: str) -> dict:
+    # every sample starts with an empty shared cache, like a fresh deployment
+    with tempfile.TemporaryDirectory() as cache_dir:
+        environment = {
+            **os.environ,
+            'DJANGO_SETTINGS_MODULE': settings_module,
+            'PLAID_API_BASE': plaid_url,
+            'STRIPE_API_BASE': stripe_url,
+            'PLAID_LINK_TOKEN_POOL_SIZE': '0',
+            'SHARED_CACHE_LOCATION': cache_dir,
+        }
+        output = subprocess.run(
+            [sys.executable, '-m', 'benchmarks.bench_startup', '--child'],
+            env=environment, check=True, capture_output=True, text=True,
+        ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--settings', nargs='+', default=['iDjango.settings', 'iDjango.settings_payment'])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        print(json.dumps(measure()))
+        return
+
+    plaid, stripe = start_fake_upstreams(latency=0.0)
+    for settings_module in args.settings:
+        samples = [sample(settings_module, plaid.url, stripe.url) for _ in range(args.runs)]
+        medians = {name: statistics.median(run[name] for run in samples) for name in samples[0]}
+        print(f'{settings_module:<28} ' + ', '.join(f'{name} {value:7.1f}' for name, value in medians.items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""
+Per-request overhead of the auth_app token endpoints with the full middleware stack (LEAN_ENDPOINTS=false) and
+in lean mode. Overhead is the time of a request (the request.<view> histogram) without its upstream spans, so
+the fake Plaid latency does not count. Sessions are kept in local memory to leave the cache backend out. Every
+mode runs in a fresh interpreter.
+
+    python -m benchmarks.bench_token_endpoints [--requests 300] [--modes full lean]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.fake_upstreams import start_fake_upstreams
+
+INVOICE_PATH = '/payment/invoice/in_1HxTokenBench01/'
+ENDPOINTS = {
+    'get_link_token': ('/auth/get_link_token/', None),
+    'get_access_token': ('/auth/get_access_token/', json.dumps({'public_token': 'public-sandbox-bench'})),
+}
+MODES = {'full': 'false', 'lean': 'true'}
+UPSTREAMS = ('plaid.', 'stripe.')
+
+
+def timing_sums(view_name: str) -> tuple:
+    """ (milliseconds spent in requests of view_name, milliseconds spent in upstream calls) so far """
+    from utils.instrumentation import metrics_snapshot
+    timings = metrics_snapshot()['timings']
+    upstream = sum(timing['sum_ms'] for name, timing in timings.items() if name.startswith(UPSTREAMS))
+    return timings.get(f'request.{view_name}', {}).get('sum_ms', 0.0), upstream
+
+
+def measure(requests: int) -> dict:
+    """ Runs in the child interpreter, the environment points Django at the fake upstreams """
+    from benchmarks.checkout_load import setup_in_process_django
+    with tempfile.TemporaryDirectory() as database_dir:
+        setup_in_process_django(os.environ['PLAID_API_BASE'], os.environ['STRIPE_API_BASE'], database_dir)
+        from django.test import Client
+        # the CSRF check is part of what the endpoints pay for
+        client = Client(enforce_csrf_checks=True)
+        assert client.get(INVOICE_PATH).status_code == 200
+        csrf_token = client.cookies['csrftoken'].value
+        results = {}
+        for name, (path, body) in ENDPOINTS.items():
+            requests_before, upstream_before = timing_sums(f'auth_app:{name}')
+            latencies = []
+            for _ in range(requests):
+                started = time.perf_counter()
+                if body is None:
+                    response = client.post(path, HTTP_X_CSRFTOKEN=csrf_token)
+                else:
+                    response = client.post(path, body, content_type='application/json', HTTP_X_CSRFTOKEN=csrf_token)
+                latencies.append((time.perf_counter() - started) * 1000)
+                assert response.status_code == 200, response.status_code
+            requests_after, upstream_after = timing_sums(f'auth_app:{name}')
+            overhead = (requests_after - requests_before) - (upstream_after - upstream_before)
+            results[name] = {
+                'overhead_mean_ms': overhead / requests,
+                'latency_p50_ms': statistics.median(latencies),
+            }
+    return results
+
+
+def sample(mode: str, requests: int, plaid_url: str, stripe_url: str) -> dict:
+    with tempfile.TemporaryDirectory() as cache_dir:
+        environment = {
+            **os.environ,
+            'DJANGO_SETTINGS_MODULE': 'iDjango.settings',
+            'LEAN_ENDPOINTS': MODES[mode],
+            'PLAID_API_BASE': plaid_url,
+            'STRIPE_API_BASE': stripe_url,
+            'PLAID_LINK_TOKEN_POOL_SIZE': '0',
+            'SHARED_CACHE_LOCATION': cache_dir,
+            'SESSION_CACHE_BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+        output = subprocess.run(
+            [sys.executable, '-m', 'benchmarks.bench_token_endpoints', '--child', '--requests', str(requests)],
+            env=environment, check=True, capture_output=True, text=True,
+        ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=300, help='requests per endpoint')
+    parser.add_argument('--modes', nargs='+', choices=tuple(MODES), default=list(MODES))
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        print(json.dumps(measure(args.requests)))
+        return
+
+    plaid, stripe = start_fake_upstreams(latency=0.0, jitter=0.0)
+    results = {mode: sample(mode, args.requests, plaid.url, stripe.url) for mode in args.modes}
+    for name in ENDPOINTS:
+        print(name)
+        for mode, endpoints in results.items():
+            result = endpoints[name]
+            print(f'  {mode:<5} overhead {result["overhead_mean_ms"] * 1000:8.1f} us/request, '
+                  f'latency p50 {result["latency_p50_ms"]:6.2f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+"""
+Load test of the checkout flow (invoice -> get_link_token -> get_access_token -> accounts -> proof-payment -> payment)
+against the local Plaid and Stripe stand-ins of benchmarks.fake_upstreams
+
+In process, through django.test.Client (fake upstreams are started too):
+
+    python -m benchmarks.checkout_load --checkouts 200 --concurrency 20 --latency 0.05 --error-rate 0.01
+
+Against a running server that was started with PLAID_API_BASE/STRIPE_API_BASE pointing at
+`python -m benchmarks.fake_upstreams`:
+
+    python -m benchmarks.checkout_load --target http://127.0.0.1:8000 \
+        --plaid-url http://127.0.0.1:8101 --stripe-url http://127.0.0.1:8102
+
+Results are saved as JSON to benchmarks/results/ so runs can be compared.
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+import requests
+
+from benchmarks.fake_upstreams import start_fake_upstreams
+
+RESULTS_DIR = Path(__file__).resolve().parent / 'results'
+ACCOUNT_ID = 'acc0000BenchAccountId'
+ERROR_MARKER = b'Something was wrong'
+
+
+def checkout_steps(invoice_id: str) -> tuple:
+    """ (step, method, path, json body, form data) """
+    return (
+        ('invoice', 'GET', f'/payment/invoice/{invoice_id}/', None, None),
+        ('get_link_token', 'POST', '/auth/get_link_token/', None, None),
+        ('get_access_token', 'POST', '/auth/get_access_token/', {'public_token': 'public-sandbox-bench'}, None),
+        ('accounts', 'GET', '/auth/accounts/', None, None),
+        ('proof_payment', 'POST', '/payment/proof-payment/', None, {'account': ACCOUNT_ID}),
+        ('payment', 'GET', '/payment/payment/', None, None),
+    )
+
+
+class InProcessUser:
+    """ One customer going through the Django URL routes in this process """
+
+    def __init__(self):
+        from django.test import Client
+        self.client = Client(raise_request_exception=False)
+
+    def request(self, method: str, path: str, json_body: dict = None, form: dict = None) -> tuple:
+        if method == 'GET':
+            response = self.client.get(path)
+        elif json_body is not None:
+            response = self.client.post(path, data=json.dumps(json_body), content_type='application/json')
+        else:
+            response = self.client.post(path, data=form or {})
+        return response.status_code, response.content
+
+
+class HttpUser:
+    """ One customer going through a running server, CSRF token is taken from the csrftoken cookie """
+
+    def __init__(self, target: str):
+        self.target = target.rstrip('/')
+        self.session = requests.Session()
+
+    def request(self, method: str, path: str, json_body: dict = None, form: dict = None) -> tuple:
+        headers = {'X-CSRFToken': self.session.cookies.get('csrftoken', '')}
+        response = self.session.request(
+            method, self.target + path, json=json_body, data=form, headers=headers, allow_redirects=False
+        )
+        return response.status_code, response.content
+
+
+def run_checkout(user, number: int) -> dict:
+    timings = {}
+    started = time.perf_counter()
+    for step, method, path, json_body, form in checkout_steps(f'in_1HxLoad{number:06d}'):
+        step_started = time.perf_counter()
+        status, body = user.request(method, path, json_body=json_body, form=form)
+        timings[step] = time.perf_counter() - step_started
+        if status != 200 or ERROR_MARKER in body:
+            return {'ok': False, 'failed_step': step, 'status': status, 'timings': timings,
+                    'duration': time.perf_counter() - started}
+    return {'ok': True, 'timings': timings, 'duration': time.perf_counter() - started}
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, round(q / 100 * (len(ordered) - 1)))]
+
+
+def summarize(values: list) -> dict:
+    return {
+        'count': len(values),
+        'p50_ms': percentile(values, 50) * 1000,
+        'p95_ms': percentile(values, 95) * 1000,
+        'p99_ms': percentile(values, 99) * 1000,
+        'max_ms': max(values) * 1000 if values else 0.0,
+    }
+
+
+def upstream_stats(url: str = None, server=None) -> dict:
+    if server is not None:
+        return server.stats()
+    return requests.get(url + '/__stats__').json()
+
+
+def reset_upstream_stats(url: str = None, server=None) -> None:
+    if server is not None:
+        server.reset()
+    else:
+        requests.post(url + '/__reset__')
+
+
+def setup_in_process_django(plaid_url: str, stripe_url: str, database_dir: str) -> None:
+    os.environ['PLAID_API_BASE'] = plaid_url
+    os.environ['STRIPE_API_BASE'] = stripe_url
+    # a run starts with empty shared caches and sessions
+    os.environ.setdefault('SHARED_CACHE_LOCATION', os.path.join(database_dir, 'shared-cache'))
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'iDjango.settings')
+    import django
+    django.setup()
+    from django.conf import settings
+    from django.db import connection
+    from django.test.utils import setup_test_environment
+    setup_test_environment()
+    # a file database, the in-memory test database cannot be shared by the user threads
+    settings.DATABASES['default'].setdefault('TEST', {})['NAME'] = os.path.join(database_dir, 'checkout.sqlite3')
+    connection.creation.create_test_db(verbosity=0)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkouts', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=0.05, help='fake upstream latency, in process mode')
+    parser.add_argument('--jitter', type=float, default=0.01)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--rate-limit', type=int, default=0, help='fake upstream calls per second before 429s')
+    parser.add_argument('--lines', type=int, default=20, help='line items per fake invoice')
+    parser.add_argument('--target', help='base URL of a running server, in process when omitted')
+    parser.add_argument('--plaid-url', help='fake Plaid of a running server')
+    parser.add_argument('--stripe-url', help='fake Stripe of a running server')
+    parser.add_argument('--label', default='')
+    parser.add_argument('--output', help=f'result file, defaults to {RESULTS_DIR}/checkout-<time>.json')
+    args = parser.parse_args()
+
+    plaid = stripe = None
+    database_dir = tempfile.TemporaryDirectory()
+    if args.target:
+        if not (args.plaid_url and args.stripe_url):
+            parser.error('--target needs --plaid-url and --stripe-url')
+        make_user = lambda: HttpUser(args.target)  # noqa: E731
+    else:
+        plaid, stripe = start_fake_upstreams(
+            latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, rate_limit=args.rate_limit,
+            lines=args.lines,
+        )
+        args.plaid_url, args.stripe_url = plaid.url, stripe.url
+        setup_in_process_django(plaid.url, stripe.url, database_dir.name)
+        make_user = InProcessUser
+
+    reset_upstream_stats(args.plaid_url, plaid)
+    reset_upstream_stats(args.stripe_url, stripe)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        checkouts = list(executor.map(lambda number: run_checkout(make_user(), number), range(args.checkouts)))
+    duration = time.perf_counter() - started
+
+    completed = [checkout for checkout in checkouts if checkout['ok']]
+    steps = {step for checkout in checkouts for step in checkout['timings']}
+    upstream_calls = {**upstream_stats(args.plaid_url, plaid), **upstream_stats(args.stripe_url, stripe)}
+    requests_sent = sum(len(checkout['timings']) for checkout in checkouts)
+    result = {
+        'label': args.label,
+        'started_at': datetime.now().isoformat(timespec='seconds'),
+        'config': {key: value for key, value in vars(args).items() if key != 'output'},
+        'checkouts': args.checkouts,
+        'completed': len(completed),
+        'failed': {step: sum(1 for checkout in checkouts if checkout.get('failed_step') == step) for step in steps},
+        'duration_s': duration,
+        'requests_per_second': requests_sent / duration,
+        'checkouts_per_second': len(completed) / duration,
+        'latency': {
+            'checkout': summarize([checkout['duration'] for checkout in completed]),
+            **{step: summarize([checkout['timings'][step] for checkout in checkouts if step in checkout['timings']])
+               for step in sorted(steps)},
+        },
+        'upstream_calls': upstream_calls,
+        'upstream_calls_per_checkout': {
+            endpoint: calls / args.checkouts for endpoint, calls in sorted(upstream_calls.items())
+        },
+    }
+
+    output = Path(args.output) if args.output else RESULTS_DIR / f"checkout-{datetime.now():%Y%m%d-%H%M%S}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(result, indent=2))
+    database_dir.cleanup()
+
+    print(f"{result['completed']}/{args.checkouts} checkouts in {duration:.2f}s, "
+          f"{result['requests_per_second']:.1f} req/s, {result['checkouts_per_second']:.1f} checkouts/s")
+    for name, latency in result['latency'].items():
+        print(f"  {name:<17} p50 {latency['p50_ms']:8.1f} ms  p95 {latency['p95_ms']:8.1f} ms  "
+              f"p99 {latency['p99_ms']:8.1f} ms")
+    for endpoint, calls in result['upstream_calls_per_checkout'].items():
+        print(f'  {endpoint:<40} {calls:.2f} calls/checkout')
+    print(f'saved to {output}')
+
+
+if __name__ == '__main__':
+    main()
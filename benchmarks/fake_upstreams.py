@@ -0,0 +1,243 @@
+"""
+Local Plaid and Stripe stand-ins with configurable latency and error rate
+
+    python -m benchmarks.fake_upstreams --plaid-port 8101 --stripe-port 8102 --latency 0.05 --error-rate 0.01
+
+With --rate-limit N, calls beyond N per second get a 429 with Retry-After, as Stripe and Plaid answer them.
+
+then run the app with PLAID_API_BASE=http://127.0.0.1:8101 STRIPE_API_BASE=http://127.0.0.1:8102.
+GET /__stats__ returns the number of calls per endpoint, POST /__reset__ clears it.
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from collections import Counter, deque
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+from benchmarks.payloads import invoice, plaid_accounts
+
+
+class FakeUpstreamServer(ThreadingHTTPServer, ABC):
+    """ Base of the fake upstreams, subclasses declare their routes and their error bodies """
+    daemon_threads = True
+    # (method, path pattern, endpoint name, handler name)
+    routes = ()
+
+    def __init__(self, address, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0,
+                 rate_limit: int = 0):
+        super().__init__(address, FakeUpstreamHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.calls = Counter()
+        self._calls_lock = threading.Lock()
+        self._recent_calls = deque()
+        self.compiled_routes = [(method, re.compile(pattern), name, handler)
+                                for method, pattern, name, handler in self.routes]
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def count(self, endpoint: str) -> None:
+        with self._calls_lock:
+            self.calls[endpoint] += 1
+
+    def reset(self) -> None:
+        with self._calls_lock:
+            self.calls.clear()
+
+    def over_rate_limit(self) -> bool:
+        """ True when more than rate_limit calls were let through during the last second """
+        if not self.rate_limit:
+            return False
+        now = time.monotonic()
+        with self._calls_lock:
+            while self._recent_calls and self._recent_calls[0] <= now - 1:
+                self._recent_calls.popleft()
+            if len(self._recent_calls) >= self.rate_limit:
+                self.calls['rate_limited'] += 1
+                return True
+            self._recent_calls.append(now)
+            return False
+
+    def stats(self) -> dict:
+        with self._calls_lock:
+            return dict(self.calls)
+
+    def serve_in_thread(self) -> 'FakeUpstreamServer':
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    @abstractmethod
+    def error_body(self) -> dict:
+        """ Body of the 500 answered to a call picked by error_rate """
+
+    @abstractmethod
+    def rate_limit_body(self) -> dict:
+        """ Body of the 429 answered to a call over rate_limit """
+
+
+class FakePlaidServer(FakeUpstreamServer):
+    routes = (
+        ('POST', r'^/link/token/create$', 'plaid.link_token_create', 'link_token_create'),
+        ('POST', r'^/item/public_token/exchange$', 'plaid.public_token_exchange', 'public_token_exchange'),
+        ('POST', r'^/accounts/get$', 'plaid.accounts_get', 'accounts_get'),
+        ('POST', r'^/processor/stripe/bank_account_token/create$', 'plaid.stripe_bank_account_token_create',
+         'bank_account_token_create'),
+    )
+
+    def error_body(self) -> dict:
+        return {'error_type': 'API_ERROR', 'error_code': 'INTERNAL_SERVER_ERROR', 'error_message': 'fake outage',
+                'display_message': None, 'request_id': uuid.uuid4().hex, 'causes': []}
+
+    def rate_limit_body(self) -> dict:
+        return {'error_type': 'RATE_LIMIT_EXCEEDED', 'error_code': 'RATE_LIMIT', 'error_message': 'fake rate limit',
+                'display_message': None, 'request_id': uuid.uuid4().hex, 'causes': []}
+
+    def link_token_create(self, match, body, query) -> dict:
+        expiration = datetime.now(timezone.utc) + timedelta(hours=4)
+        return {'link_token': f'link-sandbox-{uuid.uuid4()}', 'expiration': expiration.isoformat(),
+                'request_id': uuid.uuid4().hex}
+
+    def public_token_exchange(self, match, body, query) -> dict:
+        return {'access_token': f'access-sandbox-{uuid.uuid4()}', 'item_id': uuid.uuid4().hex,
+                'request_id': uuid.uuid4().hex}
+
+    def accounts_get(self, match, body, query) -> dict:
+        return {'accounts': plaid_accounts(), 'item': {'item_id': uuid.uuid4().hex},
+                'request_id': uuid.uuid4().hex}
+
+    def bank_account_token_create(self, match, body, query) -> dict:
+        return {'stripe_bank_account_token': f'btok_{uuid.uuid4().hex[:24]}', 'request_id': uuid.uuid4().hex}
+
+
+class FakeStripeServer(FakeUpstreamServer):
+    routes = (
+        ('GET', r'^/v1/invoices/(?P<id>[^/]+)$', 'stripe.invoice_retrieve', 'invoice_retrieve'),
+        ('GET', r'^/v1/invoices$', 'stripe.invoice_list', 'invoice_list'),
+        ('POST', r'^/v1/invoices/(?P<id>[^/]+)/pay$', 'stripe.invoice_pay', 'invoice_pay'),
+        ('POST', r'^/v1/invoices/(?P<id>[^/]+)$', 'stripe.invoice_modify', 'invoice_modify'),
+        ('POST', r'^/v1/customers/(?P<id>[^/]+)$', 'stripe.customer_modify', 'customer_modify'),
+    )
+
+    def __init__(self, *args, lines: int = 20, list_size: int = 250, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lines = lines
+        self.list_size = list_size
+
+    def error_body(self) -> dict:
+        return {'error': {'type': 'api_error', 'message': 'fake outage'}}
+
+    def rate_limit_body(self) -> dict:
+        return {'error': {'type': 'invalid_request_error', 'code': 'rate_limit', 'message': 'fake rate limit'}}
+
+    def invoice_retrieve(self, match, body, query) -> dict:
+        return invoice(match.group('id'), self.lines)
+
+    def invoice_list(self, match, body, query) -> dict:
+        """ Pages of limit invoices out of list_size, after starting_after """
+        limit = int(query.get('limit', 10))
+        starting_after = query.get('starting_after')
+        first = int(starting_after[len('in_1HxList'):]) + 1 if starting_after else 0
+        numbers = range(first, min(first + limit, self.list_size))
+        data = [invoice(f'in_1HxList{number:06d}', self.lines) for number in numbers]
+        return {'object': 'list', 'data': data, 'has_more': first + limit < self.list_size, 'url': '/v1/invoices'}
+
+    def invoice_pay(self, match, body, query) -> dict:
+        return {**invoice(match.group('id'), self.lines), 'paid': True, 'status': 'paid'}
+
+    def invoice_modify(self, match, body, query) -> dict:
+        return invoice(match.group('id'), self.lines)
+
+    def customer_modify(self, match, body, query) -> dict:
+        return {'id': match.group('id'), 'object': 'customer', 'default_source': f'ba_{uuid.uuid4().hex[:24]}'}
+
+
+class FakeUpstreamHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status: int, body: dict, headers: dict = None) -> None:
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _handle(self, method: str) -> None:
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        path, _, query_string = self.path.partition('?')
+        query = {name: values[-1] for name, values in parse_qs(query_string).items()}
+        server = self.server
+        if path == '/__stats__':
+            return self._send_json(200, server.stats())
+        if path == '/__reset__':
+            server.reset()
+            return self._send_json(200, {})
+        for route_method, pattern, endpoint, handler in server.compiled_routes:
+            match = pattern.match(path)
+            if route_method == method and match:
+                if server.over_rate_limit():
+                    return self._send_json(429, server.rate_limit_body(), {'Retry-After': '1'})
+                server.count(endpoint)
+                time.sleep(max(0.0, server.latency + random.uniform(-server.jitter, server.jitter)))
+                if random.random() < server.error_rate:
+                    return self._send_json(500, server.error_body())
+                return self._send_json(200, getattr(server, handler)(match, body, query))
+        self._send_json(404, server.error_body())
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+
+def start_fake_upstreams(host: str = '127.0.0.1', plaid_port: int = 0, stripe_port: int = 0, **options) -> tuple:
+    lines = options.pop('lines', 20)
+    plaid = FakePlaidServer((host, plaid_port), **options).serve_in_thread()
+    stripe = FakeStripeServer((host, stripe_port), lines=lines, **options).serve_in_thread()
+    return plaid, stripe
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--plaid-port', type=int, default=8101)
+    parser.add_argument('--stripe-port', type=int, default=8102)
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds added to every upstream call')
+    parser.add_argument('--jitter', type=float, default=0.01)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--rate-limit', type=int, default=0, help='calls per second before 429s, 0 for no limit')
+    parser.add_argument('--lines', type=int, default=20, help='line items per invoice')
+    args = parser.parse_args()
+    plaid, stripe = start_fake_upstreams(
+        args.host, args.plaid_port, args.stripe_port, latency=args.latency, jitter=args.jitter,
+        error_rate=args.error_rate, rate_limit=args.rate_limit, lines=args.lines,
+    )
+    print(f'PLAID_API_BASE={plaid.url} STRIPE_API_BASE={stripe.url}')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+""" Stripe and Plaid shaped payloads for the benchmarks """
+import time
+
+
+def invoice_line(number: int) -> dict:
+    return {
+        'id': f'il_1HxLine{number:06d}',
+        'object': 'line_item',
+        'amount': 1500,
+        'currency': 'usd',
+        'description': f'Consulting hours, item {number}',
+        'discount_amounts': [],
+        'discountable': True,
+        'discounts': [],
+        'invoice_item': f'ii_1HxItem{number:06d}',
+        'livemode': False,
+        'metadata': {},
+        'period': {'end': 1606780800, 'start': 1606780800},
+        'price': {
+            'id': f'price_1HxPrice{number:06d}',
+            'object': 'price',
+            'active': True,
+            'billing_scheme': 'per_unit',
+            'created': 1606780800,
+            'currency': 'usd',
+            'livemode': False,
+            'lookup_key': None,
+            'metadata': {},
+            'nickname': None,
+            'product': f'prod_IYz{number:06d}',
+            'recurring': None,
+            'tiers_mode': None,
+            'transform_quantity': None,
+            'type': 'one_time',
+            'unit_amount': 500,
+            'unit_amount_decimal': '500',
+        },
+        'proration': False,
+        'quantity': 3,
+        'subscription': None,
+        'tax_amounts': [],
+        'tax_rates': [],
+        'type': 'invoiceitem',
+    }
+
+
+def invoice(invoice_id: str = 'in_1HxBench', lines: int = 20) -> dict:
+    data = [invoice_line(number) for number in range(lines)]
+    total = sum(line['amount'] for line in data)
+    return {
+        'id': invoice_id,
+        'object': 'invoice',
+        'account_country': 'US',
+        'account_name': 'iTechArtGroup',
+        'amount_due': total,
+        'amount_paid': 0,
+        'amount_remaining': total,
+        'attempt_count': 0,
+        'attempted': False,
+        'auto_advance': True,
+        'billing_reason': 'manual',
+        'collection_method': 'send_invoice',
+        'created': 1606780800,
+        'currency': 'usd',
+        'customer': 'cus_IYzBench',
+        'customer_email': 'jenny.rosen@example.com',
+        'customer_name': 'Jenny Rosen',
+        'description': None,
+        'due_date': int(time.time()) + 30 * 24 * 3600,
+        'hosted_invoice_url': f'https://invoice.stripe.com/i/acct_1Ht9Dq/{invoice_id}',
+        'invoice_pdf': f'https://pay.stripe.com/invoice/acct_1Ht9Dq/{invoice_id}/pdf',
+        'lines': {
+            'object': 'list',
+            'data': data,
+            'has_more': False,
+            'total_count': lines,
+            'url': f'/v1/invoices/{invoice_id}/lines',
+        },
+        'livemode': False,
+        'metadata': {},
+        'number': 'F3C6A1B2-0001',
+        'paid': False,
+        'period_end': 1606780800,
+        'period_start': 1606780800,
+        'status': 'open',
+        'status_transitions': {'finalized_at': 1606780800, 'marked_uncollectible_at': None,
+                               'paid_at': None, 'voided_at': None},
+        'subtotal': total,
+        'total': total,
+    }
+
+
+def invoice_event(event_type: str = 'invoice.created', lines: int = 20, number: int = 0) -> dict:
+    return {
+        'id': f'evt_1HxBench{number:08d}',
+        'object': 'event',
+        'api_version': '2020-08-27',
+        'created': 1606780800,
+        'data': {'object': invoice(f'in_1HxBench{number:06d}', lines)},
+        'livemode': False,
+        'pending_webhooks': 1,
+        'request': {'id': None, 'idempotency_key': None},
+        'type': event_type,
+    }
+
+
+def plaid_accounts() -> list:
+    accounts = [
+        ('checking', 'depository', 'Plaid Checking', '0000'),
+        ('savings', 'depository', 'Plaid Saving', '1111'),
+        ('cd', 'depository', 'Plaid CD', '2222'),
+        ('credit card', 'credit', 'Plaid Credit Card', '3333'),
+        ('money market', 'depository', 'Plaid Money Market', '4444'),
+        ('ira', 'investment', 'Plaid IRA', '5555'),
+        ('401k', 'investment', 'Plaid 401k', '6666'),
+        ('student', 'loan', 'Plaid Student Loan', '7777'),
+        ('mortgage', 'loan', 'Plaid Mortgage', '8888'),
+    ]
+    return [
+        {
+            'account_id': f'acc{mask}BenchAccountId',
+            'balances': {'available': 100, 'current': 110, 'iso_currency_code': 'USD', 'limit': None,
+                         'unofficial_currency_code': None},
+            'mask': mask,
+            'name': name,
+            'official_name': None,
+            'subtype': subtype,
+            'type': account_type,
+        }
+        for subtype, account_type, name, mask in accounts
+    ]
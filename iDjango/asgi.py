@@ -9,8 +9,22 @@ https://docs.djangoproject.com/en/3.1/howto/deployment/asgi/
 
 import os
 
-from django.core.asgi import get_asgi_application
+import django
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'iDjango.settings')
 
-application = get_asgi_application()
+# get_asgi_application() with the handler producing streaming responses off the event loop
+django.setup(set_prefix=False)
+
+# imported once Django is set up
+from utils.concurrency import StreamingASGIHandler  # noqa: E402
+from stripe_app.events import InvoiceEventsApp  # noqa: E402
+from auth_app.views import start_link_token_pool  # noqa: E402
+
+django_application = StreamingASGIHandler()
+
+# invoice event streams are long-lived, they are served next to Django instead of by a view
+application = InvoiceEventsApp(django_application)
+
+# only processes serving requests fill the link token pool
+start_link_token_pool()
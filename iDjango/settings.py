@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.1/ref/settings/
 """
 import os
+import tempfile
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -37,11 +38,14 @@ INSTALLED_APPS = [
     'django.contrib.messages',
     'django.contrib.staticfiles',
     'crispy_forms',
-    'auth_app',
-    'stripe_app'
+    'auth_app.apps.AuthAppConfig',
+    'stripe_app.apps.StripeAppConfig',
 ]
 
 MIDDLEWARE = [
+    'utils.structured_logging.RequestIdMiddleware',
+    'utils.instrumentation.ServerTimingMiddleware',
+    'utils.lean_endpoints.LeanEndpointMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -49,19 +53,67 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
-    'django.middleware.cache.FetchFromCacheMiddleware',
 ]
 
-SESSION_SAVE_EVERY_REQUEST = True
+# Checkout sessions live in a cache and are written only when one of the checkout keys changes
+# (see utils.checkout_session). Every worker process has to reach them, so they are kept in the shared cache
+# backend unless SESSION_CACHE_BACKEND/SESSION_CACHE_LOCATION say otherwise.
+SESSION_ENGINE = 'utils.checkout_session'
+SESSION_CACHE_ALIAS = 'sessions'
+SESSION_SAVE_EVERY_REQUEST = False
+
+# The cache shared by the worker processes, the second tier of the utils.cache.TTLLRUCache caches. The file
+# based default only suits development and single-node trials: it only reaches the processes of one node and
+# lists its directory on every set to cull. Point SHARED_CACHE_BACKEND/SHARED_CACHE_LOCATION at memcached
+# in production.
+SHARED_CACHE_BACKEND = os.environ.get('SHARED_CACHE_BACKEND', 'django.core.cache.backends.filebased.FileBasedCache')
+SHARED_CACHE_LOCATION = os.environ.get(
+    'SHARED_CACHE_LOCATION', os.path.join(tempfile.gettempdir(), 'idjango-shared-cache')
+)
+# Webhook invalidations are written to the database, every worker process polls them and drops the keys from
+# its in-process tier (see stripe_app.cache_bus)
+CACHE_INVALIDATION_POLL_INTERVAL = float(os.environ.get('CACHE_INVALIDATION_POLL_INTERVAL', 1))
+CACHE_INVALIDATION_RETENTION = int(os.environ.get('CACHE_INVALIDATION_RETENTION', 60 * 60))
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'shared': {
+        'BACKEND': SHARED_CACHE_BACKEND,
+        'LOCATION': SHARED_CACHE_LOCATION,
+        'OPTIONS': {'MAX_ENTRIES': int(os.environ.get('SHARED_CACHE_MAX_ENTRIES', 10000))},
+    },
+    'sessions': {
+        'BACKEND': os.environ.get('SESSION_CACHE_BACKEND', SHARED_CACHE_BACKEND),
+        'LOCATION': os.environ.get('SESSION_CACHE_LOCATION', os.path.join(SHARED_CACHE_LOCATION, 'sessions')),
+        'OPTIONS': {'MAX_ENTRIES': int(os.environ.get('SESSION_CACHE_MAX_ENTRIES', 100000))},
+    },
+    # Rendered invoice descriptions, keyed by invoice id and state version so they never go stale
+    'invoice_fragments': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'invoice-fragments',
+        'OPTIONS': {'MAX_ENTRIES': int(os.environ.get('INVOICE_FRAGMENT_CACHE_MAX_ENTRIES', 1000))},
+    },
+}
 
 ROOT_URLCONF = 'iDjango.urls'
 
+# Compiled templates are kept by the cached loader (and preloaded by the app configs), set TEMPLATE_CACHE=false
+# to pick up template edits without a restart
+TEMPLATE_CACHE = os.environ.get('TEMPLATE_CACHE', 'true').lower() == 'true'
+TEMPLATE_LOADERS = [
+    'django.template.loaders.filesystem.Loader',
+    'django.template.loaders.app_directories.Loader',
+]
+
 TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
         'DIRS': [],
-        'APP_DIRS': True,
         'OPTIONS': {
+            'loaders': [('django.template.loaders.cached.Loader', TEMPLATE_LOADERS)] if TEMPLATE_CACHE
+            else TEMPLATE_LOADERS,
             'context_processors': [
                 'django.template.context_processors.debug',
                 'django.template.context_processors.request',
@@ -132,5 +184,197 @@ PLAID_VERSION = os.environ.get('PLAID_VERSION', '2020-09-14')
 PLAID_COUNTRY_CODES = os.environ.get('PLAID_COUNTRY_CODES', ['US'])
 PLAID_PRODUCTS = os.environ.get('PLAID_PRODUCTS', ['auth', 'transactions'])
 PLAID_REDIRECT_URI = os.environ.get('PLAID_REDIRECT_URI', 'https://8abafd455030.ngrok.io/user/accounts/') # the destination where a user should be forwarded after completing the Link flow
+PLAID_API_BASE = os.environ.get('PLAID_API_BASE', '')  # overrides https://<PLAID_ENV>.plaid.com, e.g. for benchmarks
+
+STRIPE_API_BASE = os.environ.get('STRIPE_API_BASE', 'https://api.stripe.com')
+STRIPE_BEARER = 'sk_test_51Ht9DqLCBQOzNn35iDlwc5NjBJD9GBFkOR1cSpzVudkaf9pZhNhrIXLw5nvAwpVnZH27bevN3jONg8zjLcjNvRdj00YDZxoedE'
+
+# Link tokens created ahead of time by auth_app.link_token_pool, started by the server entry points (iDjango.wsgi,
+# iDjango.asgi) when enabled, so tests, workers and scripts do not create Plaid tokens. Plaid link tokens live
+# for 4 hours, pooled ones are not handed out when they expire within PLAID_LINK_TOKEN_MIN_TTL seconds
+PLAID_LINK_TOKEN_POOL_ENABLED = os.environ.get('PLAID_LINK_TOKEN_POOL_ENABLED', 'false').lower() == 'true'
+PLAID_LINK_TOKEN_POOL_SIZE = int(os.environ.get('PLAID_LINK_TOKEN_POOL_SIZE', 10))
+PLAID_LINK_TOKEN_TTL = int(os.environ.get('PLAID_LINK_TOKEN_TTL', 4 * 60 * 60))
+PLAID_LINK_TOKEN_MIN_TTL = int(os.environ.get('PLAID_LINK_TOKEN_MIN_TTL', 30 * 60))
+PLAID_LINK_TOKEN_REFILL_INTERVAL = float(os.environ.get('PLAID_LINK_TOKEN_REFILL_INTERVAL', 60))
+
+# Invoice context read model (see utils.cache.TTLLRUCache)
+INVOICE_CACHE_TTL = int(os.environ.get('INVOICE_CACHE_TTL', 60))
+INVOICE_CACHE_MAX_SIZE = int(os.environ.get('INVOICE_CACHE_MAX_SIZE', 1024))
+INVOICE_CACHE_BACKEND = os.environ.get('INVOICE_CACHE_BACKEND', 'shared')
+
+# Serve the Plaid/Stripe views from auth_app.async_views and stripe_app.async_views (run under iDjango.asgi)
+USE_ASYNC_VIEWS = os.environ.get('USE_ASYNC_VIEWS', 'false').lower() == 'true'
+UPSTREAM_THREAD_POOL_SIZE = int(os.environ.get('UPSTREAM_THREAD_POOL_SIZE', 100))
+UPSTREAM_CALL_TIMEOUT = float(os.environ.get('UPSTREAM_CALL_TIMEOUT', 10))
+
+# Invoice state pushed to open invoice and payment result pages as Server-Sent Events (see stripe_app.events,
+# served under iDjango.asgi only). Webhooks reach the browsers connected to the process receiving them.
+EVENT_STREAM_HEARTBEAT = float(os.environ.get('EVENT_STREAM_HEARTBEAT', 15))
+EVENT_STREAM_RETRY_MS = int(os.environ.get('EVENT_STREAM_RETRY_MS', 5000))
+EVENT_STREAM_QUEUE_SIZE = int(os.environ.get('EVENT_STREAM_QUEUE_SIZE', 16))
+EVENT_STREAM_MAX_SUBSCRIBERS = int(os.environ.get('EVENT_STREAM_MAX_SUBSCRIBERS', 1000))
+
+# Pooled keep-alive HTTP sessions for the Plaid and Stripe clients (see utils.transport)
+UPSTREAM_POOL_CONNECTIONS = int(os.environ.get('UPSTREAM_POOL_CONNECTIONS', 10))
+UPSTREAM_POOL_MAXSIZE = int(os.environ.get('UPSTREAM_POOL_MAXSIZE', 50))
+UPSTREAM_POOL_BLOCK = os.environ.get('UPSTREAM_POOL_BLOCK', 'false').lower() == 'true'
+UPSTREAM_MAX_RETRIES = int(os.environ.get('UPSTREAM_MAX_RETRIES', 2))
+UPSTREAM_RETRY_BACKOFF = float(os.environ.get('UPSTREAM_RETRY_BACKOFF', 0.3))
+UPSTREAM_HTTP_TIMEOUT = float(os.environ.get('UPSTREAM_HTTP_TIMEOUT', 30))
+PLAID_IDEMPOTENT_PATHS = ('/accounts/get', '/item/get', '/auth/get', '/institutions/get_by_id')
+
+# Client-side token buckets per upstream and per endpoint (see utils.rate_limit), per process. Calls wait up to
+# UPSTREAM_RATE_LIMIT_WAIT seconds for a token; a 429 pauses the upstream for its Retry-After and is retried
+UPSTREAM_RATE_LIMITS = {
+    'stripe': {
+        'rate': float(os.environ.get('STRIPE_RATE_LIMIT', 20)),
+        'burst': float(os.environ.get('STRIPE_RATE_LIMIT_BURST', 40)),
+        'endpoints': {
+            'Invoice.modify': {'rate': 10, 'burst': 20},
+        },
+    },
+    'plaid': {
+        'rate': float(os.environ.get('PLAID_RATE_LIMIT', 20)),
+        'burst': float(os.environ.get('PLAID_RATE_LIMIT_BURST', 40)),
+        'endpoints': {
+            'LinkToken.create': {'rate': 10, 'burst': 20},
+        },
+    },
+}
+UPSTREAM_RATE_LIMIT_WAIT = float(os.environ.get('UPSTREAM_RATE_LIMIT_WAIT', 10))
+UPSTREAM_RATE_LIMIT_RETRIES = int(os.environ.get('UPSTREAM_RATE_LIMIT_RETRIES', 2))
+UPSTREAM_RATE_LIMIT_BACKOFF = float(os.environ.get('UPSTREAM_RATE_LIMIT_BACKOFF', 1))
+
+# Circuit breakers per upstream (see utils.circuit_breaker): open once `failure_rate` of at least `minimum_calls`
+# calls within `window` seconds failed with an outage error, fail fast for `open_seconds`, then probe
+UPSTREAM_CIRCUIT_BREAKERS = {
+    upstream: {
+        'failure_rate': float(os.environ.get(f'{upstream.upper()}_BREAKER_FAILURE_RATE', 0.5)),
+        'minimum_calls': int(os.environ.get(f'{upstream.upper()}_BREAKER_MINIMUM_CALLS', 10)),
+        'window': float(os.environ.get(f'{upstream.upper()}_BREAKER_WINDOW', 30)),
+        'open_seconds': float(os.environ.get(f'{upstream.upper()}_BREAKER_OPEN_SECONDS', 15)),
+        'half_open_calls': int(os.environ.get(f'{upstream.upper()}_BREAKER_HALF_OPEN_CALLS', 1)),
+    }
+    for upstream in ('plaid', 'stripe')
+}
+# While an upstream is down, invoice and accounts contexts up to this many seconds past their TTL are served
+# marked as stale
+STALE_CONTEXT_TTL = int(os.environ.get('STALE_CONTEXT_TTL', 60 * 60))
+
+# Per access token accounts cache of auth_app.views.AccountsMixin. Bank account data stays in process memory
+# unless ACCOUNTS_CACHE_BACKEND names a cache alias (keyed by access token digests there)
+ACCOUNTS_CACHE_TTL = int(os.environ.get('ACCOUNTS_CACHE_TTL', 30))
+ACCOUNTS_CACHE_MAX_SIZE = int(os.environ.get('ACCOUNTS_CACHE_MAX_SIZE', 1024))
+ACCOUNTS_CACHE_BACKEND = os.environ.get('ACCOUNTS_CACHE_BACKEND', '') or None
+
+# Timings and collectors of a worker process at /metrics/ (utils.instrumentation.MetricsView), answered with
+# Authorization: Bearer <METRICS_API_TOKEN> only, disabled without a token
+METRICS_API_TOKEN = os.environ.get('METRICS_API_TOKEN', '')
+
+# Batch invoice context API for back-office tools (stripe_app.views.InvoiceBatchView), disabled without a token
+INVOICE_BATCH_API_TOKEN = os.environ.get('INVOICE_BATCH_API_TOKEN', '')
+INVOICE_BATCH_CONCURRENCY = int(os.environ.get('INVOICE_BATCH_CONCURRENCY', 8))
+INVOICE_BATCH_MAX_IDS = int(os.environ.get('INVOICE_BATCH_MAX_IDS', 10000))
+INVOICE_BATCH_MAX_BODY_SIZE = int(os.environ.get('INVOICE_BATCH_MAX_BODY_SIZE', 1024 * 1024))
+
+# Webhook ingestion queue (see stripe_app.webhook_queue)
+STRIPE_WEBHOOK_SECRET = os.environ.get('STRIPE_WEBHOOK_SECRET', '')
+WEBHOOK_IN_PROCESS_WORKERS = int(os.environ.get('WEBHOOK_IN_PROCESS_WORKERS', 2))
+WEBHOOK_BATCH_SIZE = int(os.environ.get('WEBHOOK_BATCH_SIZE', 50))
+WEBHOOK_POLL_INTERVAL = float(os.environ.get('WEBHOOK_POLL_INTERVAL', 1))
+WEBHOOK_MAX_ATTEMPTS = int(os.environ.get('WEBHOOK_MAX_ATTEMPTS', 8))
+WEBHOOK_RETRY_BACKOFF = float(os.environ.get('WEBHOOK_RETRY_BACKOFF', 2))
+WEBHOOK_VISIBILITY_TIMEOUT = int(os.environ.get('WEBHOOK_VISIBILITY_TIMEOUT', 300))
+
+# Payments of AuthorizePaymentView (see stripe_app.payment_pipeline). The request running a payment holds a lease
+# of PAYMENT_LOCK_TIMEOUT seconds, renewed before every step and every PAYMENT_LOCK_RENEW_INTERVAL seconds while
+# a step waits on Stripe or Plaid, so the invoice of a worker that died is free again within PAYMENT_LOCK_TIMEOUT.
+# A worker that cannot renew for that long (database unreachable) may have its payment taken over while a call is
+# still running; the Stripe calls of both carry the same idempotency keys. A submission arriving while the same
+# payment runs waits up to PAYMENT_WAIT_TIMEOUT seconds for its result
+PAYMENT_LOCK_TIMEOUT = int(os.environ.get('PAYMENT_LOCK_TIMEOUT', 30))
+PAYMENT_LOCK_RENEW_INTERVAL = float(os.environ.get('PAYMENT_LOCK_RENEW_INTERVAL', 10))
+PAYMENT_WAIT_TIMEOUT = int(os.environ.get('PAYMENT_WAIT_TIMEOUT', 60))
+PAYMENT_LOCK_POLL_INTERVAL = float(os.environ.get('PAYMENT_LOCK_POLL_INTERVAL', 0.2))
+
+# JSON decoding of webhook and token request bodies (see utils.json_fast): auto picks the fastest installed
+# of simdjson (pysimdjson), orjson, ujson and json
+JSON_BACKEND = os.environ.get('JSON_BACKEND', 'auto')
+WEBHOOK_MAX_BODY_SIZE = int(os.environ.get('WEBHOOK_MAX_BODY_SIZE', 1024 * 1024))
+TOKEN_MAX_BODY_SIZE = int(os.environ.get('TOKEN_MAX_BODY_SIZE', 16 * 1024))
+
+# Upstream response size budgets in bytes (see utils.payload_budget), per upstream and per endpoint. A larger
+# response is logged as upstream.payload_over_budget; sizes and over-budget counts are in the metrics endpoint
+UPSTREAM_PAYLOAD_BUDGETS = {
+    'stripe': {
+        'budget': int(os.environ.get('STRIPE_PAYLOAD_BUDGET', 256 * 1024)),
+        'endpoints': {
+            'Invoice.retrieve': int(os.environ.get('STRIPE_INVOICE_PAYLOAD_BUDGET', 128 * 1024)),
+            'Invoice.list': int(os.environ.get('STRIPE_INVOICE_LIST_PAYLOAD_BUDGET', 1024 * 1024)),
+        },
+    },
+    'plaid': {
+        'budget': int(os.environ.get('PLAID_PAYLOAD_BUDGET', 256 * 1024)),
+        'endpoints': {
+            'Accounts.get': int(os.environ.get('PLAID_ACCOUNTS_PAYLOAD_BUDGET', 64 * 1024)),
+        },
+    },
+}
+
+# Opt-in memory profiling of the requests with tracemalloc (see utils.memory_profiling), read with the
+# memory_report command. Tracing slows down every allocation of the process, keep it off outside of sizing runs.
+# Every worker process publishes its profile to MEMORY_PROFILING_CACHE every MEMORY_PROFILING_FLUSH_INTERVAL
+# seconds; MEMORY_PROFILING_TOP allocation sites are kept per view
+MEMORY_PROFILING = os.environ.get('MEMORY_PROFILING', 'false').lower() == 'true'
+MEMORY_PROFILING_SAMPLE_RATE = float(os.environ.get('MEMORY_PROFILING_SAMPLE_RATE', 0.1))
+MEMORY_PROFILING_FRAMES = int(os.environ.get('MEMORY_PROFILING_FRAMES', 1))
+MEMORY_PROFILING_TOP = int(os.environ.get('MEMORY_PROFILING_TOP', 10))
+MEMORY_PROFILING_FLUSH_INTERVAL = float(os.environ.get('MEMORY_PROFILING_FLUSH_INTERVAL', 10))
+MEMORY_PROFILING_CACHE = os.environ.get('MEMORY_PROFILING_CACHE', 'shared')
+if MEMORY_PROFILING:
+    # right inside ServerTimingMiddleware, like the request spans the profile covers the rest of the chain
+    MIDDLEWARE.insert(MIDDLEWARE.index('utils.instrumentation.ServerTimingMiddleware') + 1,
+                      'utils.memory_profiling.MemoryProfilingMiddleware')
+
+# Lean mode of the token endpoints (see utils.lean_endpoints): views marked with lean_endpoint() in the urlconfs
+# only go through LEAN_ENDPOINT_MIDDLEWARE instead of the middleware listed after LeanEndpointMiddleware. The
+# process_view hooks of the middleware listed before it are not run for them either
+LEAN_ENDPOINTS = os.environ.get('LEAN_ENDPOINTS', 'true').lower() == 'true'
+LEAN_ENDPOINT_MIDDLEWARE = [
+    'django.middleware.security.SecurityMiddleware',
+    'django.contrib.sessions.middleware.SessionMiddleware',
+    'django.middleware.csrf.CsrfViewMiddleware',
+]
 
-STRIPE_BEARER = 'sk_test_51Ht9DqLCBQOzNn35iDlwc5NjBJD9GBFkOR1cSpzVudkaf9pZhNhrIXLw5nvAwpVnZH27bevN3jONg8zjLcjNvRdj00YDZxoedE'
\ No newline at end of file
+# Structured logging (see utils.structured_logging): JSON lines written to stderr by a background thread.
+# Events in LOG_SAMPLE_RATES are kept at that rate, LOG_QUEUE_SIZE records at most wait for the writer
+# and further ones are dropped.
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+LOG_SAMPLE_RATES = {
+    'request': float(os.environ.get('LOG_SAMPLE_REQUESTS', 0.1)),
+    'upstream.call': float(os.environ.get('LOG_SAMPLE_UPSTREAM_CALLS', 0.01)),
+    'upstream.rejected': float(os.environ.get('LOG_SAMPLE_UPSTREAM_REJECTED', 0.1)),
+}
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'json': {'()': 'utils.structured_logging.JsonFormatter'},
+    },
+    'filters': {
+        'sampling': {'()': 'utils.structured_logging.SamplingFilter'},
+    },
+    'handlers': {
+        'structured': {
+            'class': 'utils.structured_logging.BackgroundHandler',
+            'formatter': 'json',
+            'filters': ['sampling'],
+        },
+    },
+    'loggers': {
+        name: {'handlers': ['structured'], 'level': LOG_LEVEL, 'propagate': False}
+        for name in ('auth_app', 'stripe_app', 'utils')
+    },
+}
@@ -0,0 +1,31 @@
+"""
+Settings profile of payment-only workers: the checkout flow (auth_app, stripe_app) without admin, auth,
+messages and crispy_forms, so workers load fewer apps and middleware when they start.
+
+    DJANGO_SETTINGS_MODULE=iDjango.settings_payment gunicorn iDjango.wsgi
+"""
+from copy import deepcopy
+
+from iDjango.settings import *  # noqa: F401,F403
+from iDjango.settings import MIDDLEWARE, TEMPLATES
+
+INSTALLED_APPS = [
+    'auth_app.apps.AuthAppConfig',
+    'stripe_app.apps.StripeAppConfig',
+]
+
+MIDDLEWARE = [
+    middleware for middleware in MIDDLEWARE
+    if middleware not in (
+        'django.contrib.auth.middleware.AuthenticationMiddleware',
+        'django.contrib.messages.middleware.MessageMiddleware',
+    )
+]
+
+TEMPLATES = deepcopy(TEMPLATES)
+TEMPLATES[0]['OPTIONS']['context_processors'] = [
+    'django.template.context_processors.debug',
+    'django.template.context_processors.request',
+]
+
+AUTH_PASSWORD_VALIDATORS = []
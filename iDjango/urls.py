@@ -13,11 +13,17 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
-from django.contrib import admin
+from django.apps import apps
 from django.urls import path, include
+from utils.instrumentation import MetricsView
 
 urlpatterns = [
-    path('admin/', admin.site.urls),
     path('auth/', include('auth_app.urls', namespace="auth_app")),
     path('payment/', include('stripe_app.urls', namespace="stripe_app")),
+    path('metrics/', MetricsView.as_view(), name='metrics'),
 ]
+
+# payment-only workers (iDjango.settings_payment) run without the admin
+if apps.is_installed('django.contrib.admin'):
+    from django.contrib import admin
+    urlpatterns.append(path('admin/', admin.site.urls))
@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'iDjango.settings')
 
 application = get_wsgi_application()
+
+# only processes serving requests fill the link token pool
+from auth_app.views import start_link_token_pool  # noqa: E402
+
+start_link_token_pool()
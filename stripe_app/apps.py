@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class StripeAppConfig(AppConfig):
     name = 'stripe_app'
+
+    def ready(self):
+        from utils.common_functions import preload_templates
+        preload_templates(self)
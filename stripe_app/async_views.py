@@ -0,0 +1,49 @@
+from functools import partial
+from utils.concurrency import AsyncView, async_gather_upstream, run_upstream, session_get, session_set
+from utils.instrumentation import render
+from .views import get_info_from_request, InvoiceView, ProofPaymentView, AuthorizePaymentView
+
+
+class AsyncInvoiceView(AsyncView, InvoiceView):
+    """ InvoiceView for ASGI workers, Stripe is called from the upstream thread pool """
+
+    async def get(self, request, *args, **kwargs):
+        invoice_id = kwargs.get("id")
+        await session_set(request, invoice_id=invoice_id)
+        context = await run_upstream(self.create_context_from_invoice, invoice_id=invoice_id)
+        if 'error' in context:
+            return render(request, 'stripe_app/error.html')
+        return render(request, 'stripe_app/invoice_detail.html', context)
+
+
+class AsyncProofPaymentView(AsyncView, ProofPaymentView):
+    """ ProofPaymentView for ASGI workers, Stripe and Plaid are called from the upstream thread pool """
+
+    @get_info_from_request
+    async def post(self, request):
+        selected_account_id = request.POST.get('account')
+        access_token, invoice_id = await session_get(request, 'access_token', 'invoice_id')
+        await session_set(request, account_id=selected_account_id)
+        results = await async_gather_upstream({
+            'invoice': partial(self.create_context_from_invoice, invoice_id=invoice_id),
+            'accounts': partial(self.get_accounts, access_token=access_token, account_id=selected_account_id),
+        })
+        invoice, accounts = results['invoice'], results['accounts']
+        if 'error' in invoice or 'error' in accounts:
+            return render(request, 'stripe_app/error.html')
+        context = {**invoice, **accounts}
+        return render(request, 'stripe_app/proof_payment.html', context)
+
+
+class AsyncAuthorizePaymentView(AsyncView, AuthorizePaymentView):
+    """ AuthorizePaymentView for ASGI workers, Stripe and Plaid are called from the upstream thread pool """
+
+    @get_info_from_request
+    async def get(self, request):
+        access_token, invoice_id, account_id = await session_get(request, 'access_token', 'invoice_id', 'account_id')
+        payment = await run_upstream(
+            self.authorize_payment, access_token=access_token, invoice_id=invoice_id, account_id=account_id
+        )
+        if 'error' in payment:
+            return render(request, 'stripe_app/error.html')
+        return render(request, 'stripe_app/result_payment.html', payment)
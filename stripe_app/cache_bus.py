@@ -0,0 +1,112 @@
+import logging
+import os
+import socket
+import threading
+from datetime import timedelta
+
+from django.db import close_old_connections, DatabaseError
+from django.db.models import Max
+from django.utils import timezone
+from iDjango.settings import CACHE_INVALIDATION_POLL_INTERVAL, CACHE_INVALIDATION_RETENTION
+from utils.cache import drop_local, on_first_store
+from utils.instrumentation import register_collector
+from .models import CacheInvalidation
+
+logger = logging.getLogger(__name__)
+
+# namespace -> callbacks(key) run by the listener after another process changed the key
+_callbacks = {}
+
+
+def origin() -> str:
+    # taken on every call, worker processes forked from a preloaded master share the module state
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def on_invalidation(namespace: str, callback) -> None:
+    _callbacks.setdefault(namespace, []).append(callback)
+
+
+def broadcast(cache, key: str) -> None:
+    """ The other worker processes drop key from the in-process tier of cache, this one has updated it already """
+    CacheInvalidation.objects.create(namespace=cache.namespace, key=key, origin=origin())
+
+
+class InvalidationListener:
+    """ Thread applying the invalidations other processes wrote since it started, every poll_interval seconds """
+
+    def __init__(self, poll_interval: float = CACHE_INVALIDATION_POLL_INTERVAL,
+                 retention: int = CACHE_INVALIDATION_RETENTION):
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self._last_id = 0
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self.applied = 0
+        self.polls = 0
+        self.errors = 0
+
+    def start(self) -> None:
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            try:
+                # older invalidations predate every entry this process can hold
+                self._last_id = CacheInvalidation.objects.aggregate(last_id=Max('id'))['last_id'] or 0
+            except DatabaseError:
+                # not migrated yet, the listener reads the table from its start
+                logger.warning('cache_bus.start_failed', exc_info=True)
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self.run, name='cache-invalidations', daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def poll(self) -> int:
+        me = origin()
+        rows = CacheInvalidation.objects.filter(id__gt=self._last_id).order_by('id').values_list(
+            'id', 'namespace', 'key', 'origin'
+        )
+        applied = 0
+        for row_id, namespace, key, row_origin in rows:
+            self._last_id = row_id
+            if row_origin == me:
+                continue
+            drop_local(namespace, key)
+            for callback in _callbacks.get(namespace, ()):
+                callback(key)
+            applied += 1
+        self.applied += applied
+        self.polls += 1
+        return applied
+
+    def prune(self) -> None:
+        CacheInvalidation.objects.filter(created_at__lt=timezone.now() - timedelta(seconds=self.retention)).delete()
+
+    def run(self) -> None:
+        # about one prune per retention / 10 per process
+        prune_every = max(1, int(self.retention / 10 / self.poll_interval))
+        while not self._stopped.wait(self.poll_interval):
+            close_old_connections()
+            try:
+                self.poll()
+                if self.polls % prune_every == 0:
+                    self.prune()
+            except Exception:
+                logger.exception('cache_bus.poll_failed')
+                self.errors += 1
+        close_old_connections()
+
+    def stats(self) -> dict:
+        return {'last_id': self._last_id, 'applied': self.applied, 'polls': self.polls, 'errors': self.errors}
+
+
+listener = InvalidationListener()
+register_collector('cache_invalidations', listener.stats)
+# Started by the first entry a process keeps in memory rather than when the app loads: a thread started in a
+# preloading master (gunicorn --preload) does not survive the fork into the workers
+on_first_store(listener.start)
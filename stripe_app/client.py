@@ -0,0 +1,16 @@
+import stripe
+from iDjango.settings import STRIPE_BEARER, STRIPE_API_BASE
+from utils.transport import build_stripe_http_client
+from utils.upstream import LazyUpstreamProxy
+
+
+def configure_stripe():
+    stripe.api_key = STRIPE_BEARER
+    stripe.api_base = STRIPE_API_BASE
+    stripe.default_http_client = build_stripe_http_client()
+    return stripe
+
+
+# Stripe API calls go through this proxy, so they are timed like every other upstream call. The key and the
+# pooled HTTP client are set by the first call, not when the views are imported
+stripe_api = LazyUpstreamProxy(configure_stripe, upstream='stripe')
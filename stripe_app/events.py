@@ -0,0 +1,80 @@
+import asyncio
+
+from django.urls import resolve, Resolver404
+from iDjango.settings import EVENT_STREAM_HEARTBEAT, EVENT_STREAM_RETRY_MS
+from utils.concurrency import run_upstream
+from utils.pubsub import broker, TooManySubscribers
+from .views import invoice_cache, invoice_event, invoice_topic
+
+EVENT_STREAM_VIEW = 'stripe_app:invoice_events'
+HEADERS = [
+    (b'content-type', b'text/event-stream'),
+    (b'cache-control', b'no-cache'),
+    # nginx would buffer the stream otherwise
+    (b'x-accel-buffering', b'no'),
+]
+KEEP_ALIVE = b': keep-alive\n\n'
+
+
+class InvoiceEventsApp:
+    """
+    ASGI application serving GET /payment/invoice/<id>/events/ as Server-Sent Events: the cached state of the
+    invoice on connect, then every state InsertLinkView publishes for it. Other requests go to `application`.
+    """
+
+    def __init__(self, application):
+        self.application = application
+
+    async def __call__(self, scope, receive, send):
+        invoice_id = self.invoice_id(scope)
+        if invoice_id is None:
+            return await self.application(scope, receive, send)
+        try:
+            with broker.subscribe(invoice_topic(invoice_id)) as subscription:
+                await self.stream(invoice_id, subscription, receive, send)
+        except TooManySubscribers:
+            await send({'type': 'http.response.start', 'status': 503, 'headers': [(b'retry-after', b'30')]})
+            await send({'type': 'http.response.body', 'body': b''})
+
+    @staticmethod
+    def invoice_id(scope):
+        if scope['type'] != 'http' or scope['method'] != 'GET':
+            return None
+        path = scope['path'][len(scope.get('root_path', '')):] or '/'
+        try:
+            match = resolve(path)
+        except Resolver404:
+            return None
+        return match.kwargs.get('id') if match.view_name == EVENT_STREAM_VIEW else None
+
+    @staticmethod
+    async def wait_for_disconnect(receive) -> None:
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    async def stream(self, invoice_id: str, subscription, receive, send) -> None:
+        await send({'type': 'http.response.start', 'status': 200, 'headers': HEADERS})
+        opening = f'retry: {EVENT_STREAM_RETRY_MS}\n\n'.encode()
+        # the subscription is taken before the cache is read, so no state published in between is lost
+        context = await run_upstream(invoice_cache.get, invoice_id)
+        if context is not None:
+            opening += invoice_event(context)
+        await send({'type': 'http.response.body', 'body': opening, 'more_body': True})
+        disconnected = asyncio.ensure_future(self.wait_for_disconnect(receive))
+        try:
+            while True:
+                message = asyncio.ensure_future(subscription.get())
+                done, _ = await asyncio.wait(
+                    {message, disconnected}, timeout=EVENT_STREAM_HEARTBEAT, return_when=asyncio.FIRST_COMPLETED
+                )
+                if message not in done:
+                    message.cancel()
+                if disconnected in done:
+                    return
+                await send({
+                    'type': 'http.response.body',
+                    'body': message.result() if message in done else KEEP_ALIVE,
+                    'more_body': True,
+                })
+        finally:
+            disconnected.cancel()
@@ -0,0 +1,52 @@
+import time
+from django.core.management.base import BaseCommand
+from stripe_app import snapshots
+from stripe_app.client import stripe_api
+from stripe_app.views import InvoiceMixin
+from utils.rate_limit import lane, BACKGROUND
+
+
+def pages(list_page, **params):
+    """ Pages of a Stripe list endpoint, followed with starting_after """
+    while True:
+        page = list_page(**params)
+        yield page.data
+        if not page.has_more or not page.data:
+            return
+        params['starting_after'] = page.data[-1].id
+
+
+class Command(BaseCommand):
+    help = 'Copies invoices and customers from Stripe into the snapshot tables (stripe_app.snapshots)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--created-gte', type=int, help='only invoices created at or after this unix time')
+        parser.add_argument('--status', help='only invoices with this status (draft, open, paid, ...)')
+        parser.add_argument('--page-size', type=int, default=100)
+        parser.add_argument('--skip-customers', action='store_true')
+
+    def handle(self, *args, **options):
+        filters = {'limit': options['page_size']}
+        if options['created_gte'] is not None:
+            filters['created'] = {'gte': options['created_gte']}
+        if options['status']:
+            filters['status'] = options['status']
+        mixin = InvoiceMixin()
+        # checkout calls made by the web workers of this process (if any) go first
+        with lane(BACKGROUND):
+            invoices = 0
+            for page in pages(stripe_api.Invoice.list, **filters):
+                state_time = int(time.time())
+                complete, incomplete = [], []
+                for invoice in page:
+                    has_more = (invoice.get('lines') or {}).get('has_more')
+                    (incomplete if has_more else complete).append(mixin.project_invoice(invoice))
+                invoices += len(snapshots.save_invoices(complete, state_time=state_time))
+                invoices += len(snapshots.save_invoices(incomplete, state_time=state_time, lines_complete=False))
+            self.stdout.write(f'{invoices} invoice snapshots saved')
+            if options['skip_customers']:
+                return
+            customers = 0
+            for page in pages(stripe_api.Customer.list, limit=options['page_size']):
+                customers += len(snapshots.save_customers(page, state_time=int(time.time())))
+            self.stdout.write(f'{customers} customer snapshots saved')
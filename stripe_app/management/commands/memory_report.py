@@ -0,0 +1,64 @@
+import json
+from django.core.management.base import BaseCommand
+from utils.memory_profiling import clear_profiles, collect_profiles
+
+SORT_KEYS = ('peak_max', 'peak_mean', 'retained_max', 'retained_mean', 'count')
+
+
+def merge_views(profiles: dict) -> dict:
+    """ Per view profiles of all the processes added up """
+    views = {}
+    for profile in profiles.values():
+        for name, view in profile['views'].items():
+            merged = views.setdefault(name, {
+                'count': 0, 'peak_total': 0, 'peak_max': 0, 'retained_total': 0, 'retained_max': 0, 'sites': {},
+            })
+            for key in ('count', 'peak_total', 'retained_total'):
+                merged[key] += view[key]
+            for key in ('peak_max', 'retained_max'):
+                merged[key] = max(merged[key], view[key])
+            for site, size in view['sites'].items():
+                merged['sites'][site] = max(merged['sites'].get(site, 0), size)
+    for view in views.values():
+        view['peak_mean'] = view['peak_total'] // view['count'] if view['count'] else 0
+        view['retained_mean'] = view['retained_total'] // view['count'] if view['count'] else 0
+    return views
+
+
+def kib(size: int) -> str:
+    return f'{size / 1024:.1f}'
+
+
+class Command(BaseCommand):
+    help = 'Memory per view profiled by the worker processes running with MEMORY_PROFILING=true'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sort', choices=SORT_KEYS, default='peak_max')
+        parser.add_argument('--sites', type=int, default=3, help='allocation sites shown per view')
+        parser.add_argument('--json', action='store_true', help='print the merged profiles as JSON')
+        parser.add_argument('--reset', action='store_true', help='delete the published profiles')
+
+    def handle(self, *args, **options):
+        if options['reset']:
+            clear_profiles()
+            self.stdout.write('memory profiles deleted')
+            return
+        profiles = collect_profiles()
+        views = merge_views(profiles)
+        if options['json']:
+            self.stdout.write(json.dumps({'processes': profiles, 'views': views}, indent=2))
+            return
+        if not views:
+            self.stdout.write('no memory profiles published, run the workers with MEMORY_PROFILING=true')
+            return
+        self.stdout.write(f'{len(profiles)} processes, KiB per request')
+        self.stdout.write(f'{"view":<40} {"count":>7} {"peak max":>10} {"peak mean":>10} '
+                          f'{"kept max":>10} {"kept mean":>10}')
+        for name, view in sorted(views.items(), key=lambda item: -item[1][options['sort']]):
+            self.stdout.write(
+                f'{name:<40} {view["count"]:>7} {kib(view["peak_max"]):>10} {kib(view["peak_mean"]):>10} '
+                f'{kib(view["retained_max"]):>10} {kib(view["retained_mean"]):>10}'
+            )
+            sites = sorted(view['sites'].items(), key=lambda item: -item[1])[:options['sites']]
+            for site, size in sites:
+                self.stdout.write(f'    {kib(size):>10}  {site}')
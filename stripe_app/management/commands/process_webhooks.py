@@ -0,0 +1,34 @@
+import time
+from django.core.management.base import BaseCommand
+from iDjango.settings import WEBHOOK_BATCH_SIZE, WEBHOOK_POLL_INTERVAL
+from stripe_app.webhook_queue import WebhookWorkerPool
+
+
+class Command(BaseCommand):
+    help = 'Applies queued Stripe webhook events (run with WEBHOOK_IN_PROCESS_WORKERS=0 on the web workers)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--batch-size', type=int, default=WEBHOOK_BATCH_SIZE)
+        parser.add_argument('--poll-interval', type=float, default=WEBHOOK_POLL_INTERVAL)
+        parser.add_argument('--once', action='store_true', help='drain the due events and exit')
+
+    def handle(self, *args, **options):
+        pool = WebhookWorkerPool(
+            workers=options['workers'], batch_size=options['batch_size'], poll_interval=options['poll_interval']
+        )
+        if options['once']:
+            processed = 0
+            while True:
+                batch = pool.run_once()
+                if not batch:
+                    break
+                processed += batch
+            self.stdout.write(f'{processed} webhook events processed')
+            return
+        pool.start()
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pool.stop()
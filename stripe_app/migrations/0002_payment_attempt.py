@@ -0,0 +1,33 @@
+# Generated by Django 3.1.3 on 2026-10-18 09:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stripe_app', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PaymentAttempt',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('idempotency_key', models.CharField(max_length=64, unique=True)),
+                ('invoice_id', models.CharField(max_length=255)),
+                ('account_id', models.CharField(max_length=255)),
+                ('step', models.CharField(choices=[('started', 'started'), ('bank_account_token_created', 'bank account token created'), ('source_attached', 'source attached'), ('paid', 'paid'), ('failed', 'failed')], default='started', max_length=32)),
+                ('bank_account_token', models.CharField(blank=True, max_length=255)),
+                ('customer_id', models.CharField(blank=True, max_length=255)),
+                ('source_id', models.CharField(blank=True, max_length=255)),
+                ('result', models.TextField(blank=True)),
+                ('last_error', models.TextField(blank=True)),
+                ('runs', models.PositiveSmallIntegerField(default=0)),
+                ('lock', models.CharField(blank=True, max_length=32)),
+                ('locked_until', models.DateTimeField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
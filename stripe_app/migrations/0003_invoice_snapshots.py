@@ -0,0 +1,59 @@
+# Generated by Django 3.1.3 on 2026-10-18 10:04
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stripe_app', '0002_payment_attempt'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CustomerSnapshot',
+            fields=[
+                ('customer_id', models.CharField(max_length=255, primary_key=True, serialize=False)),
+                ('name', models.CharField(blank=True, max_length=255, null=True)),
+                ('email', models.CharField(blank=True, max_length=255, null=True)),
+                ('default_source', models.CharField(blank=True, max_length=255, null=True)),
+                ('state_time', models.BigIntegerField(default=0)),
+                ('synced_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='InvoiceSnapshot',
+            fields=[
+                ('invoice_id', models.CharField(max_length=255, primary_key=True, serialize=False)),
+                ('customer', models.CharField(blank=True, db_index=True, max_length=255, null=True)),
+                ('customer_name', models.CharField(blank=True, max_length=255, null=True)),
+                ('status', models.CharField(blank=True, max_length=32, null=True)),
+                ('number', models.CharField(blank=True, max_length=255, null=True)),
+                ('subtotal', models.BigIntegerField(null=True)),
+                ('total', models.BigIntegerField(null=True)),
+                ('invoice_pdf', models.TextField(blank=True, null=True)),
+                ('period_end', models.BigIntegerField(null=True)),
+                ('created', models.BigIntegerField(null=True)),
+                ('paid', models.BooleanField(null=True)),
+                ('lines_complete', models.BooleanField(default=True)),
+                ('state_time', models.BigIntegerField(default=0)),
+                ('synced_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='InvoiceLineSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position', models.PositiveIntegerField()),
+                ('quantity', models.BigIntegerField(null=True)),
+                ('description', models.TextField(blank=True, null=True)),
+                ('unit_amount', models.BigIntegerField(null=True)),
+                ('invoice', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='lines', to='stripe_app.invoicesnapshot')),
+            ],
+            options={
+                'ordering': ['invoice', 'position'],
+                'unique_together': {('invoice', 'position')},
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.1.3 on 2026-10-18 10:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stripe_app', '0004_cache_invalidation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='paymentattempt',
+            name='generation',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+    ]
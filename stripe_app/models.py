@@ -1,3 +1,146 @@
 from django.db import models
+from django.utils import timezone
 
-# Create your models here.
+
+class WebhookEvent(models.Model):
+    """ Stripe webhook event persisted by InsertLinkView and applied later by the webhook workers """
+    PENDING = 'pending'
+    PROCESSING = 'processing'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUSES = (
+        (PENDING, 'pending'),
+        (PROCESSING, 'processing'),
+        (DONE, 'done'),
+        (FAILED, 'failed'),
+    )
+
+    event_id = models.CharField(max_length=255, unique=True)
+    type = models.CharField(max_length=255)
+    object_id = models.CharField(max_length=255, blank=True)
+    host_url = models.CharField(max_length=255, blank=True)
+    payload = models.TextField()
+    status = models.CharField(max_length=16, choices=STATUSES, default=PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    claim = models.CharField(max_length=32, blank=True)
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'next_attempt_at'])]
+
+    def __str__(self):
+        return f'{self.event_id} ({self.type}, {self.status})'
+
+
+class PaymentAttempt(models.Model):
+    """
+    Payment of an invoice from a bank account, run step by step by stripe_app.payment_pipeline.
+    Each completed step is saved, so a retried payment carries on from where the previous try stopped. A failed
+    payment submitted again starts over as the next generation, with Stripe idempotency keys of its own.
+    """
+    STARTED = 'started'
+    BANK_ACCOUNT_TOKEN_CREATED = 'bank_account_token_created'
+    SOURCE_ATTACHED = 'source_attached'
+    PAID = 'paid'
+    FAILED = 'failed'
+    STEPS = (
+        (STARTED, 'started'),
+        (BANK_ACCOUNT_TOKEN_CREATED, 'bank account token created'),
+        (SOURCE_ATTACHED, 'source attached'),
+        (PAID, 'paid'),
+        (FAILED, 'failed'),
+    )
+    FINISHED = (PAID, FAILED)
+
+    idempotency_key = models.CharField(max_length=64, unique=True)
+    invoice_id = models.CharField(max_length=255)
+    account_id = models.CharField(max_length=255)
+    step = models.CharField(max_length=32, choices=STEPS, default=STARTED)
+    bank_account_token = models.CharField(max_length=255, blank=True)
+    customer_id = models.CharField(max_length=255, blank=True)
+    source_id = models.CharField(max_length=255, blank=True)
+    result = models.TextField(blank=True)
+    last_error = models.TextField(blank=True)
+    runs = models.PositiveSmallIntegerField(default=0)
+    generation = models.PositiveSmallIntegerField(default=0)
+    lock = models.CharField(max_length=32, blank=True)
+    locked_until = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    @property
+    def finished(self) -> bool:
+        return self.step in self.FINISHED
+
+    def __str__(self):
+        return f'{self.invoice_id} from {self.account_id} ({self.step})'
+
+
+class CustomerSnapshot(models.Model):
+    """ Customer as of the last customer.* webhook (or backfill), with its default payment source """
+    customer_id = models.CharField(max_length=255, primary_key=True)
+    name = models.CharField(max_length=255, null=True, blank=True)
+    email = models.CharField(max_length=255, null=True, blank=True)
+    default_source = models.CharField(max_length=255, null=True, blank=True)
+    # unix time of the Stripe state (event created or read time), older states never replace newer ones
+    state_time = models.BigIntegerField(default=0)
+    synced_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'{self.customer_id} ({self.default_source})'
+
+
+class InvoiceSnapshot(models.Model):
+    """
+    Invoice header as projected by stripe_app.views.InvoiceMixin, kept by invoice.* webhooks, reads from Stripe
+    and the backfill_snapshots command. Pages are rendered from it when its lines are complete.
+    """
+    invoice_id = models.CharField(max_length=255, primary_key=True)
+    customer = models.CharField(max_length=255, null=True, blank=True, db_index=True)
+    customer_name = models.CharField(max_length=255, null=True, blank=True)
+    status = models.CharField(max_length=32, null=True, blank=True)
+    number = models.CharField(max_length=255, null=True, blank=True)
+    subtotal = models.BigIntegerField(null=True)
+    total = models.BigIntegerField(null=True)
+    invoice_pdf = models.TextField(null=True, blank=True)
+    period_end = models.BigIntegerField(null=True)
+    created = models.BigIntegerField(null=True)
+    paid = models.BooleanField(null=True)
+    # False when the webhook payload cut the line items off, the invoice is then read from Stripe
+    lines_complete = models.BooleanField(default=True)
+    state_time = models.BigIntegerField(default=0)
+    synced_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'{self.invoice_id} ({self.status})'
+
+
+class InvoiceLineSnapshot(models.Model):
+    """ Line item of an InvoiceSnapshot, in invoice order """
+    invoice = models.ForeignKey(InvoiceSnapshot, on_delete=models.CASCADE, related_name='lines')
+    position = models.PositiveIntegerField()
+    quantity = models.BigIntegerField(null=True)
+    description = models.TextField(null=True, blank=True)
+    unit_amount = models.BigIntegerField(null=True)
+
+    class Meta:
+        ordering = ['invoice', 'position']
+        unique_together = [('invoice', 'position')]
+
+    def __str__(self):
+        return f'{self.invoice_id} #{self.position}'
+
+
+class CacheInvalidation(models.Model):
+    """ Key of a two-tier cache changed by one worker process, the others drop it from their in-process tier """
+    namespace = models.CharField(max_length=64)
+    key = models.CharField(max_length=255)
+    # host:pid of the process that wrote it, it skips its own invalidations
+    origin = models.CharField(max_length=128)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __str__(self):
+        return f'{self.namespace}:{self.key} from {self.origin}'
@@ -0,0 +1,215 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import timedelta
+
+import stripe
+from django.db import close_old_connections
+from django.db.models import F, Q
+from django.utils import timezone
+from iDjango.settings import PAYMENT_LOCK_TIMEOUT, PAYMENT_WAIT_TIMEOUT, PAYMENT_LOCK_POLL_INTERVAL, \
+    PAYMENT_LOCK_RENEW_INTERVAL
+from . import snapshots
+from .client import stripe_api
+from .models import PaymentAttempt
+
+logger = logging.getLogger(__name__)
+
+# Stripe keeps these answers under the idempotency key and replays them on every retry, so the attempt fails; a
+# new submission starts the next generation with new keys (e.g. once the customer fixed the bank account)
+TERMINAL_ERRORS = (stripe.error.CardError, stripe.error.InvalidRequestError)
+
+
+class LeaseLost(Exception):
+    """ The lock of the attempt ran out and another request took it over """
+
+
+def idempotency_key(invoice_id: str, account_id: str) -> str:
+    return hashlib.sha256(f'{invoice_id}:{account_id}'.encode()).hexdigest()
+
+
+def stripe_key(attempt: PaymentAttempt, call: str) -> str:
+    """ Idempotency key of a Stripe call of the attempt, generation 0 keeps the keys of the first attempts """
+    if attempt.generation:
+        return f'{attempt.idempotency_key}:{attempt.generation}:{call}'
+    return f'{attempt.idempotency_key}:{call}'
+
+
+def acquire(attempt: PaymentAttempt):
+    """ Lock token if this request may run the attempt, None while another request runs it """
+    now = timezone.now()
+    lock = uuid.uuid4().hex
+    acquired = PaymentAttempt.objects.filter(
+        Q(locked_until__isnull=True) | Q(locked_until__lt=now), pk=attempt.pk,
+    ).update(lock=lock, locked_until=now + timedelta(seconds=PAYMENT_LOCK_TIMEOUT), runs=F('runs') + 1)
+    return lock if acquired else None
+
+
+def renew(attempt: PaymentAttempt, lock: str) -> None:
+    """ Extends the lock by PAYMENT_LOCK_TIMEOUT before the next step, raises LeaseLost if it is not held anymore """
+    renewed = PaymentAttempt.objects.filter(pk=attempt.pk, lock=lock).update(
+        locked_until=timezone.now() + timedelta(seconds=PAYMENT_LOCK_TIMEOUT),
+    )
+    if not renewed:
+        raise LeaseLost()
+
+
+@contextmanager
+def heartbeat(attempt: PaymentAttempt, lock: str, interval: float = PAYMENT_LOCK_RENEW_INTERVAL):
+    """ Renews the lock every `interval` seconds while the block runs, a step may take longer than the lease """
+    stopped = threading.Event()
+
+    def beat():
+        try:
+            while not stopped.wait(interval):
+                try:
+                    renew(attempt, lock)
+                except LeaseLost:
+                    # the request finds out when it renews before its next step
+                    return
+                except Exception:
+                    logger.warning('payment.renew_failed', exc_info=True, extra={'invoice_id': attempt.invoice_id})
+        finally:
+            close_old_connections()
+
+    thread = threading.Thread(target=beat, name='payment-heartbeat', daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stopped.set()
+        thread.join()
+
+
+def release(attempt: PaymentAttempt, lock: str) -> None:
+    PaymentAttempt.objects.filter(pk=attempt.pk, lock=lock).update(lock='', locked_until=None)
+
+
+def outcome(attempt: PaymentAttempt) -> dict:
+    if attempt.step == PaymentAttempt.PAID:
+        return json.loads(attempt.result)
+    return {'error': attempt.last_error or 'payment is not finished'}
+
+
+def wait_for_outcome(attempt: PaymentAttempt) -> dict:
+    """ Result of an attempt that another request (e.g. a double click) is running """
+    deadline = time.monotonic() + PAYMENT_WAIT_TIMEOUT
+    while time.monotonic() < deadline:
+        time.sleep(PAYMENT_LOCK_POLL_INTERVAL)
+        attempt.refresh_from_db()
+        if attempt.finished or not attempt.lock:
+            return outcome(attempt)
+    return {'error': 'payment is already in progress'}
+
+
+def save_step(attempt: PaymentAttempt, step: str, **fields) -> None:
+    for name, value in fields.items():
+        setattr(attempt, name, value)
+    attempt.step = step
+    attempt.last_error = ''
+    attempt.save(update_fields=['step', 'last_error', 'updated_at', *fields])
+
+
+def restart(attempt: PaymentAttempt) -> None:
+    """ Failed attempt back to its first step as the next generation """
+    attempt.generation += 1
+    attempt.step = PaymentAttempt.STARTED
+    attempt.bank_account_token = attempt.customer_id = attempt.source_id = attempt.result = ''
+    attempt.last_error = ''
+    attempt.save(update_fields=[
+        'generation', 'step', 'bank_account_token', 'customer_id', 'source_id', 'result', 'last_error', 'updated_at',
+    ])
+
+
+def save_error(attempt: PaymentAttempt, error, terminal: bool = False) -> dict:
+    attempt.last_error = str(error)
+    fields = ['last_error', 'updated_at']
+    if terminal:
+        attempt.step = PaymentAttempt.FAILED
+        fields.append('step')
+    attempt.save(update_fields=fields)
+    return {'error': error}
+
+
+class PaymentPipelineMixin:
+    """
+    Bank account token -> customer source -> invoice payment, saved in PaymentAttempt after every step.
+    Stripe calls carry idempotency keys derived from invoice and account, a repeated submission of a paid invoice
+    is answered from the database and one of a failed payment starts it over. Needs InvoiceMixin and AccountsMixin.
+    """
+
+    def run_payment(self, access_token: str, invoice_id: str, account_id: str) -> dict:
+        key = idempotency_key(invoice_id, account_id)
+        attempt, _ = PaymentAttempt.objects.get_or_create(
+            idempotency_key=key, defaults={'invoice_id': invoice_id, 'account_id': account_id},
+        )
+        if attempt.step == PaymentAttempt.PAID:
+            return outcome(attempt)
+        lock = acquire(attempt)
+        if lock is None:
+            return wait_for_outcome(attempt)
+        try:
+            attempt.refresh_from_db()
+            if attempt.step == PaymentAttempt.PAID:
+                return outcome(attempt)
+            if attempt.step == PaymentAttempt.FAILED:
+                restart(attempt)
+            with heartbeat(attempt, lock):
+                return self.resume_payment(attempt, access_token, lock)
+        finally:
+            release(attempt, lock)
+
+    def resume_payment(self, attempt: PaymentAttempt, access_token: str, lock: str) -> dict:
+        """ Runs the steps that are not done yet, renewing the lock before each """
+        try:
+            if attempt.step == PaymentAttempt.STARTED:
+                renew(attempt, lock)
+                bank_account_token = self.create_bank_account_token(
+                    access_token=access_token, account_id=attempt.account_id
+                )
+                if 'error' in bank_account_token:
+                    return save_error(attempt, bank_account_token['error'])
+                save_step(attempt, PaymentAttempt.BANK_ACCOUNT_TOKEN_CREATED,
+                          bank_account_token=bank_account_token.get('stripe_bank_account_token'))
+
+            if attempt.step == PaymentAttempt.BANK_ACCOUNT_TOKEN_CREATED:
+                renew(attempt, lock)
+                # the customer comes from Stripe itself, not from invoice_cache or snapshots that webhooks write
+                invoice = self.get_invoice(attempt.invoice_id)
+                customer = stripe_api.Customer.modify(
+                    invoice.get('customer'),
+                    source=attempt.bank_account_token,
+                    idempotency_key=stripe_key(attempt, 'source'),
+                )
+                save_step(attempt, PaymentAttempt.SOURCE_ATTACHED,
+                          customer_id=customer.get('id'), source_id=customer.get('default_source'))
+                try:
+                    snapshots.save_customers([customer], state_time=int(time.time()))
+                except Exception:
+                    # the snapshot is caught up by the customer.updated webhook
+                    logger.warning('snapshot.customer_failed', exc_info=True, extra={'customer': customer.get('id')})
+
+            if attempt.step == PaymentAttempt.SOURCE_ATTACHED:
+                renew(attempt, lock)
+                payment = stripe_api.Invoice.pay(
+                    attempt.invoice_id, source=attempt.source_id, idempotency_key=stripe_key(attempt, 'pay')
+                )
+                result = {'id': payment.get('id'), 'status': payment.get('status'), 'paid': payment.get('paid')}
+                save_step(attempt, PaymentAttempt.PAID, result=json.dumps(result))
+            return outcome(attempt)
+        except LeaseLost:
+            # the request holding the lock now carries on with the same idempotency keys
+            logger.warning('payment.lease_lost', extra={'invoice_id': attempt.invoice_id, 'step': attempt.step})
+            return {'error': 'payment is already in progress'}
+        except TERMINAL_ERRORS as e:
+            logger.warning('payment.failed', extra={
+                'invoice_id': attempt.invoice_id, 'step': attempt.step, 'error_class': type(e).__name__,
+            })
+            return save_error(attempt, e, terminal=True)
+        except Exception as e:
+            logger.exception('payment.step_failed', extra={'invoice_id': attempt.invoice_id, 'step': attempt.step})
+            return save_error(attempt, e)
@@ -0,0 +1,101 @@
+from django.db import transaction
+from django.utils import timezone
+from .models import CustomerSnapshot, InvoiceSnapshot, InvoiceLineSnapshot
+
+# Fields of the invoice contexts (stripe_app.views.InvoiceMixin) kept on InvoiceSnapshot, 'id' is its primary key
+INVOICE_COLUMNS = (
+    'customer', 'customer_name', 'status', 'number', 'subtotal', 'total', 'invoice_pdf', 'period_end', 'created',
+    'paid',
+)
+LINE_COLUMNS = ('quantity', 'description', 'unit_amount')
+CUSTOMER_COLUMNS = ('name', 'email', 'default_source')
+
+
+def load_invoice(invoice_id: str):
+    """ Invoice context (without state_version) of a snapshot with complete lines, None otherwise """
+    snapshot = InvoiceSnapshot.objects.filter(invoice_id=invoice_id, lines_complete=True).first()
+    if snapshot is None:
+        return None
+    lines = InvoiceLineSnapshot.objects.filter(invoice_id=invoice_id).values_list(*LINE_COLUMNS)
+    return {
+        'id': snapshot.invoice_id,
+        **{column: getattr(snapshot, column) for column in INVOICE_COLUMNS},
+        'products': [dict(zip(LINE_COLUMNS, line)) for line in lines],
+    }
+
+
+def save_invoices(contexts: list, state_time: int, lines_complete: bool = True) -> list:
+    """
+    Upserts the snapshots of invoice contexts with their lines, returns the ids saved.
+    Snapshots of a state newer than state_time are left as they are (webhooks arrive out of order).
+    """
+    if not contexts:
+        return []
+    # read outside the transaction: on SQLite a transaction that reads before writing fails instead of waiting
+    # for a concurrent writer
+    existing = InvoiceSnapshot.objects.in_bulk([context['id'] for context in contexts])
+    now = timezone.now()
+    created, updated, lines = [], [], []
+    for context in contexts:
+        snapshot = existing.get(context['id'])
+        if snapshot is not None and snapshot.state_time > state_time:
+            continue
+        if snapshot is None:
+            snapshot = InvoiceSnapshot(invoice_id=context['id'])
+            created.append(snapshot)
+        else:
+            updated.append(snapshot)
+        for column in INVOICE_COLUMNS:
+            setattr(snapshot, column, context.get(column))
+        snapshot.lines_complete = lines_complete
+        snapshot.state_time = state_time
+        snapshot.synced_at = now
+        lines.extend(
+            InvoiceLineSnapshot(invoice_id=snapshot.invoice_id, position=position,
+                                **{column: (product or {}).get(column) for column in LINE_COLUMNS})
+            for position, product in enumerate(context.get('products') or ())
+        )
+    saved = [snapshot.invoice_id for snapshot in created + updated]
+    with transaction.atomic():
+        # a snapshot created concurrently is of about the same state, the first one is kept
+        InvoiceSnapshot.objects.bulk_create(created, ignore_conflicts=True)
+        # bulk_update does not fill auto_now fields, synced_at is set above
+        InvoiceSnapshot.objects.bulk_update(updated, [*INVOICE_COLUMNS, 'lines_complete', 'state_time', 'synced_at'])
+        InvoiceLineSnapshot.objects.filter(invoice_id__in=saved).delete()
+        InvoiceLineSnapshot.objects.bulk_create(lines, ignore_conflicts=True)
+    return saved
+
+
+def delete_invoice(invoice_id: str) -> None:
+    InvoiceSnapshot.objects.filter(invoice_id=invoice_id).delete()
+
+
+def save_customers(customers: list, state_time: int) -> list:
+    """ Upserts the snapshots of Stripe customer objects, returns the ids saved """
+    if not customers:
+        return []
+    existing = CustomerSnapshot.objects.in_bulk([customer['id'] for customer in customers])
+    now = timezone.now()
+    created, updated = [], []
+    for customer in customers:
+        snapshot = existing.get(customer['id'])
+        if snapshot is not None and snapshot.state_time > state_time:
+            continue
+        if snapshot is None:
+            snapshot = CustomerSnapshot(customer_id=customer['id'])
+            created.append(snapshot)
+        else:
+            updated.append(snapshot)
+        for column in CUSTOMER_COLUMNS:
+            setattr(snapshot, column, customer.get(column))
+        snapshot.state_time = state_time
+        snapshot.synced_at = now
+    with transaction.atomic():
+        CustomerSnapshot.objects.bulk_create(created, ignore_conflicts=True)
+        CustomerSnapshot.objects.bulk_update(updated, [*CUSTOMER_COLUMNS, 'state_time', 'synced_at'])
+    return [snapshot.customer_id for snapshot in created + updated]
+
+
+def delete_customer(customer_id: str) -> None:
+    CustomerSnapshot.objects.filter(customer_id=customer_id).delete()
+
@@ -1,3 +1,457 @@
-from django.test import TestCase
+import asyncio
+import json
+import logging
+import threading
+import time
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+import stripe
+from asgiref.sync import sync_to_async
+from django.apps import apps
+from django.core.cache import caches
+from django.http import StreamingHttpResponse
+from django.template import engines
+from django.template.loader import render_to_string
+from django.test import RequestFactory, SimpleTestCase, TestCase
+from django.utils import timezone
+from utils import cache
+from utils.common_functions import preload_templates
+from utils.concurrency import StreamingASGIHandler
+from utils.pubsub import broker
+
+from . import cache_bus, webhook_queue
+from .events import EVENT_STREAM_RETRY_MS, InvoiceEventsApp
+from .models import CustomerSnapshot, InvoiceSnapshot, PaymentAttempt, WebhookEvent
+from .payment_pipeline import LeaseLost, PaymentPipelineMixin, acquire, heartbeat, idempotency_key
+from .views import InsertLinkView, InvoiceBatchView, InvoiceMixin, invoice_cache, invoice_topic
+
+
+class FakeCheckout(PaymentPipelineMixin):
+    """ The InvoiceMixin and AccountsMixin calls of the pipeline, counted """
+
+    def __init__(self, reading_invoice=None):
+        self.bank_account_tokens = 0
+        self.reading_invoice = reading_invoice
+
+    def create_bank_account_token(self, access_token: str, account_id: str) -> dict:
+        self.bank_account_tokens += 1
+        return {'stripe_bank_account_token': f'btok_{self.bank_account_tokens}'}
+
+    def get_invoice(self, invoice_id: str) -> dict:
+        if self.reading_invoice:
+            self.reading_invoice()
+        return {'id': invoice_id, 'customer': 'cus_1'}
+
+
+@mock.patch('stripe_app.payment_pipeline.snapshots.save_customers')
+@mock.patch('stripe_app.payment_pipeline.stripe_api')
+class PaymentPipelineTests(TestCase):
+    def setUp(self):
+        self.checkout = FakeCheckout()
+
+    def pay(self):
+        return self.checkout.run_payment(access_token='access-1', invoice_id='in_1', account_id='acc_1')
+
+    @staticmethod
+    def answer(stripe_api):
+        stripe_api.Customer.modify.return_value = {'id': 'cus_1', 'default_source': 'ba_1'}
+        stripe_api.Invoice.pay.return_value = {'id': 'in_1', 'status': 'paid', 'paid': True}
+
+    def test_paid_payment_is_answered_from_the_database(self, stripe_api, save_customers):
+        self.answer(stripe_api)
+        self.assertEqual(self.pay(), {'id': 'in_1', 'status': 'paid', 'paid': True})
+        self.assertEqual(self.pay(), {'id': 'in_1', 'status': 'paid', 'paid': True})
+        self.assertEqual(stripe_api.Invoice.pay.call_count, 1)
+        self.assertEqual(stripe_api.Customer.modify.call_args.args, ('cus_1',))
+        key = idempotency_key('in_1', 'acc_1')
+        self.assertEqual(stripe_api.Invoice.pay.call_args.kwargs['idempotency_key'], f'{key}:pay')
+        attempt = PaymentAttempt.objects.get()
+        self.assertEqual((attempt.step, attempt.lock), (PaymentAttempt.PAID, ''))
+
+    def test_transient_error_resumes_at_the_failed_step(self, stripe_api, save_customers):
+        self.answer(stripe_api)
+        stripe_api.Invoice.pay.side_effect = [
+            stripe.error.APIConnectionError('reset'), stripe_api.Invoice.pay.return_value,
+        ]
+        with self.assertLogs('stripe_app.payment_pipeline', 'ERROR'):
+            self.assertIn('error', self.pay())
+        self.assertEqual(PaymentAttempt.objects.get().step, PaymentAttempt.SOURCE_ATTACHED)
+        self.assertTrue(self.pay()['paid'])
+        self.assertEqual(self.checkout.bank_account_tokens, 1)
+        self.assertEqual(stripe_api.Customer.modify.call_count, 1)
+        first, second = (call.kwargs['idempotency_key'] for call in stripe_api.Invoice.pay.call_args_list)
+        self.assertEqual(first, second)
+
+    def test_failed_payment_starts_over_with_new_keys(self, stripe_api, save_customers):
+        self.answer(stripe_api)
+        stripe_api.Invoice.pay.side_effect = [
+            stripe.error.CardError('declined', None, 'card_declined'), stripe_api.Invoice.pay.return_value,
+        ]
+        with self.assertLogs('stripe_app.payment_pipeline', 'WARNING'):
+            self.assertIn('declined', str(self.pay()['error']))
+        attempt = PaymentAttempt.objects.get()
+        self.assertEqual((attempt.step, attempt.generation), (PaymentAttempt.FAILED, 0))
+
+        self.assertTrue(self.pay()['paid'])
+        attempt.refresh_from_db()
+        self.assertEqual((attempt.step, attempt.generation), (PaymentAttempt.PAID, 1))
+        self.assertEqual(self.checkout.bank_account_tokens, 2)
+        key = idempotency_key('in_1', 'acc_1')
+        self.assertEqual(stripe_api.Customer.modify.call_args.kwargs['idempotency_key'], f'{key}:1:source')
+        self.assertEqual(stripe_api.Invoice.pay.call_args.kwargs['idempotency_key'], f'{key}:1:pay')
+
+    def test_running_payment_is_not_run_twice(self, stripe_api, save_customers):
+        attempt = PaymentAttempt.objects.create(idempotency_key='k', invoice_id='in_1', account_id='acc_1')
+        self.assertIsNotNone(acquire(attempt))
+        self.assertIsNone(acquire(attempt))
+
+    def test_lock_is_renewed_before_every_step(self, stripe_api, save_customers):
+        self.answer(stripe_api)
+        paid = stripe_api.Invoice.pay.return_value
+        leases = []
+
+        def pay(*args, **kwargs):
+            leases.append(PaymentAttempt.objects.get().locked_until)
+            return paid
+
+        stripe_api.Invoice.pay.side_effect = pay
+        # reading the invoice took so long that the lock ran out
+        self.checkout.reading_invoice = lambda: PaymentAttempt.objects.update(
+            locked_until=timezone.now() - timedelta(seconds=1),
+        )
+        self.assertTrue(self.pay()['paid'])
+        self.assertGreater(leases[0], timezone.now())
+
+    def test_heartbeat_renews_the_lock_until_the_step_is_done(self, stripe_api, save_customers):
+        attempt = PaymentAttempt.objects.create(idempotency_key='k', invoice_id='in_1', account_id='acc_1')
+        renewed = threading.Event()
+        with mock.patch('stripe_app.payment_pipeline.renew', side_effect=lambda *args: renewed.set()) as renew:
+            with heartbeat(attempt, 'lock-1', interval=0.01):
+                # a Stripe call taking longer than the renew interval
+                self.assertTrue(renewed.wait(1))
+            beats = renew.call_count
+            time.sleep(0.05)
+        self.assertEqual(renew.call_count, beats)
+        renew.assert_called_with(attempt, 'lock-1')
+
+    def test_heartbeat_stops_once_the_lock_is_lost(self, stripe_api, save_customers):
+        attempt = PaymentAttempt.objects.create(idempotency_key='k', invoice_id='in_1', account_id='acc_1')
+        with mock.patch('stripe_app.payment_pipeline.renew', side_effect=LeaseLost()) as renew:
+            with heartbeat(attempt, 'lock-1', interval=0.01):
+                time.sleep(0.1)
+        renew.assert_called_once()
+
+    def test_lost_lock_stops_the_payment(self, stripe_api, save_customers):
+        self.answer(stripe_api)
+        # another request took the lock over while the invoice was read
+        self.checkout.reading_invoice = lambda: PaymentAttempt.objects.update(lock='other')
+        with self.assertLogs('stripe_app.payment_pipeline', 'WARNING'):
+            self.assertEqual(self.pay(), {'error': 'payment is already in progress'})
+        stripe_api.Invoice.pay.assert_not_called()
+        attempt = PaymentAttempt.objects.get()
+        self.assertEqual((attempt.step, attempt.lock), (PaymentAttempt.SOURCE_ATTACHED, 'other'))
+
+
+@mock.patch.object(cache, '_first_store_hooks', [])
+@mock.patch.object(invoice_cache, 'backend_alias', None)
+class CacheBusTests(TestCase):
+    def setUp(self):
+        for invoice_id in ('in_1', 'in_2'):
+            invoice_cache.set(invoice_id, {'id': invoice_id})
+            self.addCleanup(invoice_cache.drop_local, invoice_id)
+
+    def test_invalidation_of_another_process_drops_the_local_entry_on_the_next_poll(self):
+        listener = cache_bus.InvalidationListener()
+        with mock.patch.object(cache_bus, 'origin', return_value='worker-2:4242'):
+            cache_bus.broadcast(invoice_cache, 'in_1')
+        # this process updated in_2 itself, its own invalidation is skipped
+        cache_bus.broadcast(invoice_cache, 'in_2')
+        self.assertEqual(invoice_cache.get('in_1'), {'id': 'in_1'})
+        self.assertEqual(listener.poll(), 1)
+        self.assertIsNone(invoice_cache.get('in_1'))
+        self.assertEqual(invoice_cache.get('in_2'), {'id': 'in_2'})
+        self.assertEqual(listener.poll(), 0)
+        self.assertEqual(listener.stats()['applied'], 1)
+
+
+@mock.patch.object(webhook_queue, 'WEBHOOK_IN_PROCESS_WORKERS', 0)
+@mock.patch.object(webhook_queue, 'stripe_api')
+class WebhookQueueTests(TestCase):
+    @staticmethod
+    def enqueue(event_id: str, event_type: str = 'invoice.created', object_id: str = 'in_1') -> bool:
+        return webhook_queue.enqueue_event(event_id, event_type, object_id, 'https://shop.test', '{}')
+
+    def test_redelivered_event_is_queued_once(self, stripe_api):
+        self.assertTrue(self.enqueue('evt_1'))
+        self.assertFalse(self.enqueue('evt_1'))
+        self.assertEqual(WebhookEvent.objects.count(), 1)
+
+    def test_claimed_events_are_not_claimed_again_until_their_worker_times_out(self, stripe_api):
+        self.enqueue('evt_1')
+        self.enqueue('evt_2')
+        WebhookEvent.objects.filter(event_id='evt_2').update(next_attempt_at=timezone.now() + timedelta(minutes=1))
+        self.assertEqual([event.event_id for event in webhook_queue.claim_batch()], ['evt_1'])
+        self.assertEqual(webhook_queue.claim_batch(), [])
+        # the worker holding evt_1 died
+        WebhookEvent.objects.filter(event_id='evt_1').update(
+            claimed_at=timezone.now() - timedelta(seconds=webhook_queue.WEBHOOK_VISIBILITY_TIMEOUT + 1),
+        )
+        self.assertEqual([event.event_id for event in webhook_queue.claim_batch()], ['evt_1'])
+
+    def test_events_of_one_invoice_are_applied_once(self, stripe_api):
+        self.enqueue('evt_1')
+        self.enqueue('evt_2')
+        self.enqueue('evt_3', event_type='customer.updated', object_id='cus_1')
+        webhook_queue.process_batch(webhook_queue.claim_batch())
+        stripe_api.Invoice.modify.assert_called_once()
+        self.assertEqual(stripe_api.Invoice.modify.call_args.args, ('in_1',))
+        self.assertEqual(set(WebhookEvent.objects.values_list('status', flat=True)), {WebhookEvent.DONE})
+
+    def test_failed_events_are_retried_with_backoff_then_given_up(self, stripe_api):
+        stripe_api.Invoice.modify.side_effect = stripe.error.APIConnectionError('reset')
+        self.enqueue('evt_1')
+        with self.assertLogs('stripe_app.webhook_queue', 'WARNING'):
+            webhook_queue.process_batch(webhook_queue.claim_batch())
+        event = WebhookEvent.objects.get()
+        self.assertEqual((event.status, event.attempts, event.claim), (WebhookEvent.PENDING, 1, ''))
+        self.assertGreater(event.next_attempt_at, timezone.now())
+        self.assertEqual(webhook_queue.claim_batch(), [])
+
+        WebhookEvent.objects.update(attempts=webhook_queue.WEBHOOK_MAX_ATTEMPTS - 1, next_attempt_at=timezone.now())
+        with self.assertLogs('stripe_app.webhook_queue', 'WARNING'):
+            webhook_queue.process_batch(webhook_queue.claim_batch())
+        self.assertEqual(WebhookEvent.objects.get().status, WebhookEvent.FAILED)
+
+
+WEBHOOK_SECRET = 'whsec_test'
+
+
+def stripe_signature(payload: str, secret: str = WEBHOOK_SECRET) -> str:
+    timestamp = int(time.time())
+    return f't={timestamp},v1={stripe.WebhookSignature._compute_signature(f"{timestamp}.{payload}", secret)}'
+
+
+class SignedWebhooks:
+    """ Signed events posted to InsertLinkView, whose info logs are left out """
+    view = staticmethod(InsertLinkView.as_view())
+
+    def setUp(self):
+        self.addCleanup(invoice_cache.drop_local, 'in_1')
+        views_logger = logging.getLogger('stripe_app.views')
+        views_logger.setLevel(logging.WARNING)
+        self.addCleanup(views_logger.setLevel, logging.NOTSET)
+
+    def post(self, event: dict, signature=None):
+        payload = json.dumps(event)
+        headers = {'HTTP_STRIPE_SIGNATURE': stripe_signature(payload) if signature is None else signature}
+        request = RequestFactory().post('/payment/insert-link/', payload, content_type='application/json', **headers)
+        return self.view(request)
+
+    @staticmethod
+    def invoice_event(**invoice) -> dict:
+        invoice = {'id': 'in_1', 'object': 'invoice', 'customer': 'cus_1', 'total': 500, 'created': 1600000000,
+                   'lines': {'data': [], 'has_more': False}, **invoice}
+        return {'id': 'evt_1', 'type': 'invoice.updated', 'created': 1600000100, 'data': {'object': invoice}}
+
+
+@mock.patch.object(webhook_queue, 'WEBHOOK_IN_PROCESS_WORKERS', 0)
+@mock.patch.object(cache, '_first_store_hooks', [])
+@mock.patch.object(invoice_cache, 'backend_alias', None)
+@mock.patch('stripe_app.views.STRIPE_WEBHOOK_SECRET', WEBHOOK_SECRET)
+class InsertLinkViewTests(SignedWebhooks, TestCase):
+    def test_signed_event_updates_the_snapshot_and_the_cache(self):
+        self.assertEqual(self.post(self.invoice_event()).status_code, 200)
+        snapshot = InvoiceSnapshot.objects.get()
+        self.assertEqual((snapshot.customer, snapshot.state_time), ('cus_1', 1600000100))
+        self.assertEqual(invoice_cache.get('in_1')['total'], 500)
+        self.assertTrue(WebhookEvent.objects.filter(event_id='evt_1').exists())
+
+    def test_state_time_is_not_later_than_now(self):
+        event = self.invoice_event()
+        event['created'] = 9999999999
+        self.post(event)
+        self.assertLessEqual(InvoiceSnapshot.objects.get().state_time, int(time.time()))
+        # the next real state replaces it
+        event = self.invoice_event(customer='cus_2')
+        event.update(id='evt_2', created=int(time.time()) + 1)
+        self.post(event)
+        self.assertEqual(InvoiceSnapshot.objects.get().customer, 'cus_2')
+
+    async def test_webhook_update_reaches_an_open_event_stream(self):
+        sent, received = asyncio.Queue(), asyncio.Queue()
+        scope = {'type': 'http', 'method': 'GET', 'path': '/payment/invoice/in_1/events/', 'root_path': '',
+                 'query_string': b'', 'headers': []}
+        stream = asyncio.ensure_future(InvoiceEventsApp(mock.Mock())(scope, received.get, sent.put))
+        start = await asyncio.wait_for(sent.get(), 1)
+        self.assertEqual((start['status'], dict(start['headers'])[b'content-type']), (200, b'text/event-stream'))
+        # nothing is cached yet, the stream opens with the reconnection delay only
+        opening = await asyncio.wait_for(sent.get(), 1)
+        self.assertEqual(opening['body'], f'retry: {EVENT_STREAM_RETRY_MS}\n\n'.encode())
+
+        response = await sync_to_async(self.post)(self.invoice_event(status='paid', paid=True))
+        self.assertEqual(response.status_code, 200)
+        message = await asyncio.wait_for(sent.get(), 1)
+        self.assertTrue(message['more_body'])
+        event, data, end = message['body'].split(b'\n', 2)
+        self.assertEqual((event, end), (b'event: invoice', b'\n'))
+        state = json.loads(data[len(b'data: '):])
+        self.assertEqual((state['id'], state['status'], state['paid']), ('in_1', 'paid', True))
+
+        await received.put({'type': 'http.disconnect'})
+        await asyncio.wait_for(stream, 1)
+        self.assertFalse(broker.has_subscribers(invoice_topic('in_1')))
+
+    def test_unsigned_and_badly_signed_events_are_rejected(self):
+        customer_event = {'id': 'evt_2', 'type': 'customer.updated', 'created': 1600000100,
+                          'data': {'object': {'id': 'cus_1', 'object': 'customer', 'name': 'Mallory'}}}
+        forged = self.invoice_event(customer='cus_ATTACKER')
+        self.assertEqual(self.post(forged, signature='').status_code, 400)
+        self.assertEqual(self.post(customer_event, signature=stripe_signature('{}')).status_code, 400)
+        bad_secret = stripe_signature(json.dumps(forged), secret='whsec_other')
+        self.assertEqual(self.post(forged, signature=bad_secret).status_code, 400)
+        with mock.patch('stripe_app.views.STRIPE_WEBHOOK_SECRET', ''), \
+                self.assertLogs('stripe_app.views', 'WARNING'):
+            # without a secret nothing can be checked, so nothing is taken
+            self.assertEqual(self.post(forged, signature='').status_code, 400)
+        self.assertFalse(WebhookEvent.objects.exists())
+        self.assertFalse(InvoiceSnapshot.objects.exists())
+        self.assertFalse(CustomerSnapshot.objects.exists())
+        self.assertIsNone(invoice_cache.get('in_1'))
+
+
+@mock.patch.object(webhook_queue, 'WEBHOOK_IN_PROCESS_WORKERS', 0)
+@mock.patch.object(cache, '_first_store_hooks', [])
+@mock.patch.object(invoice_cache, 'backend_alias', None)
+@mock.patch('stripe_app.views.STRIPE_WEBHOOK_SECRET', WEBHOOK_SECRET)
+@mock.patch('stripe_app.views.stripe_api')
+class InvoiceCacheTests(SignedWebhooks, TestCase):
+    def counters(self) -> tuple:
+        stats = invoice_cache.stats()
+        return stats['hits'], stats['misses']
+
+    def test_invoice_is_read_from_stripe_once_and_then_from_the_cache(self, stripe_api):
+        stripe_api.Invoice.retrieve.return_value = self.invoice_event()['data']['object']
+        hits, misses = self.counters()
+        for _ in range(3):
+            self.assertEqual(InvoiceMixin().create_context_from_invoice('in_1')['total'], 500)
+        stripe_api.Invoice.retrieve.assert_called_once_with('in_1')
+        self.assertEqual(self.counters(), (hits + 2, misses + 1))
+
+    def test_webhook_invalidates_the_cached_invoice(self, stripe_api):
+        stripe_api.Invoice.retrieve.return_value = self.invoice_event()['data']['object']
+        InvoiceMixin().create_context_from_invoice('in_1')
+        # lines cut off in the event are read from Stripe on the next request
+        event = self.invoice_event(total=700, lines={'data': [], 'has_more': True})
+        event['created'] = int(time.time())
+        self.post(event)
+        self.assertIsNone(invoice_cache.get('in_1'))
+        stripe_api.Invoice.retrieve.return_value = self.invoice_event(total=700)['data']['object']
+        self.assertEqual(InvoiceMixin().create_context_from_invoice('in_1')['total'], 700)
+        self.assertEqual(stripe_api.Invoice.retrieve.call_count, 2)
+
+        event = self.invoice_event()
+        event.update(id='evt_2', type='invoice.deleted', created=1600000200)
+        self.post(event)
+        self.assertIsNone(invoice_cache.get('in_1'))
+        self.assertFalse(InvoiceSnapshot.objects.exists())
+
+
+class InvoiceFragmentTests(SimpleTestCase):
+    invoice = {
+        'id': 'in_1', 'number': 'A-1', 'total': 500, 'customer_name': 'Jane',
+        'lines': {'data': [{'quantity': 1, 'description': 'Seat', 'price': {'unit_amount': 500}}]},
+    }
+
+    def setUp(self):
+        self.addCleanup(caches['invoice_fragments'].clear)
+
+    def render(self, context: dict) -> str:
+        return render_to_string('stripe_app/invoice_description.html', context)
+
+    def test_state_version_follows_the_rendered_fields(self):
+        mixin = InvoiceMixin()
+        version = mixin.project_invoice(self.invoice)['state_version']
+        self.assertEqual(mixin.project_invoice(dict(self.invoice))['state_version'], version)
+        changed = {**self.invoice, 'lines': {'data': [{'quantity': 2, 'description': 'Seat'}]}}
+        self.assertNotEqual(mixin.project_invoice(changed)['state_version'], version)
+        self.assertNotEqual(mixin.project_invoice({**self.invoice, 'status': 'paid'})['state_version'], version)
+
+    def test_fragment_is_rendered_once_per_state_version(self):
+        context = InvoiceMixin().project_invoice(self.invoice)
+        first = self.render(context)
+        self.assertIn('Invoice A-1', first)
+        # a context of the same version is served from the fragment cache
+        self.assertEqual(self.render({**context, 'number': 'B-2'}), first)
+        self.assertIn('Invoice B-2', self.render({**context, 'number': 'B-2', 'state_version': 'next'}))
+
+    def test_app_templates_are_preloaded(self):
+        names = preload_templates(apps.get_app_config('stripe_app'))
+        self.assertIn('stripe_app/invoice_description.html', names)
+        cached_loader = engines['django'].engine.template_loaders[0]
+        self.assertTrue(set(names) <= set(cached_loader.get_template_cache))
+
+
+@mock.patch('stripe_app.views.INVOICE_BATCH_API_TOKEN', 'batch-token')
+@mock.patch('stripe_app.views.stripe_api')
+class InvoiceBatchViewTests(SimpleTestCase):
+    view = staticmethod(InvoiceBatchView.as_view())
+
+    def get(self, query: str):
+        request = RequestFactory().get(f'/payment/invoices/batch/?{query}', HTTP_AUTHORIZATION='Bearer batch-token')
+        return self.view(request)
+
+    def post(self, body: dict):
+        request = RequestFactory().post('/payment/invoices/batch/', json.dumps(body), content_type='application/json',
+                                        HTTP_AUTHORIZATION='Bearer batch-token')
+        return self.view(request)
+
+    def test_bad_created_bounds_are_rejected(self, stripe_api):
+        for query in ('created_gte=yesterday', 'created_gte=-5', 'created_gte=1.5', 'created_gte=20&created_lte=10',
+                      'status=paid'):
+            with self.subTest(query=query):
+                self.assertEqual(self.get(query).status_code, 400)
+        for body in ({'created': {'gte': 'yesterday'}}, {'created': {'gte': True}}, {'created': {'gte': 1.5}},
+                     {'created': {'gte': [1]}}, {'created': {'gte': 1}, 'status': {'in': 'paid'}},
+                     {'ids': ['in_1', 2]}):
+            with self.subTest(body=body):
+                self.assertEqual(self.post(body).status_code, 400)
+        stripe_api.Invoice.list.assert_not_called()
+
+    def test_time_range_is_streamed(self, stripe_api):
+        invoice = {'id': 'in_1', 'status': 'open', 'lines': {'data': []}}
+        stripe_api.Invoice.list.return_value = mock.Mock(data=[invoice], has_more=False)
+        response = self.post({'created': {'gte': 0, 'lte': 1600000000}, 'status': 'open'})
+        self.assertEqual(response.status_code, 200)
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual([json.loads(line)['id'] for line in lines], ['in_1'])
+        self.assertEqual(stripe_api.Invoice.list.call_args.kwargs['created'], {'gte': 0, 'lte': 1600000000})
+
+
+class StreamingASGIHandlerTests(SimpleTestCase):
+    def test_streaming_parts_are_produced_off_the_event_loop(self):
+        threads = []
+
+        def parts():
+            for number in range(3):
+                threads.append(threading.get_ident())
+                yield f'{number}\n'
+
+        response = StreamingHttpResponse(parts(), content_type='application/x-ndjson')
+        response.set_cookie('csrftoken', 'x')
+        messages = []
+
+        async def send(message):
+            messages.append(message)
+
+        async def serve():
+            await StreamingASGIHandler().send_response(response, send)
+            return threading.get_ident()
+
+        loop_thread = asyncio.run(serve())
+        self.assertNotIn(loop_thread, threads)
+        self.assertEqual(messages[0]['status'], 200)
+        self.assertIn((b'Content-Type', b'application/x-ndjson'), messages[0]['headers'])
+        self.assertTrue(any(name == b'Set-Cookie' for name, _ in messages[0]['headers']))
+        self.assertEqual(b''.join(message.get('body', b'') for message in messages[1:]), b'0\n1\n2\n')
+        self.assertFalse(messages[-1].get('more_body', False))
@@ -1,5 +1,12 @@
 from django.urls import path
-from .views import WebhookView, InsertLinkView, InvoiceView, ProofPaymentView, AuthorizePaymentView
+from iDjango.settings import USE_ASYNC_VIEWS
+from .views import WebhookView, InsertLinkView, InvoiceBatchView, InvoiceEventsView
+
+if USE_ASYNC_VIEWS:
+    from .async_views import AsyncInvoiceView as InvoiceView, AsyncProofPaymentView as ProofPaymentView, \
+        AsyncAuthorizePaymentView as AuthorizePaymentView
+else:
+    from .views import InvoiceView, ProofPaymentView, AuthorizePaymentView
 
 
 app_name = "stripe_app"
@@ -8,6 +15,8 @@ urlpatterns = [
     path('webhook/', WebhookView.as_view(), name='webhook'),
     path('insert-link/', InsertLinkView.as_view(), name='insert_link'),
     path('invoice/<str:id>/', InvoiceView.as_view(), name='invoice'),
+    path('invoice/<str:id>/events/', InvoiceEventsView.as_view(), name='invoice_events'),
+    path('invoices/batch/', InvoiceBatchView.as_view(), name='invoice_batch'),
     path('proof-payment/', ProofPaymentView.as_view(), name='proof_payment'),
     path('payment/', AuthorizePaymentView.as_view(), name='payment'),
 ]
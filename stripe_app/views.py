@@ -1,26 +1,82 @@
+import asyncio
+import logging
+import hashlib
+import hmac
 import json
+import time
 import stripe
-from functools import wraps
+from functools import partial, wraps
+from asgiref.sync import sync_to_async
 from datetime import datetime
-from django.http import HttpResponse
-from django.shortcuts import render
+from django.http import HttpResponse, StreamingHttpResponse
 from django.utils.decorators import method_decorator
 from django.views import View
 from django.views.decorators.csrf import csrf_exempt
-from iDjango.settings import STRIPE_BEARER
+from iDjango.settings import STRIPE_WEBHOOK_SECRET, WEBHOOK_MAX_BODY_SIZE, INVOICE_CACHE_TTL, \
+    INVOICE_CACHE_MAX_SIZE, INVOICE_CACHE_BACKEND, INVOICE_BATCH_API_TOKEN, INVOICE_BATCH_CONCURRENCY, \
+    INVOICE_BATCH_MAX_IDS, INVOICE_BATCH_MAX_BODY_SIZE, STALE_CONTEXT_TTL
+from utils import json_fast
+from utils.cache import TTLLRUCache
+from utils.circuit_breaker import is_outage
 from utils.common_functions import format_date, get_schema
+from utils.concurrency import gather_upstream, map_upstream
+from utils.instrumentation import register_collector, render
+from utils.projection import FieldProjection
+from utils.pubsub import broker
+from utils.rate_limit import in_lane, BACKGROUND
 from auth_app.views import AccountsMixin
+from . import snapshots
+from .cache_bus import broadcast, on_invalidation
+from .client import stripe_api
+from .payment_pipeline import PaymentPipelineMixin
+from .webhook_queue import enqueue_event
 
-stripe.api_key = STRIPE_BEARER
+logger = logging.getLogger(__name__)
+
+invoice_cache = TTLLRUCache(
+    namespace='invoice_context',
+    max_size=INVOICE_CACHE_MAX_SIZE,
+    ttl=INVOICE_CACHE_TTL,
+    backend_alias=INVOICE_CACHE_BACKEND,
+    stale_ttl=STALE_CONTEXT_TTL,
+)
+register_collector('invoice_cache', invoice_cache.stats)
+
+# Invoice fields pushed to open invoice pages (see stripe_app.events), the pages are public by invoice id
+PUSHED_INVOICE_FIELDS = ('id', 'status', 'paid', 'state_version')
+
+
+def invoice_topic(invoice_id: str) -> str:
+    return f'invoice:{invoice_id}'
+
+
+def invoice_event(context: dict) -> bytes:
+    """ Server-Sent Event with the state of an invoice context """
+    data = json.dumps({field: context.get(field) for field in PUSHED_INVOICE_FIELDS})
+    return f'event: invoice\ndata: {data}\n\n'.encode()
+
+
+def publish_invoice(context: dict) -> int:
+    """ Pushes the invoice state to the pages of the invoice open on this process """
+    return broker.publish(invoice_topic(context['id']), invoice_event(context))
+
+
+def has_payment_info(request, session_keys: tuple) -> bool:
+    return all(request.session.get(key) for key in session_keys)
 
 
 def get_info_from_request(decorated):
+    if asyncio.iscoroutinefunction(decorated):
+        @wraps(decorated)
+        async def async_wrapper(api, request, *args, **kwargs):
+            if not await sync_to_async(has_payment_info)(request, api._session_keys):
+                return render(request, 'stripe_app/error.html')
+            return await decorated(api, request, *args, **kwargs)
+        return async_wrapper
+
     @wraps(decorated)
     def wrapper(api, request, *args, **kwargs):
-        access_token = request.session.get('access_token')
-        invoice_id = request.session.get('invoice_id')
-        account_id = request.session.get('account_id')
-        if not all((access_token, invoice_id, account_id)):
+        if not has_payment_info(request, api._session_keys):
             return render(request, 'stripe_app/error.html')
         return decorated(api, request, *args, **kwargs)
     return wrapper
@@ -33,7 +89,7 @@ class WebhookView(View):
     def get(self, request):
         # TODO not localhost link
         try:
-            stripe.WebhookEndpoint.create(
+            stripe_api.WebhookEndpoint.create(
                 url='http://localhost:8000/payment/insert-link/',
                 enabled_events=[
                     'invoice.created',
@@ -41,81 +97,187 @@ class WebhookView(View):
             )
             return HttpResponse(status=200)
         except Exception as e:
-            import traceback
-            traceback.print_exc()
-            return HttpResponse(status=400)
-
-
-@method_decorator(csrf_exempt, name='dispatch')
-class InsertLinkView(View):
-    """ Insert link to invoice into field memo (description) """
-
-    def post(self, request):
-        raw_payload = request.body
-        payload = json.loads(raw_payload)
-        try:
-            event = stripe.Event.construct_from(
-                payload, stripe.api_key
-            )
-            invoice_id = payload.get("data", {}).get("object", {}).get("id")
-        except ValueError as e:
+            logger.exception('stripe.webhook_endpoint_failed')
             return HttpResponse(status=400)
-        print(event.type)
-        if event.type == 'invoice.created':
-            schema = get_schema(request.is_secure())
-            invoice_redirect_url = f'{schema}{request.get_host()}/user/invoice/{invoice_id}'
-            invoice = stripe.Invoice.modify(
-                invoice_id,
-                description=f'Please follow link for ACH Direct Debit payment {invoice_redirect_url}',
-            )
-        return HttpResponse(status=200)
 
 
 class InvoiceMixin:
     """  Class for handling invoice's views """
     _fields_to_represent_invoice = (
-        'period_end', 'customer_name', 'status', 'number', 'subtotal', 'total', 'invoice_pdf', 'created', 'paid'
+        'id', 'period_end', 'customer', 'customer_name', 'status', 'number', 'subtotal', 'total', 'invoice_pdf',
+        'created', 'paid'
     )
     _fields_to_represent_line_invoice = (
         'quantity', 'description', 'unit_amount'
     )
+    _line_projection = FieldProjection(_fields_to_represent_line_invoice, nested=True)
 
     @staticmethod
     def get_invoice(invoice_id: str) -> dict:
-        invoice_details = stripe.Invoice.retrieve(invoice_id)
+        invoice_details = stripe_api.Invoice.retrieve(invoice_id)
         return invoice_details
 
-    def search(self, line) -> dict:
-        result = {}
-        for item in line.items():
-            if isinstance(item[1], dict):
-                result.update(self.search(item[1]))
-            elif item[0] in self._fields_to_represent_line_invoice:
-                result.update({item[0]: item[1]})
+    def project_invoice(self, invoice_details) -> dict:
+        result = {
+            invoice_key: invoice_details.get(invoice_key)
+            for invoice_key in self._fields_to_represent_invoice
+        }
+        # result = dict(filter(lambda elem: elem[0] in self._fields_to_represent_invoice, invoice_details.items()))
+        lines = invoice_details.get('lines', {}).get('data', [])
+        result.update({'products': self._line_projection.project(lines)})
+        result['state_version'] = self.state_version(result)
         return result
 
+    @staticmethod
+    def state_version(invoice_context: dict) -> str:
+        """ Changes whenever anything rendered from the invoice changes, keys its cached template fragments """
+        encoded = json.dumps(invoice_context, sort_keys=True, default=str).encode()
+        return hashlib.md5(encoded).hexdigest()
+
     def create_context_from_invoice(self, invoice_id: str) -> dict:
+        """ Invoice context is served from invoice_cache, Stripe is asked only on a miss """
         try:
-            invoice_details = self.get_invoice(invoice_id)
-            result = {
-                invoice_key: invoice_details.get(invoice_key)
-                for invoice_key in self._fields_to_represent_invoice
-            }
+            result = invoice_cache.get(invoice_id)
+            if result is None:
+                result = self.load_invoice_context(invoice_id)
             if result.get('created') > datetime.timestamp(datetime.now()):
                 return {'error': 'invoice link is expired'}
-            # result = dict(filter(lambda elem: elem[0] in self._fields_to_represent_invoice, invoice_details.items()))
-            lines = invoice_details.get('lines', {}).get('data', [])
-            result.update({'products': [self.search(line=line) for line in lines]})
-            return result
+            return dict(result)
         except Exception as e:
-            import traceback
-            traceback.print_exc()
+            logger.exception('invoice.context_failed', extra={'invoice_id': invoice_id})
             # TODO beautiful error
             return {'error': ''}
 
+    def load_invoice_context(self, invoice_id: str) -> dict:
+        """
+        Context from the invoice snapshot, or from Stripe (saved as the snapshot) when there is none.
+        The last known one is marked as stale while Stripe is down.
+        """
+        result = self.snapshot_context(invoice_id)
+        if result is None:
+            try:
+                result = self.project_invoice(self.get_invoice(invoice_id))
+            except Exception as e:
+                stale = invoice_cache.get_stale(invoice_id) if is_outage(e) else None
+                if stale is None:
+                    raise
+                return {**stale, 'stale': True}
+            snapshots.save_invoices([result], state_time=int(time.time()))
+        invoice_cache.set(invoice_id, result)
+        return result
+
+    def snapshot_context(self, invoice_id: str):
+        context = snapshots.load_invoice(invoice_id)
+        if context is not None:
+            context['state_version'] = self.state_version(context)
+        return context
+
+
+def push_remote_invoice(invoice_id: str) -> None:
+    """ The invoice changed on another process, the pages of it open on this one get its new state """
+    if broker.has_subscribers(invoice_topic(invoice_id)):
+        context = InvoiceMixin().create_context_from_invoice(invoice_id)
+        if 'error' not in context:
+            publish_invoice(context)
+
+
+on_invalidation(invoice_cache.namespace, push_remote_invoice)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class InsertLinkView(View, InvoiceMixin):
+    """
+    Queues webhook events, the invoice link is inserted into memo (description) by webhook_queue workers.
+    Events are accepted only with a valid signature, so without STRIPE_WEBHOOK_SECRET every event is rejected.
+    invoice.* and customer.* events update the snapshots (stripe_app.snapshots), invoice states are also cached
+    and pushed to the open pages of the invoice.
+    """
+
+    _event_fields = {
+        'id': ('id',),
+        'type': ('type',),
+        'created': ('created',),
+        'object_id': ('data', 'object', 'id'),
+        'object': ('data', 'object'),
+    }
+
+    def post(self, request):
+        raw_payload = request.body
+        if not STRIPE_WEBHOOK_SECRET:
+            logger.warning('webhook.no_secret')
+            return HttpResponse(status=400)
+        try:
+            stripe.WebhookSignature.verify_header(
+                raw_payload.decode(), request.META.get('HTTP_STRIPE_SIGNATURE'), STRIPE_WEBHOOK_SECRET,
+                stripe.Webhook.DEFAULT_TOLERANCE
+            )
+            event = json_fast.extract(raw_payload, self._event_fields, max_size=WEBHOOK_MAX_BODY_SIZE)
+        except json_fast.PayloadTooLarge:
+            return HttpResponse(status=413)
+        except (ValueError, stripe.error.SignatureVerificationError) as e:
+            return HttpResponse(status=400)
+        if not isinstance(event.get('type'), str):
+            return HttpResponse(status=400)
+        invoice_id = event.get('object_id')
+        logger.info('webhook.received', extra={'event_type': event['type'], 'invoice_id': invoice_id})
+        state_time = self.state_time(event.get('created'))
+        if event['type'].startswith('invoice.') and invoice_id:
+            self.update_invoice(invoice_id, event.get('object'), event['type'], state_time)
+        elif event['type'].startswith('customer.') and invoice_id:
+            self.update_customer(event.get('object'), event['type'], state_time)
+        enqueue_event(
+            event_id=event.get('id') or f"{event['type']}:{invoice_id}",
+            event_type=event['type'],
+            object_id=invoice_id,
+            host_url=f'{get_schema(request.is_secure())}{request.get_host()}',
+            payload=raw_payload.decode(),
+        )
+        return HttpResponse(status=200)
+
+    @staticmethod
+    def state_time(created) -> int:
+        """ Time of the event's state, never later than now: a later one would win over every state to come """
+        now = int(time.time())
+        if isinstance(created, int) and not isinstance(created, bool):
+            return min(created, now)
+        # events without a time are taken as the current state
+        return now
+
+    def update_invoice(self, invoice_id: str, invoice, event_type: str, state_time: int) -> None:
+        """
+        The invoice of the event replaces its snapshot and cached context, unless the snapshot is of a later
+        state. An invoice whose lines are cut off is snapshotted as incomplete and read from Stripe.
+        """
+        lines = invoice.get('lines') if isinstance(invoice, dict) else None
+        context = None
+        if event_type == 'invoice.deleted':
+            snapshots.delete_invoice(invoice_id)
+        elif isinstance(lines, dict):
+            complete = not lines.get('has_more')
+            context = self.project_invoice(invoice)
+            if not snapshots.save_invoices([context], state_time=state_time, lines_complete=complete):
+                return
+            context = context if complete else None
+        if context is None:
+            invoice_cache.invalidate(invoice_id)
+        else:
+            invoice_cache.set(invoice_id, context)
+            publish_invoice(context)
+        broadcast(invoice_cache, invoice_id)
+
+    @staticmethod
+    def update_customer(customer, event_type: str, state_time: int) -> None:
+        # customer.source.*, customer.subscription.* and others carry other objects
+        if not isinstance(customer, dict) or customer.get('object') != 'customer':
+            return
+        if event_type == 'customer.deleted':
+            snapshots.delete_customer(customer['id'])
+        else:
+            snapshots.save_customers([customer], state_time=state_time)
+
 
 class InvoiceView(View, InvoiceMixin):
-    """ Detail view of invoice (all info is getting from Stripe by API) """
+    """ Detail view of invoice (from its snapshot, Stripe is asked when there is none) """
 
     def get(self, request, *args, **kwargs):
         invoice_id = kwargs.get("id")
@@ -123,7 +285,6 @@ class InvoiceView(View, InvoiceMixin):
         context = self.create_context_from_invoice(
             invoice_id=invoice_id
         )
-        print(context)
         if 'error' in context:
             return render(request, 'stripe_app/error.html')
         return render(request, 'stripe_app/invoice_detail.html', context)
@@ -131,6 +292,8 @@ class InvoiceView(View, InvoiceMixin):
 
 class ProofPaymentView(View, InvoiceMixin, AccountsMixin):
     """ Page with invoice and selected account views """
+    # account_id is chosen on this page
+    _session_keys = ('access_token', 'invoice_id')
 
     @get_info_from_request
     def post(self, request):
@@ -138,35 +301,166 @@ class ProofPaymentView(View, InvoiceMixin, AccountsMixin):
         access_token = request.session.get('access_token')
         invoice_id = request.session.get('invoice_id')
         request.session['account_id'] = selected_account_id
-        invoice = self.create_context_from_invoice(
-            invoice_id=invoice_id
-        )
-        accounts = self.get_accounts(
-            access_token=access_token,
-            account_id=selected_account_id
-        )
+        results = gather_upstream({
+            'invoice': partial(self.create_context_from_invoice, invoice_id=invoice_id),
+            'accounts': partial(self.get_accounts, access_token=access_token, account_id=selected_account_id),
+        })
+        invoice, accounts = results['invoice'], results['accounts']
         if 'error' in invoice or 'error' in accounts:
             return render(request, 'stripe_app/error.html')
         context = {**invoice, **accounts}
         return render(request, 'stripe_app/proof_payment.html', context)
 
 
-class AuthorizePaymentView(View, AccountsMixin):
+class AuthorizePaymentView(View, InvoiceMixin, AccountsMixin, PaymentPipelineMixin):
     """ Payment! """
+    _session_keys = ('access_token', 'invoice_id', 'account_id')
+
+    def authorize_payment(self, access_token: str, invoice_id: str, account_id: str) -> dict:
+        payment = self.run_payment(access_token=access_token, invoice_id=invoice_id, account_id=account_id)
+        if 'error' not in payment:
+            # the next read takes the paid invoice from Stripe
+            snapshots.delete_invoice(invoice_id)
+            invoice_cache.invalidate(invoice_id)
+            broadcast(invoice_cache, invoice_id)
+        return payment
 
     @get_info_from_request
     def get(self, request):
         access_token = request.session.get('access_token')
         invoice_id = request.session.get('invoice_id')
         account_id = request.session.get('account_id')
-        bank_account_token = self.create_bank_account_token(access_token=access_token, account_id=account_id)
-        if 'error' in bank_account_token:
+        payment = self.authorize_payment(access_token=access_token, invoice_id=invoice_id, account_id=account_id)
+        if 'error' in payment:
             return render(request, 'stripe_app/error.html')
-        invoice_details = stripe.Invoice.retrieve(invoice_id)
-        customer_id = invoice_details.get('customer')
-        customer = stripe.Customer.modify(
-            customer_id,
-            source=bank_account_token.get('stripe_bank_account_token'),
-        )
-        payment = stripe.Invoice.pay(invoice_id, source=customer.get('default_source'))
-        return render(request, 'stripe_app/result_payment.html')
+        return render(request, 'stripe_app/result_payment.html', payment)
+
+
+class InvoiceEventsView(View):
+    """ The invoice event stream is served by stripe_app.events under ASGI, other servers tell browsers to stop """
+
+    def get(self, request, *args, **kwargs):
+        return HttpResponse(status=204)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class InvoiceBatchView(View, InvoiceMixin):
+    """
+    Invoice contexts for back-office tools, streamed as NDJSON (one invoice per line) with
+    Authorization: Bearer <INVOICE_BATCH_API_TOKEN>.
+    By id: GET ?ids=in_1,in_2 or POST {"ids": [...]}
+    By time range: GET ?created_gte=<unix time>&created_lte=<unix time>[&status=...][&customer=...]
+    or POST {"created": {"gte": ..., "lte": ...}, "status": ..., "customer": ...}
+    Under ASGI the lines are produced in a worker thread by utils.concurrency.StreamingASGIHandler.
+    """
+    _page_size = 100
+    _payload_fields = {
+        'ids': ('ids',),
+        'created_gte': ('created', 'gte'),
+        'created_lte': ('created', 'lte'),
+        'status': ('status',),
+        'customer': ('customer',),
+    }
+
+    @staticmethod
+    def authorized(request) -> bool:
+        given = request.META.get('HTTP_AUTHORIZATION', '')
+        return bool(INVOICE_BATCH_API_TOKEN) and hmac.compare_digest(given, f'Bearer {INVOICE_BATCH_API_TOKEN}')
+
+    @staticmethod
+    def parse_query(query) -> dict:
+        ids = [invoice_id for value in query.getlist('ids') for invoice_id in value.split(',') if invoice_id]
+        return {'ids': ids, **{name: query.get(name) for name in ('created_gte', 'created_lte', 'status', 'customer')}}
+
+    def parse_body(self, body: bytes) -> dict:
+        return json_fast.extract(body, self._payload_fields, max_size=INVOICE_BATCH_MAX_BODY_SIZE)
+
+    @staticmethod
+    def unix_time(name: str, value) -> int:
+        """ created_gte/created_lte of the query (a string) or of the body (a number) """
+        if isinstance(value, int) and not isinstance(value, bool) and value >= 0:
+            return value
+        if isinstance(value, str) and value.isascii() and value.isdigit():
+            return int(value)
+        raise ValueError(f'{name} must be a unix time')
+
+    def list_filters(self, batch: dict) -> dict:
+        """ Invoice.list parameters of a time range batch, ValueError for an invalid one """
+        created = {
+            bound: self.unix_time(f'created_{bound}', batch[f'created_{bound}'])
+            for bound in ('gte', 'lte') if batch.get(f'created_{bound}') not in (None, '')
+        }
+        if not created:
+            raise ValueError('ids or a created range is required')
+        if 'gte' in created and 'lte' in created and created['gte'] > created['lte']:
+            raise ValueError('created_gte is after created_lte')
+        filters = {'created': created}
+        for name in ('status', 'customer'):
+            if batch.get(name) in (None, ''):
+                continue
+            if not isinstance(batch[name], str):
+                raise ValueError(f'{name} must be a string')
+            filters[name] = batch[name]
+        return filters
+
+    def batch_context(self, invoice_id: str) -> dict:
+        """ Projection of one invoice, cached ones and snapshots are reused but batches do not fill the cache """
+        context = invoice_cache.get(invoice_id) or self.snapshot_context(invoice_id)
+        return context if context is not None else self.project_invoice(self.get_invoice(invoice_id))
+
+    def contexts_by_id(self, invoice_ids: list):
+        call = in_lane(BACKGROUND, self.batch_context)
+        for invoice_id, context in map_upstream(call, invoice_ids, window=INVOICE_BATCH_CONCURRENCY):
+            yield {'id': invoice_id, 'error': str(context['error'])} if 'error' in context else context
+
+    def contexts_in_range(self, filters: dict):
+        """ Stripe's auto-pagination over Invoice.list, every page is requested through stripe_api """
+        list_page = in_lane(BACKGROUND, stripe_api.Invoice.list)
+        params = {'limit': self._page_size, **filters}
+        while True:
+            try:
+                page = list_page(**params)
+            except Exception as e:
+                logger.exception('invoice.batch_page_failed', extra={'starting_after': params.get('starting_after')})
+                yield {'error': str(e), 'starting_after': params.get('starting_after')}
+                return
+            for invoice in page.data:
+                yield self.project_invoice(invoice)
+            if not page.has_more or not page.data:
+                return
+            params['starting_after'] = page.data[-1].id
+
+    @staticmethod
+    def stream(contexts) -> StreamingHttpResponse:
+        lines = (json.dumps(context, default=str) + '\n' for context in contexts)
+        return StreamingHttpResponse(lines, content_type='application/x-ndjson')
+
+    def respond(self, request, batch: dict):
+        if batch.get('ids'):
+            if len(batch['ids']) > INVOICE_BATCH_MAX_IDS:
+                return HttpResponse(f'at most {INVOICE_BATCH_MAX_IDS} ids per batch', status=400)
+            return self.stream(self.contexts_by_id(batch['ids']))
+        try:
+            filters = self.list_filters(batch)
+        except (TypeError, ValueError) as e:
+            return HttpResponse(str(e), status=400)
+        return self.stream(self.contexts_in_range(filters))
+
+    def get(self, request):
+        if not self.authorized(request):
+            return HttpResponse(status=403)
+        return self.respond(request, self.parse_query(request.GET))
+
+    def post(self, request):
+        if not self.authorized(request):
+            return HttpResponse(status=403)
+        try:
+            batch = self.parse_body(request.body)
+        except json_fast.PayloadTooLarge:
+            return HttpResponse(status=413)
+        except ValueError:
+            return HttpResponse(status=400)
+        ids = batch.get('ids')
+        if ids is not None and not (isinstance(ids, list) and all(isinstance(invoice_id, str) for invoice_id in ids)):
+            return HttpResponse(status=400)
+        return self.respond(request, batch)
@@ -0,0 +1,160 @@
+import logging
+import threading
+import uuid
+from datetime import timedelta
+
+from django.db import close_old_connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+from iDjango.settings import WEBHOOK_IN_PROCESS_WORKERS, WEBHOOK_BATCH_SIZE, WEBHOOK_POLL_INTERVAL, \
+    WEBHOOK_MAX_ATTEMPTS, WEBHOOK_RETRY_BACKOFF, WEBHOOK_VISIBILITY_TIMEOUT
+from utils.rate_limit import lane, BACKGROUND
+from .client import stripe_api
+from .models import WebhookEvent
+
+logger = logging.getLogger(__name__)
+
+
+def enqueue_event(event_id: str, event_type: str, object_id: str, host_url: str, payload: str) -> bool:
+    """ Persists the event once per event_id, returns False for a redelivery of a known event """
+    _, created = WebhookEvent.objects.get_or_create(
+        event_id=event_id,
+        defaults={'type': event_type, 'object_id': object_id or '', 'host_url': host_url, 'payload': payload},
+    )
+    if created and WEBHOOK_IN_PROCESS_WORKERS:
+        in_process_pool().wake()
+    return created
+
+
+def claim_batch(size: int = WEBHOOK_BATCH_SIZE) -> list:
+    """ Claims due events, including ones left in processing by a worker that died """
+    now = timezone.now()
+    claim = uuid.uuid4().hex
+    due = (
+        Q(status=WebhookEvent.PENDING, next_attempt_at__lte=now)
+        | Q(status=WebhookEvent.PROCESSING, claimed_at__lt=now - timedelta(seconds=WEBHOOK_VISIBILITY_TIMEOUT))
+    )
+    with transaction.atomic():
+        ids = list(WebhookEvent.objects.filter(due).order_by('id').values_list('id', flat=True)[:size])
+        WebhookEvent.objects.filter(due, id__in=ids).update(
+            status=WebhookEvent.PROCESSING, claim=claim, claimed_at=now
+        )
+    return list(WebhookEvent.objects.filter(claim=claim, status=WebhookEvent.PROCESSING).order_by('id'))
+
+
+def insert_invoice_link(invoice_id: str, events: list) -> None:
+    """ Insert link to invoice into field memo (description) """
+    invoice_redirect_url = f'{events[-1].host_url}/user/invoice/{invoice_id}'
+    stripe_api.Invoice.modify(
+        invoice_id,
+        description=f'Please follow link for ACH Direct Debit payment {invoice_redirect_url}',
+    )
+
+
+# event type -> handler(object_id, events), called once per object of a batch
+EVENT_HANDLERS = {
+    'invoice.created': insert_invoice_link,
+}
+
+
+def process_batch(events: list) -> None:
+    grouped = {}
+    for event in events:
+        if event.type in EVENT_HANDLERS:
+            grouped.setdefault((event.type, event.object_id), []).append(event)
+        else:
+            mark_done([event])
+    for (event_type, object_id), object_events in grouped.items():
+        try:
+            EVENT_HANDLERS[event_type](object_id, object_events)
+        except Exception as e:
+            logger.warning('webhook.handler_failed', exc_info=True, extra={
+                'event_type': event_type, 'object_id': object_id, 'events': len(object_events),
+            })
+            mark_failed(object_events, e)
+        else:
+            mark_done(object_events)
+
+
+def mark_done(events: list) -> None:
+    WebhookEvent.objects.filter(id__in=[event.id for event in events]).update(
+        status=WebhookEvent.DONE, claim='', last_error=''
+    )
+
+
+def mark_failed(events: list, error: Exception) -> None:
+    for event in events:
+        event.attempts += 1
+        event.claim = ''
+        event.last_error = repr(error)
+        if event.attempts >= WEBHOOK_MAX_ATTEMPTS:
+            event.status = WebhookEvent.FAILED
+        else:
+            event.status = WebhookEvent.PENDING
+            event.next_attempt_at = timezone.now() + timedelta(
+                seconds=WEBHOOK_RETRY_BACKOFF * 2 ** (event.attempts - 1)
+            )
+        event.save(update_fields=['attempts', 'claim', 'last_error', 'status', 'next_attempt_at'])
+
+
+class WebhookWorkerPool:
+    """ Threads claiming and applying batches of queued webhook events """
+
+    def __init__(self, workers: int, batch_size: int = WEBHOOK_BATCH_SIZE,
+                 poll_interval: float = WEBHOOK_POLL_INTERVAL):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._threads = []
+
+    def start(self) -> None:
+        for number in range(self.workers):
+            thread = threading.Thread(target=self.run, name=f'webhook-worker-{number}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self._wakeup.set()
+        for thread in self._threads:
+            thread.join()
+
+    def wake(self) -> None:
+        self._wakeup.set()
+
+    def run_once(self) -> int:
+        events = claim_batch(self.batch_size)
+        if events:
+            # checkout calls are let through before webhook work
+            with lane(BACKGROUND):
+                process_batch(events)
+        return len(events)
+
+    def run(self) -> None:
+        while not self._stopped.is_set():
+            close_old_connections()
+            try:
+                processed = self.run_once()
+            except Exception:
+                logger.exception('webhook.worker_failed')
+                processed = 0
+            if not processed:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+        close_old_connections()
+
+
+_in_process_pool = None
+_in_process_pool_lock = threading.Lock()
+
+
+def in_process_pool() -> WebhookWorkerPool:
+    """ Workers living in the web process, started with the first queued event """
+    global _in_process_pool
+    with _in_process_pool_lock:
+        if _in_process_pool is None:
+            _in_process_pool = WebhookWorkerPool(workers=WEBHOOK_IN_PROCESS_WORKERS)
+            _in_process_pool.start()
+    return _in_process_pool
@@ -0,0 +1,191 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from django.core.cache import caches
+
+# namespace -> TTLLRUCache, for invalidations broadcast by other processes (see stripe_app.cache_bus)
+_namespaces = {}
+# callbacks run once per process before the first entry is kept in process memory, and pid that ran them
+_first_store_hooks = []
+_hooked_pid = None
+
+
+def on_first_store(callback) -> None:
+    """ callback() runs before a process (a forked worker too) first keeps an entry in an in-process tier """
+    _first_store_hooks.append(callback)
+
+
+def _run_first_store_hooks() -> None:
+    global _hooked_pid
+    pid = os.getpid()
+    if _hooked_pid == pid:
+        return
+    _hooked_pid = pid
+    for callback in _first_store_hooks:
+        callback()
+
+
+def drop_local(namespace: str, key: str) -> bool:
+    """ Drops key from the in-process tier of the namespace's cache, False for an unknown namespace """
+    cache = _namespaces.get(namespace)
+    if cache is None:
+        return False
+    cache.drop_local(key)
+    return True
+
+
+class TTLLRUCache:
+    """
+    Two-tier cache: an in-process TTL + LRU store (L1) in front of one of Django's caches (L2, optional)
+    shared by the worker processes. Expired entries are kept for another stale_ttl seconds, get_stale() serves
+    them while the upstream is down. With hash_keys the L2 keys are digests, so secrets used as keys stay in
+    process memory.
+    """
+
+    def __init__(self, namespace: str, max_size: int, ttl: float, backend_alias: str = None, stale_ttl: float = 0,
+                 hash_keys: bool = False):
+        self.namespace = namespace
+        self.max_size = max_size
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.backend_alias = backend_alias
+        self.hash_keys = hash_keys
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.backend_hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.remote_invalidations = 0
+        _namespaces[namespace] = self
+
+    @property
+    def backend(self):
+        return caches[self.backend_alias] if self.backend_alias else None
+
+    def _backend_key(self, key: str) -> str:
+        if self.hash_keys:
+            key = hashlib.sha256(key.encode()).hexdigest()
+        return f'{self.namespace}:{key}'
+
+    def _backend_get(self, key: str):
+        """ (expires_at as unix time, value) from the backend, None when it is not there """
+        entry = self.backend.get(self._backend_key(key)) if self.backend_alias else None
+        return entry if isinstance(entry, tuple) else None
+
+    def get(self, key: str):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                if expires_at + self.stale_ttl <= now:
+                    del self._entries[key]
+        backend_entry = self._backend_get(key)
+        remaining = backend_entry[0] - time.time() if backend_entry else 0
+        if remaining > 0:
+            _run_first_store_hooks()
+        with self._lock:
+            if remaining <= 0:
+                self.misses += 1
+                return None
+            self.backend_hits += 1
+            self._store(key, backend_entry[1], now + remaining)
+        return backend_entry[1]
+
+    def get_stale(self, key: str):
+        """ Last value stored for key, even an expired one (within stale_ttl) """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] + self.stale_ttl > now:
+                self.stale_hits += 1
+                return entry[1]
+        backend_entry = self._backend_get(key)
+        if backend_entry is None:
+            return None
+        with self._lock:
+            self.stale_hits += 1
+        return backend_entry[1]
+
+    def set(self, key: str, value) -> None:
+        _run_first_store_hooks()
+        with self._lock:
+            self._store(key, value, time.monotonic() + self.ttl)
+        if self.backend_alias:
+            self.backend.set(self._backend_key(key), (time.time() + self.ttl, value), timeout=self.ttl + self.stale_ttl)
+
+    def invalidate(self, key: str) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+        if self.backend_alias:
+            self.backend.delete(self._backend_key(key))
+
+    def drop_local(self, key: str) -> None:
+        """ Another process changed key, the next get() reads it from L2 """
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self.remote_invalidations += 1
+
+    def _store(self, key: str, value, expires_at: float) -> None:
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.backend_hits + self.misses
+            backend_lookups = self.backend_hits + self.misses
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'backend_hits': self.backend_hits,
+                'misses': self.misses,
+                'stale_hits': self.stale_hits,
+                'remote_invalidations': self.remote_invalidations,
+                'upstream_calls_saved': self.hits + self.backend_hits,
+                # L1 ratio over all lookups, L2 ratio over the lookups L1 missed
+                'l1_hit_ratio': round(self.hits / lookups, 4) if lookups else None,
+                'l2_hit_ratio': round(self.backend_hits / backend_lookups, 4)
+                if self.backend_alias and backend_lookups else None,
+                'hit_ratio': round((self.hits + self.backend_hits) / lookups, 4) if lookups else None,
+            }
+
+
+class SingleFlight:
+    """ Concurrent callers asking for the same key share a single execution of the loader """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.coalesced = 0
+
+    def do(self, key: str, loader):
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self._calls[key] = Future()
+            else:
+                self.coalesced += 1
+        if not is_leader:
+            return call.result()
+        try:
+            result = loader()
+            call.set_result(result)
+            return result
+        except Exception as e:
+            call.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
@@ -0,0 +1,65 @@
+from django.contrib.sessions.backends.base import CreateError, UpdateError
+from django.contrib.sessions.backends.cache import SessionStore as CacheSessionStore
+
+# Everything the checkout flow keeps in the session
+CHECKOUT_KEYS = ('link_token', 'access_token', 'invoice_id', 'account_id')
+
+
+def pack(session: dict) -> tuple:
+    """ Values of CHECKOUT_KEYS by position, other keys (if any) are kept in a trailing dict """
+    values = tuple(session.get(key) for key in CHECKOUT_KEYS)
+    extra = {key: value for key, value in session.items() if key not in CHECKOUT_KEYS}
+    return values + (extra,) if extra else values
+
+
+def unpack(packed: tuple) -> dict:
+    session = {key: value for key, value in zip(CHECKOUT_KEYS, packed) if value is not None}
+    if len(packed) > len(CHECKOUT_KEYS):
+        session.update(packed[-1])
+    return session
+
+
+class SessionStore(CacheSessionStore):
+    """
+    Cache session of the checkout flow (SESSION_CACHE_ALIAS).
+    The session is stored as a tuple of the checkout keys and it is only written when it differs from the one
+    that was loaded, so requests that do not change link_token/access_token/invoice_id/account_id do not write.
+    """
+    cache_key_prefix = 'checkout_session:'
+
+    def __init__(self, session_key=None):
+        super().__init__(session_key)
+        self._stored = None
+
+    def load(self):
+        try:
+            packed = self._cache.get(self.cache_key)
+        except Exception:
+            # memcached raises on invalid keys, the session is reset as in the cache backend
+            packed = None
+        if isinstance(packed, tuple):
+            self._stored = packed
+            return unpack(packed)
+        self._session_key = None
+        self._stored = None
+        return {}
+
+    def save(self, must_create=False):
+        if self.session_key is None:
+            return self.create()
+        packed = pack(self._get_session(no_load=must_create))
+        if not must_create and packed == self._stored:
+            return
+        if must_create:
+            if not self._cache.add(self.cache_key, packed, self.get_expiry_age()):
+                raise CreateError
+        elif self._cache.get(self.cache_key) is None:
+            # deleted by another request (e.g. flushed), SessionMiddleware must not bring it back
+            raise UpdateError
+        else:
+            self._cache.set(self.cache_key, packed, self.get_expiry_age())
+        self._stored = packed
+
+    def delete(self, session_key=None):
+        super().delete(session_key)
+        self._stored = None
@@ -0,0 +1,152 @@
+import threading
+import time
+from collections import deque
+
+import requests
+import stripe
+from plaid.errors import APIError as PlaidAPIError
+from utils.instrumentation import register_collector
+from utils.rate_limit import is_rate_limited
+from iDjango.settings import UPSTREAM_CIRCUIT_BREAKERS
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# Outages, as opposed to errors about the request itself (declined card, invalid token, ...)
+UPSTREAM_FAILURES = (
+    requests.ConnectionError,
+    requests.Timeout,
+    stripe.error.APIConnectionError,
+    stripe.error.APIError,
+    PlaidAPIError,
+)
+
+
+class CircuitOpenError(Exception):
+    """ The upstream is failing, the call was not made """
+
+
+def is_upstream_failure(error: Exception) -> bool:
+    return isinstance(error, UPSTREAM_FAILURES) or (getattr(error, 'http_status', None) or 0) >= 500
+
+
+def is_outage(error: Exception) -> bool:
+    """ The upstream is down (or its breaker is open), cached data may be served instead """
+    return isinstance(error, CircuitOpenError) or is_upstream_failure(error)
+
+
+class CircuitBreaker:
+    """
+    Opens once at least minimum_calls were made within `window` seconds and failure_rate of them failed.
+    Open, calls fail at once with CircuitOpenError; after open_seconds up to half_open_calls probe calls are
+    let through, the breaker closes when they succeed and opens again when one fails.
+    """
+
+    def __init__(self, name: str, failure_rate: float = 0.5, minimum_calls: int = 10, window: float = 30,
+                 open_seconds: float = 15, half_open_calls: int = 1):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.minimum_calls = minimum_calls
+        self.window = window
+        self.open_seconds = open_seconds
+        self.half_open_calls = half_open_calls
+        self.state = CLOSED
+        self._lock = threading.Lock()
+        self._outcomes = deque()
+        self._opened_at = 0.0
+        self._probes = 0
+        self._probe_successes = 0
+        self.rejected = 0
+        self.state_changes = {OPEN: 0, HALF_OPEN: 0, CLOSED: 0}
+        self.last_state_change = None
+
+    def _change_state(self, state: str) -> None:
+        self.state = state
+        self.state_changes[state] += 1
+        self.last_state_change = time.time()
+        if state == OPEN:
+            self._opened_at = time.monotonic()
+        if state == HALF_OPEN:
+            self._probes = self._probe_successes = 0
+        if state == CLOSED:
+            self._outcomes.clear()
+
+    def allow(self) -> None:
+        """ Raises CircuitOpenError when the call must not be made """
+        with self._lock:
+            if self.state == OPEN and time.monotonic() - self._opened_at >= self.open_seconds:
+                self._change_state(HALF_OPEN)
+            if self.state == CLOSED:
+                return
+            if self.state == HALF_OPEN and self._probes < self.half_open_calls:
+                self._probes += 1
+                return
+            self.rejected += 1
+        raise CircuitOpenError(f'{self.name} circuit is open')
+
+    def _failure_rate(self, now: float) -> float:
+        while self._outcomes and self._outcomes[0][0] <= now - self.window:
+            self._outcomes.popleft()
+        if len(self._outcomes) < self.minimum_calls:
+            return 0.0
+        return sum(1 for _, failed in self._outcomes if failed) / len(self._outcomes)
+
+    def record(self, failed: bool) -> None:
+        now = time.monotonic()
+        with self._lock:
+            if self.state == HALF_OPEN:
+                if failed:
+                    self._change_state(OPEN)
+                else:
+                    self._probe_successes += 1
+                    if self._probe_successes >= self.half_open_calls:
+                        self._change_state(CLOSED)
+                return
+            if self.state == OPEN:
+                return
+            self._outcomes.append((now, failed))
+            if failed and self._failure_rate(now) >= self.failure_rate:
+                self._change_state(OPEN)
+
+    def release(self) -> None:
+        """ The call allow() let through has no outcome, a half-open breaker lets another probe through """
+        with self._lock:
+            if self.state == HALF_OPEN and self._probes > self._probe_successes:
+                self._probes -= 1
+
+    def call(self, func, *args, **kwargs):
+        self.allow()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            if is_rate_limited(e):
+                # rate limited calls are neither failures nor successes
+                self.release()
+            else:
+                self.record(is_upstream_failure(e))
+            raise
+        self.record(False)
+        return result
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'state': self.state,
+                'failure_rate': round(self._failure_rate(time.monotonic()), 3),
+                'calls_in_window': len(self._outcomes),
+                'rejected': self.rejected,
+                'state_changes': dict(self.state_changes),
+                'last_state_change': self.last_state_change,
+            }
+
+
+breakers = {name: CircuitBreaker(name, **config) for name, config in UPSTREAM_CIRCUIT_BREAKERS.items()}
+register_collector('circuit_breakers', lambda: {name: breaker.stats() for name, breaker in breakers.items()})
+
+
+def call_with_breaker(upstream: str, func, *args, **kwargs):
+    breaker = breakers.get(upstream)
+    if breaker is None:
+        return func(*args, **kwargs)
+    return breaker.call(func, *args, **kwargs)
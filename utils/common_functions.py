@@ -1,4 +1,6 @@
 from datetime import datetime
+from pathlib import Path
+from utils.projection import FieldProjection
 
 
 def format_date(raw_date: float) -> str:
@@ -9,9 +11,19 @@ def format_date(raw_date: float) -> str:
 
 
 def reduce_info(needed_keys: tuple, data_to_reduce: list) -> list:
-    result = [{key: info.get(key, '') for key in needed_keys} for info in data_to_reduce]
+    result = FieldProjection(needed_keys).project(data_to_reduce, default='')
     return result
 
 
 def get_schema(is_secure: bool) -> str:
     return 'https://' if is_secure else 'http://'
+
+
+def preload_templates(app_config) -> list:
+    """ Compiles the templates of an app into the cached template loader, returns their names """
+    from django.template.loader import get_template
+    templates_dir = Path(app_config.path) / 'templates'
+    names = sorted(path.relative_to(templates_dir).as_posix() for path in templates_dir.rglob('*.html'))
+    for name in names:
+        get_template(name)
+    return names
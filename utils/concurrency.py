@@ -0,0 +1,199 @@
+import asyncio
+from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, as_completed
+from contextvars import copy_context
+from functools import partial, update_wrapper
+
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIHandler
+from django.db import close_old_connections
+from django.utils.decorators import classonlymethod
+from django.views import View
+from iDjango.settings import UPSTREAM_THREAD_POOL_SIZE, UPSTREAM_CALL_TIMEOUT
+
+# Blocking Plaid/Stripe SDK calls of async views run here, so the event loop never waits on the network
+upstream_executor = ThreadPoolExecutor(max_workers=UPSTREAM_THREAD_POOL_SIZE, thread_name_prefix='upstream')
+
+
+def _in_pool(func, *args, **kwargs):
+    # calls reading the database (invoice snapshots) leave the connection of the pool thread as a request does,
+    # the threads are never told that a request finished
+    close_old_connections()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        close_old_connections()
+
+
+async def run_upstream(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    # run_in_executor does not carry contextvars (request spans) over to the pool thread
+    return await loop.run_in_executor(upstream_executor, partial(copy_context().run, _in_pool, func, *args, **kwargs))
+
+
+def _is_error(result) -> bool:
+    return isinstance(result, dict) and 'error' in result
+
+
+def _unfinished(results: dict, names, reason: str) -> dict:
+    return {**results, **{name: {'error': reason} for name in names if name not in results}}
+
+
+def gather_upstream(calls: dict, timeout: float = UPSTREAM_CALL_TIMEOUT) -> dict:
+    """
+    Runs {name: callable} at the same time on the upstream pool and returns {name: result}.
+    Every call gets `timeout` seconds from submission; once a call times out or returns an error
+    the calls still queued are cancelled and reported as {'error': ...}.
+    """
+    futures = {upstream_executor.submit(copy_context().run, _in_pool, call): name for name, call in calls.items()}
+    results = {}
+    reason = 'upstream call was cancelled'
+    try:
+        for future in as_completed(futures, timeout=timeout):
+            try:
+                results[futures[future]] = future.result()
+            except Exception as e:
+                results[futures[future]] = {'error': e}
+            if _is_error(results[futures[future]]):
+                break
+    except TimeoutError:
+        reason = 'upstream call timed out'
+    for future in futures:
+        future.cancel()
+    return _unfinished(results, calls, reason)
+
+
+async def async_gather_upstream(calls: dict, timeout: float = UPSTREAM_CALL_TIMEOUT) -> dict:
+    """ gather_upstream for coroutines """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    tasks = {asyncio.ensure_future(run_upstream(call)): name for name, call in calls.items()}
+    pending = set(tasks)
+    results = {}
+    reason = 'upstream call was cancelled'
+    while pending:
+        done, pending = await asyncio.wait(
+            pending, timeout=deadline - loop.time(), return_when=asyncio.FIRST_COMPLETED
+        )
+        if not done:
+            reason = 'upstream call timed out'
+            break
+        for task in done:
+            try:
+                results[tasks[task]] = task.result()
+            except Exception as e:
+                results[tasks[task]] = {'error': e}
+        if any(_is_error(results[tasks[task]]) for task in done):
+            break
+    for task in pending:
+        task.cancel()
+    return _unfinished(results, calls, reason)
+
+
+def map_upstream(func, items, window: int):
+    """
+    Yields (item, func(item)) in the order of items, with at most `window` calls running on the upstream pool.
+    Items are consumed lazily, so a long iterable is never held in memory; a call raising yields {'error': e}.
+    """
+    running = deque()
+
+    def result(item, future):
+        try:
+            return item, future.result()
+        except Exception as e:
+            return item, {'error': e}
+
+    for item in items:
+        running.append((item, upstream_executor.submit(copy_context().run, _in_pool, func, item)))
+        if len(running) >= window:
+            yield result(*running.popleft())
+    while running:
+        yield result(*running.popleft())
+
+
+class HybridMiddleware(ABC):
+    """
+    Base of middleware running in the mode of the chain around it, sync under WSGI and async under ASGI, so
+    Django never moves the chain into its single sync thread for it. Subclasses implement sync_call and
+    async_call.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = asyncio.iscoroutinefunction(get_response)
+        if self.is_async:
+            # how Django's MiddlewareMixin tells the handler that calling the instance returns a coroutine
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.async_call(request)
+        return self.sync_call(request)
+
+    @abstractmethod
+    def sync_call(self, request):
+        pass
+
+    @abstractmethod
+    async def async_call(self, request):
+        pass
+
+
+@sync_to_async
+def session_get(request, *keys) -> tuple:
+    return tuple(request.session.get(key) for key in keys)
+
+
+@sync_to_async
+def session_set(request, **values) -> None:
+    request.session.update(values)
+
+
+class AsyncView(View):
+    """ View with coroutine handlers (View.as_view() of Django 3.1 only builds sync callables) """
+
+    @classonlymethod
+    def as_view(cls, **initkwargs):
+        view = super().as_view(**initkwargs)
+
+        async def async_view(request, *args, **kwargs):
+            response = view(request, *args, **kwargs)
+            if asyncio.iscoroutine(response):
+                response = await response
+            return response
+
+        update_wrapper(async_view, view)
+        return async_view
+
+
+class StreamingASGIHandler(ASGIHandler):
+    """
+    Django's ASGI handler, except that the parts of a streaming response are produced in a worker thread: Django
+    3.1 iterates streaming responses in the event loop, so a part waiting on an upstream (an NDJSON batch line)
+    would hold up every other request of the process.
+    """
+
+    async def send_response(self, response, send):
+        if not response.streaming:
+            return await super().send_response(response, send)
+        headers = [
+            (header.encode('ascii') if isinstance(header, str) else bytes(header),
+             value.encode('latin1') if isinstance(value, str) else bytes(value))
+            for header, value in response.items()
+        ]
+        headers.extend((b'Set-Cookie', cookie.output(header='').encode('ascii').strip())
+                       for cookie in response.cookies.values())
+        await send({'type': 'http.response.start', 'status': response.status_code, 'headers': headers})
+        parts = iter(response)
+        next_part = sync_to_async(next, thread_sensitive=False)
+        while True:
+            part = await next_part(parts, None)
+            if part is None:
+                break
+            for chunk, _ in self.chunk_bytes(part):
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body'})
+        await sync_to_async(response.close, thread_sensitive=True)()
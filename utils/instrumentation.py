@@ -0,0 +1,187 @@
+import hmac
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.http import HttpResponse, JsonResponse
+from django.shortcuts import render as django_render
+from django.urls import resolve, Resolver404
+from django.views import View
+from iDjango.settings import METRICS_API_TOKEN
+from utils.concurrency import HybridMiddleware
+
+# Upper bounds of the histogram buckets, in milliseconds
+BUCKETS_MS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, float('inf'))
+
+_request_spans = ContextVar('request_spans', default=None)
+
+
+class Histogram:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = [0] * len(BUCKETS_MS)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, duration_ms: float) -> None:
+        index = bisect_left(BUCKETS_MS, duration_ms)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total_ms += duration_ms
+            self.max_ms = max(self.max_ms, duration_ms)
+
+    def quantile(self, q: float) -> float:
+        """ Upper bound of the bucket holding the q quantile (the slowest observation caps it) """
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS_MS, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, round(self.max_ms, 3))
+        return round(self.max_ms, 3)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                'count': self.count,
+                'sum_ms': round(self.total_ms, 3),
+                'mean_ms': round(self.total_ms / self.count, 3) if self.count else 0.0,
+                'max_ms': round(self.max_ms, 3),
+                'p50_ms': self.quantile(0.5),
+                'p95_ms': self.quantile(0.95),
+                'p99_ms': self.quantile(0.99),
+                'buckets': {str(bound): count for bound, count in zip(BUCKETS_MS, self.counts) if count},
+            }
+
+
+_histograms = {}
+_histograms_lock = threading.Lock()
+_collectors = {}
+
+
+def observe(name: str, duration_ms: float) -> None:
+    histogram = _histograms.get(name)
+    if histogram is None:
+        with _histograms_lock:
+            histogram = _histograms.setdefault(name, Histogram())
+    histogram.observe(duration_ms)
+
+
+def register_collector(name: str, collect) -> None:
+    """ collect() -> dict is added to the metrics endpoint under name """
+    _collectors[name] = collect
+
+
+def metrics_snapshot() -> dict:
+    return {
+        'timings': {name: histogram.snapshot() for name, histogram in sorted(_histograms.items())},
+        **{name: collect() for name, collect in sorted(_collectors.items())},
+    }
+
+
+def record_span(name: str, duration_ms: float) -> None:
+    """ Adds a span to the current request (if any) and to the process wide histogram """
+    spans = _request_spans.get()
+    if spans is not None:
+        spans.append((name, duration_ms))
+    observe(name, duration_ms)
+
+
+@contextmanager
+def span(name: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(name, (time.perf_counter() - started) * 1000)
+
+
+def timed(name: str, func):
+    def wrapper(*args, **kwargs):
+        with span(name):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def render(request, template_name, context=None, *args, **kwargs):
+    """ django.shortcuts.render with a render span """
+    with span('render'):
+        return django_render(request, template_name, context, *args, **kwargs)
+
+
+def route_name(request) -> str:
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        try:
+            match = resolve(request.path_info)
+        except Resolver404:
+            return 'unresolved'
+    return match.view_name
+
+
+def server_timing(spans: list) -> str:
+    totals = {}
+    for name, duration_ms in spans:
+        totals[name] = totals.get(name, 0.0) + duration_ms
+    return ', '.join(f'{name};dur={duration_ms:.1f}' for name, duration_ms in totals.items())
+
+
+class ServerTimingMiddleware(HybridMiddleware):
+    """
+    Collects the spans of a request (upstream calls, render, session load/save) into a Server-Timing header
+    and the histograms of the metrics endpoint. Goes first in MIDDLEWARE so the session save is inside it.
+    Lean endpoints (utils.lean_endpoints) skip process_view, their sessions are not timed.
+    """
+
+    def sync_call(self, request):
+        spans, token, started = self.start()
+        try:
+            response = self.get_response(request)
+        finally:
+            _request_spans.reset(token)
+        return self.finish(request, response, spans, started)
+
+    async def async_call(self, request):
+        spans, token, started = self.start()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _request_spans.reset(token)
+        return self.finish(request, response, spans, started)
+
+    @staticmethod
+    def start() -> tuple:
+        spans = []
+        return spans, _request_spans.set(spans), time.perf_counter()
+
+    @staticmethod
+    def finish(request, response, spans: list, started: float):
+        total_ms = (time.perf_counter() - started) * 1000
+        spans.append(('total', total_ms))
+        observe(f'request.{route_name(request)}', total_ms)
+        response['Server-Timing'] = server_timing(spans)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        session = getattr(request, 'session', None)
+        if session is not None:
+            session.load = timed('session.load', session.load)
+            session.save = timed('session.save', session.save)
+
+
+class MetricsView(View):
+    """ Aggregated timings and the registered collectors of this process, with Bearer <METRICS_API_TOKEN> """
+
+    @staticmethod
+    def authorized(request) -> bool:
+        given = request.META.get('HTTP_AUTHORIZATION', '')
+        return bool(METRICS_API_TOKEN) and hmac.compare_digest(given, f'Bearer {METRICS_API_TOKEN}')
+
+    def get(self, request):
+        if not self.authorized(request):
+            return HttpResponse(status=403)
+        return JsonResponse(metrics_snapshot())
@@ -0,0 +1,118 @@
+import json
+import threading
+from json.encoder import encode_basestring_ascii as encode_string
+from django.core.exceptions import ImproperlyConfigured
+from iDjango.settings import JSON_BACKEND
+
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+BACKENDS = {
+    'simdjson': simdjson,
+    'orjson': orjson,
+    'ujson': ujson,
+    'json': json,
+}
+
+
+class PayloadTooLarge(ValueError):
+    pass
+
+
+def available_backends() -> tuple:
+    return tuple(name for name, module in BACKENDS.items() if module is not None)
+
+
+def pick_backend(name: str = JSON_BACKEND) -> str:
+    """ 'auto' takes the fastest installed backend, an explicit name has to be installed """
+    if name == 'auto':
+        return available_backends()[0]
+    if BACKENDS.get(name) is None:
+        raise ImproperlyConfigured(f'JSON backend {name!r} is not installed')
+    return name
+
+
+_local = threading.local()
+
+
+def _simdjson_parser():
+    # a simdjson parser holds one document at a time, so every thread gets its own
+    parser = getattr(_local, 'parser', None)
+    if parser is None:
+        parser = _local.parser = simdjson.Parser()
+    return parser
+
+
+def loads(raw: bytes, backend: str = None):
+    backend = backend or pick_backend()
+    if backend == 'orjson':
+        return orjson.loads(raw)
+    if backend == 'ujson':
+        return ujson.loads(raw)
+    return json.loads(raw)
+
+
+def _walk(document, path: tuple):
+    for key in path:
+        if not isinstance(document, dict):
+            return None
+        document = document.get(key)
+    return document
+
+
+def extract(raw: bytes, paths: dict, max_size: int, backend: str = None) -> dict:
+    """
+    Returns {name: value} for {name: key path} without keeping the decoded document around.
+    simdjson only materialises the requested values; the other backends decode the body and walk it.
+    """
+    if len(raw) > max_size:
+        raise PayloadTooLarge(f'payload of {len(raw)} bytes is larger than {max_size}')
+    backend = backend or pick_backend()
+    if backend != 'simdjson':
+        document = loads(raw, backend)
+        return {name: _walk(document, path) for name, path in paths.items()}
+    try:
+        document = _simdjson_parser().parse(raw)
+    except RuntimeError as e:
+        raise ValueError(str(e))
+    if not isinstance(document, simdjson.Object):
+        # a scalar, null or array root has no keys to look up, like _walk finds for the other backends
+        return {name: None for name in paths}
+    result = {}
+    for name, path in paths.items():
+        try:
+            value = document.at_pointer('/' + '/'.join(path))
+        except (KeyError, IndexError, TypeError, ValueError):
+            value = None
+        if isinstance(value, simdjson.Object):
+            value = value.as_dict()
+        elif isinstance(value, simdjson.Array):
+            value = value.as_list()
+        result[name] = value
+    return result
+
+
+class JsonTemplate:
+    """
+    Body of a JSON object with fixed keys, serialised once: render() only encodes the values.
+    JsonTemplate('link_token').render(token) == json.dumps({'link_token': token}).encode()
+    """
+
+    def __init__(self, *keys: str):
+        self.keys = keys
+        self._format = '{' + ', '.join(f'{encode_string(key).replace("%", "%%")}: %s' for key in keys) + '}'
+
+    def render(self, *values) -> bytes:
+        return (self._format % tuple(
+            encode_string(value) if isinstance(value, str) else json.dumps(value) for value in values
+        )).encode()
@@ -0,0 +1,101 @@
+import asyncio
+from functools import lru_cache
+
+from asgiref.sync import async_to_sync, sync_to_async
+from django.core.exceptions import ImproperlyConfigured, MiddlewareNotUsed
+from django.urls import resolve, Resolver404
+from django.utils.module_loading import import_string
+from iDjango.settings import LEAN_ENDPOINTS, LEAN_ENDPOINT_MIDDLEWARE
+from utils.concurrency import HybridMiddleware
+
+
+def lean_endpoint(view):
+    """ Marks a view of the urlconf to be served by LeanEndpointMiddleware, unless LEAN_ENDPOINTS is off """
+    if LEAN_ENDPOINTS:
+        view.lean_endpoint = True
+    return view
+
+
+@lru_cache(maxsize=1024)
+def lean_match(path: str):
+    """ ResolverMatch of path when it routes to a lean endpoint, None otherwise """
+    try:
+        match = resolve(path)
+    except Resolver404:
+        return None
+    return match if getattr(match.func, 'lean_endpoint', False) else None
+
+
+class LeanEndpointMiddleware(HybridMiddleware):
+    """
+    Serves the views marked with lean_endpoint() behind LEAN_ENDPOINT_MIDDLEWARE only (security headers, sessions
+    and CSRF), the middleware after this one in MIDDLEWARE is skipped for them. The middleware before it still
+    wraps them, but their process_view hooks do not run (no session spans of ServerTimingMiddleware).
+    Other requests go on unchanged.
+    """
+
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        # the chain is built like BaseHandler.load_middleware builds the full one, in the mode of this middleware
+        self._view_middleware = []
+        handler = self._async_view if self.is_async else self._sync_view
+        for middleware_path in reversed(LEAN_ENDPOINT_MIDDLEWARE):
+            middleware = import_string(middleware_path)
+            capable = getattr(middleware, 'async_capable', False) if self.is_async \
+                else getattr(middleware, 'sync_capable', True)
+            if not capable:
+                raise ImproperlyConfigured(
+                    f'{middleware_path} of LEAN_ENDPOINT_MIDDLEWARE cannot run in '
+                    f'{"async" if self.is_async else "sync"} mode'
+                )
+            try:
+                instance = middleware(handler)
+            except MiddlewareNotUsed:
+                # nothing was adapted, so unlike in Django 3.1's handler skipping it is safe
+                continue
+            if hasattr(instance, 'process_view'):
+                self._view_middleware.insert(0, instance.process_view)
+            handler = instance
+        self._lean_response = handler
+
+    def sync_call(self, request):
+        match = lean_match(request.path_info) if LEAN_ENDPOINTS else None
+        if match is None:
+            return self.get_response(request)
+        request.resolver_match = match
+        return self._lean_response(request)
+
+    async def async_call(self, request):
+        match = lean_match(request.path_info) if LEAN_ENDPOINTS else None
+        if match is None:
+            return await self.get_response(request)
+        request.resolver_match = match
+        return await self._lean_response(request)
+
+    def _sync_view(self, request):
+        match = request.resolver_match
+        for process_view in self._view_middleware:
+            response = process_view(request, match.func, match.args, match.kwargs)
+            if response is not None:
+                return response
+        view = match.func
+        if asyncio.iscoroutinefunction(view):
+            # an async view behind a sync (WSGI) chain
+            view = async_to_sync(view)
+        return view(request, *match.args, **match.kwargs)
+
+    async def _async_view(self, request):
+        match = request.resolver_match
+        for process_view in self._view_middleware:
+            # process_view hooks are sync (CSRF reads headers, cookies and the POST body already received), they
+            # run in the thread pool rather than in the single thread of thread sensitive calls
+            response = await sync_to_async(process_view, thread_sensitive=False)(
+                request, match.func, match.args, match.kwargs
+            )
+            if response is not None:
+                return response
+        view = match.func
+        if asyncio.iscoroutinefunction(view):
+            return await view(request, *match.args, **match.kwargs)
+        # a sync view gets the thread Django gives sync views under ASGI
+        return await sync_to_async(view, thread_sensitive=True)(request, *match.args, **match.kwargs)
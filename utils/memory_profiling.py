@@ -0,0 +1,203 @@
+import linecache
+import os
+import random
+import socket
+import threading
+import time
+import tracemalloc
+
+from django.core.cache import caches
+from utils.concurrency import HybridMiddleware
+from utils.instrumentation import register_collector, route_name
+from iDjango.settings import MEMORY_PROFILING_SAMPLE_RATE, MEMORY_PROFILING_FRAMES, \
+    MEMORY_PROFILING_TOP, MEMORY_PROFILING_FLUSH_INTERVAL, MEMORY_PROFILING_CACHE
+
+# Keys of the shared cache the worker processes publish their profiles under, read by the memory_report command
+PROFILES_KEY = 'memory_profile:processes'
+PROFILE_KEY = 'memory_profile:{origin}'
+
+# The allocations of tracemalloc and of this module are not the view's
+_IGNORED = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, __file__),
+    tracemalloc.Filter(False, linecache.__file__),
+)
+
+
+def origin() -> str:
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+class ViewMemory:
+    """ Peak and retained memory of the profiled requests of a view and its largest allocation sites """
+
+    def __init__(self, top: int):
+        self.top = top
+        self.count = 0
+        self.peak_total = 0
+        self.peak_max = 0
+        self.retained_total = 0
+        self.retained_max = 0
+        # 'file:line' -> largest size (bytes) allocated there by one request
+        self.sites = {}
+
+    def add(self, peak: int, retained: int, sites: list) -> None:
+        self.count += 1
+        self.peak_total += peak
+        self.peak_max = max(self.peak_max, peak)
+        self.retained_total += retained
+        self.retained_max = max(self.retained_max, retained)
+        for site, size in sites:
+            self.sites[site] = max(self.sites.get(site, 0), size)
+        if len(self.sites) > self.top:
+            self.sites = dict(sorted(self.sites.items(), key=lambda item: -item[1])[:self.top])
+
+    def snapshot(self) -> dict:
+        return {
+            'count': self.count,
+            'peak_total': self.peak_total,
+            'peak_max': self.peak_max,
+            'retained_total': self.retained_total,
+            'retained_max': self.retained_max,
+            'sites': dict(self.sites),
+        }
+
+
+class MemoryProfiler:
+    """
+    Measures requests with tracemalloc: the peak over the memory in use when the request started, what is still
+    allocated when the response is returned (retained, e.g. cache entries) and the lines that allocated the most.
+    tracemalloc counts the allocations of every thread, so one request is measured at a time and the others
+    pass unmeasured; the numbers are exact with a single worker thread and an upper bound otherwise.
+    """
+
+    def __init__(self, sample_rate: float = MEMORY_PROFILING_SAMPLE_RATE, frames: int = MEMORY_PROFILING_FRAMES,
+                 top: int = MEMORY_PROFILING_TOP, flush_interval: float = MEMORY_PROFILING_FLUSH_INTERVAL):
+        self.sample_rate = sample_rate
+        self.frames = frames
+        self.top = top
+        self.flush_interval = flush_interval
+        self._measuring = threading.Lock()
+        self._lock = threading.Lock()
+        self._views = {}
+        self._flushed_at = 0.0
+        self._started = False
+        self.skipped = 0
+
+    def start(self) -> None:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            self._started = True
+
+    def stop(self) -> None:
+        """ Stops tracemalloc if start() started it, waiting for the request being measured """
+        with self._measuring:
+            if self._started:
+                tracemalloc.stop()
+                self._started = False
+
+    def sites(self, before, after) -> list:
+        """ ('file:line', bytes) of the lines that allocated the most between two snapshots """
+        differences = after.compare_to(before, 'lineno')
+        return [
+            (f'{difference.traceback[0].filename}:{difference.traceback[0].lineno}', difference.size_diff)
+            for difference in differences[:self.top] if difference.size_diff > 0
+        ]
+
+    def begin(self):
+        """ Measurement state of a sampled request, None when it goes unmeasured """
+        if not tracemalloc.is_tracing() or random.random() >= self.sample_rate:
+            return None
+        if not self._measuring.acquire(blocking=False):
+            self.skipped += 1
+            return None
+        try:
+            before = tracemalloc.take_snapshot().filter_traces(_IGNORED) if self.top else None
+            tracemalloc.reset_peak()
+            started, _ = tracemalloc.get_traced_memory()
+        except BaseException:
+            self._measuring.release()
+            raise
+        return before, started
+
+    def end(self, state, request) -> None:
+        """ Records the request begin() returned state for, the lock is released even when the request raised """
+        before, started = state
+        try:
+            current, peak = tracemalloc.get_traced_memory()
+            sites = self.sites(before, tracemalloc.take_snapshot().filter_traces(_IGNORED)) if self.top else []
+        finally:
+            self._measuring.release()
+        # the view is resolved by now
+        name = route_name(request)
+        with self._lock:
+            self._views.setdefault(name, ViewMemory(self.top)).add(peak - started, current - started, sites)
+        self.flush()
+
+    def stats(self) -> dict:
+        current, peak = tracemalloc.get_traced_memory()
+        with self._lock:
+            views = {name: view.snapshot() for name, view in sorted(self._views.items())}
+        return {'tracing': tracemalloc.is_tracing(), 'traced': current, 'traced_peak': peak,
+                'skipped': self.skipped, 'views': views}
+
+    def flush(self, force: bool = False) -> None:
+        """ Publishes the profile of this process to the shared cache every flush_interval seconds """
+        now = time.monotonic()
+        if not force and now - self._flushed_at < self.flush_interval:
+            return
+        self._flushed_at = now
+        cache = caches[MEMORY_PROFILING_CACHE]
+        me = origin()
+        cache.set(PROFILE_KEY.format(origin=me), self.stats(), None)
+        processes = cache.get(PROFILES_KEY) or []
+        if me not in processes:
+            # a process added concurrently is lost until its next flush adds it again
+            cache.set(PROFILES_KEY, processes + [me], None)
+
+
+profiler = MemoryProfiler()
+register_collector('memory', profiler.stats)
+
+
+def collect_profiles() -> dict:
+    """ origin -> profile of every process that published one """
+    cache = caches[MEMORY_PROFILING_CACHE]
+    processes = cache.get(PROFILES_KEY) or []
+    profiles = cache.get_many([PROFILE_KEY.format(origin=process) for process in processes])
+    return {process: profiles[PROFILE_KEY.format(origin=process)]
+            for process in processes if PROFILE_KEY.format(origin=process) in profiles}
+
+
+def clear_profiles() -> None:
+    cache = caches[MEMORY_PROFILING_CACHE]
+    processes = cache.get(PROFILES_KEY) or []
+    cache.delete_many([PROFILE_KEY.format(origin=process) for process in processes] + [PROFILES_KEY])
+
+
+class MemoryProfilingMiddleware(HybridMiddleware):
+    """
+    Profiles the requests with MemoryProfiler, iDjango.settings adds it to MIDDLEWARE when MEMORY_PROFILING is on.
+    Under ASGI the other requests running on the event loop meanwhile are counted too. The response of a
+    streaming view is produced after it returns and is not counted.
+    """
+
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        profiler.start()
+
+    def sync_call(self, request):
+        state = profiler.begin()
+        try:
+            return self.get_response(request)
+        finally:
+            if state is not None:
+                profiler.end(state, request)
+
+    async def async_call(self, request):
+        state = profiler.begin()
+        try:
+            return await self.get_response(request)
+        finally:
+            if state is not None:
+                profiler.end(state, request)
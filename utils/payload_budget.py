@@ -0,0 +1,80 @@
+import logging
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from utils.instrumentation import register_collector
+from iDjango.settings import UPSTREAM_PAYLOAD_BUDGETS
+
+logger = logging.getLogger(__name__)
+
+# Body sizes of the HTTP responses received by the upstream call running in this context
+_response_sizes = ContextVar('response_sizes', default=None)
+
+
+def measure_response(response, *args, **kwargs):
+    """ requests response hook of the upstream sessions (see utils.transport.build_session) """
+    sizes = _response_sizes.get()
+    if sizes is None:
+        return
+    if kwargs.get('stream'):
+        # reading the body here would buffer a stream the caller meant to consume piecewise
+        sizes.append(int(response.headers.get('Content-Length') or 0))
+    else:
+        # the SDKs read the whole body anyway, this only reads it a little earlier
+        sizes.append(len(response.content))
+
+
+@contextmanager
+def measure_payload():
+    """ Collects the response sizes of the block into the yielded list """
+    sizes = []
+    token = _response_sizes.set(sizes)
+    try:
+        yield sizes
+    finally:
+        _response_sizes.reset(token)
+
+
+class PayloadBudgets:
+    """
+    Response sizes per upstream endpoint against the budgets of UPSTREAM_PAYLOAD_BUDGETS
+    ({'plaid': {'budget': bytes, 'endpoints': {'Accounts.get': bytes}}, ...}). A response over its budget is
+    logged as upstream.payload_over_budget and counted, the counts are in the metrics endpoint.
+    """
+
+    def __init__(self, config: dict = None):
+        self.config = UPSTREAM_PAYLOAD_BUDGETS if config is None else config
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def budget(self, upstream: str, endpoint: str):
+        config = self.config.get(upstream, {})
+        return config.get('endpoints', {}).get(endpoint, config.get('budget'))
+
+    def record(self, upstream: str, endpoint: str, size: int) -> None:
+        budget = self.budget(upstream, endpoint)
+        over = budget is not None and size > budget
+        with self._lock:
+            stats = self._stats.setdefault(f'{upstream}.{endpoint}', {
+                'count': 0, 'total_bytes': 0, 'max_bytes': 0, 'over_budget': 0, 'budget_bytes': budget,
+            })
+            stats['count'] += 1
+            stats['total_bytes'] += size
+            stats['max_bytes'] = max(stats['max_bytes'], size)
+            stats['over_budget'] += over
+        if over:
+            logger.warning('upstream.payload_over_budget', extra={
+                'upstream': upstream, 'endpoint': endpoint, 'response_bytes': size, 'budget_bytes': budget,
+            })
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                name: {**stats, 'mean_bytes': round(stats['total_bytes'] / stats['count'])}
+                for name, stats in sorted(self._stats.items())
+            }
+
+
+payload_budgets = PayloadBudgets()
+register_collector('upstream_payloads', payload_budgets.stats)
@@ -0,0 +1,34 @@
+class FieldProjection:
+    """
+    Picks `fields` out of records.
+    Flat projections read top-level keys. Nested ones find each field anywhere in the record the way a
+    recursive search does (nested dicts are descended in order, the last occurrence wins), in one pass that
+    fills a single row per record. Every record is walked on its own: lines of one invoice can differ in shape
+    (a price that is null on one line and expanded on the next, metadata with a 'description').
+    """
+
+    def __init__(self, fields: tuple, nested: bool = False):
+        self.fields = tuple(fields)
+        self.nested = nested
+        self._wanted = frozenset(self.fields)
+
+    def _collect(self, record: dict, row: dict) -> dict:
+        # a stack of iterators instead of recursion, a deeply nested record cannot hit the recursion limit
+        wanted = self._wanted
+        stack = [iter(record.items())]
+        while stack:
+            for key, value in stack[-1]:
+                if isinstance(value, dict):
+                    stack.append(iter(value.items()))
+                    break
+                if key in wanted:
+                    row[key] = value
+            else:
+                stack.pop()
+        return row
+
+    def project(self, records, default='') -> list:
+        if not self.nested:
+            fields = self.fields
+            return [{key: record.get(key, default) for key in fields} for record in records]
+        return [self._collect(record, {}) for record in records]
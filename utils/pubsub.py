@@ -0,0 +1,98 @@
+import asyncio
+import threading
+from contextlib import contextmanager
+
+from utils.instrumentation import register_collector
+from iDjango.settings import EVENT_STREAM_QUEUE_SIZE, EVENT_STREAM_MAX_SUBSCRIBERS
+
+
+class TooManySubscribers(Exception):
+    pass
+
+
+class Subscription:
+    """ Messages of a topic for one subscriber, filled from any thread and read on the subscriber's event loop """
+
+    def __init__(self, loop, queue_size: int):
+        self.loop = loop
+        self.queue = asyncio.Queue(queue_size)
+        self.dropped = 0
+
+    def deliver(self, message) -> None:
+        # runs on self.loop, a subscriber that does not keep up loses its oldest messages
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(message)
+
+    async def get(self):
+        return await self.queue.get()
+
+
+class Broker:
+    """
+    In-process publish/subscribe: publish() can be called from any thread (sync views, workers), subscribers are
+    coroutines on an event loop (ASGI). Only the subscribers of this process are reached.
+    """
+
+    def __init__(self, queue_size: int = EVENT_STREAM_QUEUE_SIZE,
+                 max_subscribers: int = EVENT_STREAM_MAX_SUBSCRIBERS):
+        self.queue_size = queue_size
+        self.max_subscribers = max_subscribers
+        self._lock = threading.Lock()
+        self._topics = {}
+        self._count = 0
+        self.published = 0
+        self.delivered = 0
+        self.rejected = 0
+
+    @contextmanager
+    def subscribe(self, topic: str):
+        """ Subscription to topic while the block runs, has to be entered on the event loop reading it """
+        subscription = Subscription(asyncio.get_running_loop(), self.queue_size)
+        with self._lock:
+            if self._count >= self.max_subscribers:
+                self.rejected += 1
+                raise TooManySubscribers()
+            self._topics.setdefault(topic, set()).add(subscription)
+            self._count += 1
+        try:
+            yield subscription
+        finally:
+            with self._lock:
+                subscribers = self._topics.get(topic, set())
+                subscribers.discard(subscription)
+                if not subscribers:
+                    self._topics.pop(topic, None)
+                self._count -= 1
+
+    def has_subscribers(self, topic: str) -> bool:
+        return topic in self._topics
+
+    def publish(self, topic: str, message) -> int:
+        """ Hands message to the subscribers of topic, returns how many there were """
+        with self._lock:
+            subscribers = tuple(self._topics.get(topic, ()))
+            self.published += 1
+        for subscription in subscribers:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.deliver, message)
+            except RuntimeError:
+                # the loop of a subscriber that went away with it is closed
+                continue
+            self.delivered += 1
+        return len(subscribers)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'topics': len(self._topics),
+                'subscribers': self._count,
+                'published': self.published,
+                'delivered': self.delivered,
+                'rejected': self.rejected,
+            }
+
+
+broker = Broker()
+register_collector('pubsub', broker.stats)
@@ -0,0 +1,191 @@
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from plaid.errors import RateLimitExceededError
+from stripe.error import RateLimitError
+from utils.instrumentation import observe, register_collector
+from iDjango.settings import UPSTREAM_RATE_LIMITS, UPSTREAM_RATE_LIMIT_WAIT, UPSTREAM_RATE_LIMIT_RETRIES, \
+    UPSTREAM_RATE_LIMIT_BACKOFF
+
+# Priority lanes, interactive (checkout) calls go ahead of background ones (webhook workers, pool refills)
+INTERACTIVE = 0
+BACKGROUND = 1
+LANES = ('interactive', 'background')
+
+_lane = ContextVar('upstream_lane', default=INTERACTIVE)
+
+
+class UpstreamRateLimited(Exception):
+    """ No token could be taken within the wait limit, the upstream was not called """
+
+
+@contextmanager
+def lane(priority: int):
+    """ Upstream calls made inside the block are scheduled in the priority lane """
+    token = _lane.set(priority)
+    try:
+        yield
+    finally:
+        _lane.reset(token)
+
+
+def in_lane(priority: int, func):
+    """ func with its upstream calls scheduled in the priority lane """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with lane(priority):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+class TokenBucket:
+    """
+    `rate` calls per second with bursts of up to `burst`. A share of the bucket (background_reserve) can only
+    be taken by interactive calls, and background calls wait while interactive ones are waiting.
+    """
+
+    def __init__(self, rate: float, burst: float, background_reserve: float = 0.2):
+        self.rate = rate
+        self.burst = burst
+        self.reserve = burst * background_reserve
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._waiting = [0, 0]
+        self._condition = threading.Condition()
+        self.granted = [0, 0]
+        self.throttled = [0, 0]
+        self.rejected = [0, 0]
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, priority: int, deadline: float) -> None:
+        """ Takes a token, waits for one until the monotonic deadline at the latest """
+        with self._condition:
+            self._waiting[priority] += 1
+            try:
+                waited = False
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    floor = 0.0 if priority == INTERACTIVE else self.reserve
+                    ahead = priority == BACKGROUND and self._waiting[INTERACTIVE]
+                    if now >= self._blocked_until and self._tokens - floor >= 1 and not ahead:
+                        self._tokens -= 1
+                        self.granted[priority] += 1
+                        self.throttled[priority] += waited
+                        return
+                    if now >= deadline:
+                        self.rejected[priority] += 1
+                        raise UpstreamRateLimited()
+                    wait = max(self._blocked_until - now, (1 + floor - self._tokens) / self.rate, 0.001)
+                    waited = True
+                    self._condition.wait(min(wait, deadline - now))
+            finally:
+                self._waiting[priority] -= 1
+                self._condition.notify_all()
+
+    def block(self, seconds: float) -> None:
+        """ Nothing is let through for `seconds` (Retry-After of a 429) """
+        with self._condition:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+            self._tokens = min(self._tokens, 0.0)
+
+    def stats(self) -> dict:
+        with self._condition:
+            self._refill(time.monotonic())
+            return {
+                'rate': self.rate,
+                'burst': self.burst,
+                'tokens': round(self._tokens, 2),
+                'blocked_for': round(max(0.0, self._blocked_until - time.monotonic()), 3),
+                **{f'{name}_{counter}': values[priority]
+                   for counter, values in (('waiting', self._waiting), ('granted', self.granted),
+                                           ('throttled', self.throttled), ('rejected', self.rejected))
+                   for priority, name in enumerate(LANES)},
+            }
+
+
+class UpstreamScheduler:
+    """
+    Token buckets per upstream and per endpoint, configured by UPSTREAM_RATE_LIMITS:
+    {'stripe': {'rate': 20, 'burst': 40, 'endpoints': {'Invoice.pay': {'rate': 5, 'burst': 10}}}, ...}
+    Limits apply per process, so they have to be divided by the number of worker processes.
+    """
+
+    def __init__(self, limits: dict = UPSTREAM_RATE_LIMITS, max_wait: float = UPSTREAM_RATE_LIMIT_WAIT):
+        self.max_wait = max_wait
+        self.buckets = {}
+        for upstream, config in limits.items():
+            self.buckets[upstream] = TokenBucket(config['rate'], config['burst'])
+            for endpoint, endpoint_config in config.get('endpoints', {}).items():
+                self.buckets[f'{upstream}.{endpoint}'] = TokenBucket(endpoint_config['rate'], endpoint_config['burst'])
+
+    def _buckets_of(self, upstream: str, endpoint: str) -> list:
+        # the endpoint token is taken first, so waiting on it does not hold an upstream token
+        names = (f'{upstream}.{endpoint}', upstream)
+        return [self.buckets[name] for name in names if name in self.buckets]
+
+    def acquire(self, upstream: str, endpoint: str) -> None:
+        buckets = self._buckets_of(upstream, endpoint)
+        if not buckets:
+            return
+        priority = _lane.get()
+        started = time.monotonic()
+        deadline = started + self.max_wait
+        try:
+            for bucket in buckets:
+                bucket.acquire(priority, deadline)
+        finally:
+            observe(f'rate_limit_wait.{upstream}.{LANES[priority]}', (time.monotonic() - started) * 1000)
+
+    def block(self, upstream: str, seconds: float) -> bool:
+        bucket = self.buckets.get(upstream)
+        if bucket is None:
+            return False
+        bucket.block(seconds)
+        return True
+
+    def stats(self) -> dict:
+        return {name: bucket.stats() for name, bucket in self.buckets.items()}
+
+
+def retry_after(error: Exception):
+    """ Seconds to wait before calling again if error is a 429 from Stripe or Plaid, None otherwise """
+    if not isinstance(error, (RateLimitError, RateLimitExceededError)) and getattr(error, 'http_status', None) != 429:
+        return None
+    # stripe errors carry the response headers, PooledPlaidClient sets retry_after on its errors
+    headers = getattr(error, 'headers', None) or {}
+    value = getattr(error, 'retry_after', None) or headers.get('retry-after') or headers.get('Retry-After')
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return UPSTREAM_RATE_LIMIT_BACKOFF
+
+
+def is_rate_limited(error: Exception) -> bool:
+    """ The call was turned away by a token bucket or a 429, which says nothing about the health of the upstream """
+    return isinstance(error, UpstreamRateLimited) or retry_after(error) is not None
+
+
+scheduler = UpstreamScheduler()
+register_collector('rate_limits', scheduler.stats)
+
+
+def call_with_rate_limit(upstream: str, endpoint: str, func, *args, **kwargs):
+    """ Waits for a token, and on a 429 blocks the upstream for Retry-After and tries again """
+    for attempt in range(UPSTREAM_RATE_LIMIT_RETRIES + 1):
+        scheduler.acquire(upstream, endpoint)
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            delay = retry_after(e)
+            if delay is None or delay > scheduler.max_wait or attempt == UPSTREAM_RATE_LIMIT_RETRIES:
+                raise
+            if not scheduler.block(upstream, delay):
+                time.sleep(delay)
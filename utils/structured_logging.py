@@ -0,0 +1,188 @@
+import json
+import logging
+import os
+import queue
+import random
+import re
+import sys
+import time
+import uuid
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
+
+from utils.concurrency import HybridMiddleware
+from utils.instrumentation import register_collector
+from iDjango.settings import LOG_SAMPLE_RATES, LOG_QUEUE_SIZE
+
+_request_id = ContextVar('request_id', default=None)
+
+# Attributes every LogRecord has, anything else on a record came in through `extra`
+_RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+_VALID_REQUEST_ID = re.compile(r'^[A-Za-z0-9._:-]{1,64}$')
+
+logger = logging.getLogger(__name__)
+
+# BackgroundHandlers and SamplingFilters created by the logging configuration, for the metrics endpoint
+handlers = []
+sampling_filters = []
+
+
+def request_id():
+    return _request_id.get()
+
+
+def set_request_id(value: str):
+    """ Records logged in this context carry value as request_id, returns the token to reset it """
+    return _request_id.set(value)
+
+
+def reset_request_id(token) -> None:
+    _request_id.reset(token)
+
+
+class JsonFormatter(logging.Formatter):
+    """ One JSON object per record: time, level, logger, event (the message), request_id and the `extra` fields """
+
+    def format(self, record) -> str:
+        entry = {
+            'time': round(record.created, 6),
+            'level': record.levelname,
+            'logger': record.name,
+            'event': record.getMessage(),
+        }
+        entry.update((key, value) for key, value in vars(record).items() if key not in _RECORD_ATTRIBUTES)
+        if record.exc_info:
+            entry.setdefault('error_class', record.exc_info[0].__name__)
+            entry['error'] = str(record.exc_info[1])
+            entry['traceback'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps the records of the events in `rates` ({'upstream.call': 0.01, ...}) at that rate and marks them with
+    sample_rate, records of other events are all kept
+    """
+
+    def __init__(self, rates: dict = None):
+        super().__init__()
+        self.rates = LOG_SAMPLE_RATES if rates is None else rates
+        self.dropped = 0
+        sampling_filters.append(self)
+
+    def filter(self, record) -> bool:
+        rate = self.rates.get(record.msg)
+        if rate is None:
+            return True
+        if random.random() >= rate:
+            self.dropped += 1
+            return False
+        record.sample_rate = rate
+        return True
+
+
+class BackgroundHandler(QueueHandler):
+    """
+    Puts records on a bounded queue, a QueueListener thread formats them and writes them to `stream`.
+    The logging thread only pays for building the record, when the queue is full records are dropped
+    instead of waiting for the writer. A forked worker gets its own queue and listener.
+    """
+
+    def __init__(self, stream=None, queue_size: int = LOG_QUEUE_SIZE):
+        super().__init__(queue.Queue(queue_size))
+        self.sink = logging.StreamHandler(stream or sys.stderr)
+        self.listener = QueueListener(self.queue, self.sink, respect_handler_level=True)
+        self.listener.start()
+        self.dropped = 0
+        handlers.append(self)
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self) -> None:
+        # the listener thread is not copied into the child, its records would stay queued: the child starts its
+        # own listener on a new queue, what the parent had queued is written by the parent
+        if self not in handlers:
+            return
+        self.queue = queue.Queue(self.queue.maxsize)
+        self.listener = QueueListener(self.queue, self.sink, respect_handler_level=True)
+        self.listener.start()
+        self.dropped = 0
+
+    def setFormatter(self, fmt) -> None:
+        # records are formatted in the listener thread
+        self.sink.setFormatter(fmt)
+
+    def prepare(self, record):
+        # the message and the request id are taken now, formatting (and the traceback) is left to the listener
+        record.msg = record.getMessage()
+        record.args = None
+        if getattr(record, 'request_id', None) is None:
+            record.request_id = _request_id.get()
+        return record
+
+    def enqueue(self, record) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self) -> None:
+        # logging.shutdown closes the handler at exit, the listener writes out what is queued before it stops
+        if self in handlers:
+            handlers.remove(self)
+            self.listener.stop()
+        super().close()
+
+    def stats(self) -> dict:
+        return {'queued': self.queue.qsize(), 'dropped': self.dropped}
+
+
+def logging_stats() -> dict:
+    return {
+        'handlers': [handler.stats() for handler in handlers],
+        'sampled_out': sum(log_filter.dropped for log_filter in sampling_filters),
+    }
+
+
+register_collector('logging', logging_stats)
+
+
+class RequestIdMiddleware(HybridMiddleware):
+    """
+    Gives every request an id (the X-Request-ID header when the proxy sends a usable one), records logged while
+    it is handled carry it. Logs a sampled 'request' event with status and latency.
+    """
+
+    def sync_call(self, request):
+        value, token, started = self.start(request)
+        try:
+            response = self.get_response(request)
+            self.log(request, response, started)
+        finally:
+            reset_request_id(token)
+        response['X-Request-ID'] = value
+        return response
+
+    async def async_call(self, request):
+        value, token, started = self.start(request)
+        try:
+            response = await self.get_response(request)
+            self.log(request, response, started)
+        finally:
+            reset_request_id(token)
+        response['X-Request-ID'] = value
+        return response
+
+    @staticmethod
+    def start(request) -> tuple:
+        incoming = request.META.get('HTTP_X_REQUEST_ID', '')
+        value = incoming if _VALID_REQUEST_ID.match(incoming) else uuid.uuid4().hex
+        return value, set_request_id(value), time.perf_counter()
+
+    @staticmethod
+    def log(request, response, started: float) -> None:
+        logger.info('request', extra={
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'latency_ms': round((time.perf_counter() - started) * 1000, 3),
+        })
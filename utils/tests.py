@@ -0,0 +1,806 @@
+import asyncio
+import http.server
+import io
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import tracemalloc
+from unittest import mock, skipUnless
+
+import requests
+import stripe
+from asgiref.sync import async_to_sync
+from plaid.errors import PlaidError
+from django.contrib.sessions.backends.base import UpdateError
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, override_settings
+from django.urls import path
+
+from utils import cache, circuit_breaker, concurrency, instrumentation, json_fast, lean_endpoints, rate_limit, \
+    memory_profiling, payload_budget, pubsub, structured_logging, transport, upstream
+from utils.checkout_session import SessionStore
+from utils.projection import FieldProjection
+
+LINE_FIELDS = ('quantity', 'description', 'unit_amount')
+
+
+def search(line: dict) -> dict:
+    """ The recursive line search FieldProjection replaced """
+    result = {}
+    for key, value in line.items():
+        if isinstance(value, dict):
+            result.update(search(value))
+        elif key in LINE_FIELDS:
+            result.update({key: value})
+    return result
+
+
+class FieldProjectionTests(SimpleTestCase):
+    def test_nested_matches_recursive_search_on_mixed_shapes(self):
+        lines = [
+            {'id': 'il_1', 'quantity': 1, 'description': 'Plan', 'price': None},
+            {'id': 'il_2', 'quantity': 2, 'description': 'Seat', 'price': {'id': 'price_1', 'unit_amount': 200}},
+            {'id': 'il_3', 'quantity': 3, 'description': 'Seat', 'metadata': {'description': 'from metadata'},
+             'price': {'unit_amount': 300, 'recurring': {'interval': 'month'}}},
+            {'id': 'il_4', 'price': {'unit_amount': 400}, 'quantity': 4},
+            {'id': 'il_5', 'quantity': 5, 'description': 'Seat', 'price': {'id': 'price_1', 'unit_amount': 500}},
+            {'id': 'il_6', 'quantity': {'value': 6}, 'description': None},
+        ]
+        projected = FieldProjection(LINE_FIELDS, nested=True).project(lines)
+        self.assertEqual(projected, [search(line) for line in lines])
+        self.assertEqual(projected[1]['unit_amount'], 200)
+        self.assertEqual(projected[2]['description'], 'from metadata')
+
+    def test_deeply_nested_record_does_not_hit_the_recursion_limit(self):
+        record = {'quantity': 1}
+        for depth in range(5000):
+            record = {'metadata': record, 'description': f'level {depth}'}
+        record['unit_amount'] = 100
+        projected = FieldProjection(LINE_FIELDS, nested=True).project([record])
+        self.assertEqual(projected, [{'quantity': 1, 'description': 'level 4999', 'unit_amount': 100}])
+
+    def test_flat_reads_top_level_keys_with_default(self):
+        records = [{'account_id': 'a', 'name': 'Checking', 'balances': {'mask': 'x'}}]
+        self.assertEqual(
+            FieldProjection(('account_id', 'mask')).project(records, default=''),
+            [{'account_id': 'a', 'mask': ''}],
+        )
+
+
+class JsonFastExtractTests(SimpleTestCase):
+    paths = {'status': ('data', 'object', 'status'), 'type': ('type',)}
+
+    def test_backends_agree_on_objects(self):
+        raw = b'{"type": "invoice.paid", "data": {"object": {"status": "paid", "lines": [1, 2]}}}'
+        for backend in json_fast.available_backends():
+            with self.subTest(backend=backend):
+                self.assertEqual(
+                    json_fast.extract(raw, self.paths, 1024, backend=backend),
+                    {'status': 'paid', 'type': 'invoice.paid'},
+                )
+
+    def test_non_object_root_has_no_fields(self):
+        for backend in json_fast.available_backends():
+            for raw in (b'"x"', b'null', b'1', b'[{"type": "invoice.paid"}]'):
+                with self.subTest(backend=backend, raw=raw):
+                    self.assertEqual(
+                        json_fast.extract(raw, self.paths, 1024, backend=backend),
+                        {'status': None, 'type': None},
+                    )
+
+    def test_invalid_and_oversized_payloads(self):
+        for backend in json_fast.available_backends():
+            with self.subTest(backend=backend):
+                with self.assertRaises(ValueError):
+                    json_fast.extract(b'{"type": ', self.paths, 1024, backend=backend)
+                with self.assertRaises(json_fast.PayloadTooLarge):
+                    json_fast.extract(b'{"type": "x"}', self.paths, 4, backend=backend)
+
+
+class FakeClock:
+    """ Stands in for the time module, monotonic and wall clock move together """
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def time(self) -> float:
+        return self.now
+
+
+@mock.patch.object(cache, '_first_store_hooks', [])
+class TTLLRUCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch.object(cache, 'time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(caches['default'].clear)
+
+    def test_entries_expire_after_ttl_and_stay_stale_for_stale_ttl(self):
+        store = cache.TTLLRUCache('tests.ttl', max_size=10, ttl=30, stale_ttl=60)
+        store.set('in_1', 'context')
+        self.clock.now += 29
+        self.assertEqual(store.get('in_1'), 'context')
+        self.clock.now += 2
+        self.assertIsNone(store.get('in_1'))
+        self.assertEqual(store.get_stale('in_1'), 'context')
+        self.clock.now += 60
+        self.assertIsNone(store.get('in_1'))
+        self.assertIsNone(store.get_stale('in_1'))
+        self.assertEqual(store.stats()['hits'], 1)
+
+    def test_least_recently_used_entry_is_evicted(self):
+        store = cache.TTLLRUCache('tests.lru', max_size=2, ttl=30)
+        store.set('a', 1)
+        store.set('b', 2)
+        store.get('a')
+        store.set('c', 3)
+        self.assertEqual((store.get('a'), store.get('b'), store.get('c')), (1, None, 3))
+
+    def test_backend_hit_keeps_the_remaining_ttl(self):
+        writer = cache.TTLLRUCache('tests.l2', max_size=10, ttl=30, backend_alias='default')
+        reader = cache.TTLLRUCache('tests.l2', max_size=10, ttl=30, backend_alias='default')
+        writer.set('in_1', 'context')
+        self.clock.now += 20
+        self.assertEqual(reader.get('in_1'), 'context')
+        self.assertEqual(reader.stats()['backend_hits'], 1)
+        self.clock.now += 11
+        self.assertIsNone(reader.get('in_1'))
+
+    def test_hashed_backend_keys_do_not_contain_the_key(self):
+        store = cache.TTLLRUCache('tests.hashed', max_size=10, ttl=30, backend_alias='default', hash_keys=True)
+        store.set('access-sandbox-secret', ['account'])
+        self.assertIsNone(caches['default'].get('tests.hashed:access-sandbox-secret'))
+        self.assertNotIn('secret', store._backend_key('access-sandbox-secret'))
+        store.drop_local('access-sandbox-secret')
+        self.assertEqual(store.get('access-sandbox-secret'), ['account'])
+
+    def test_invalidate_drops_both_tiers(self):
+        store = cache.TTLLRUCache('tests.invalidate', max_size=10, ttl=30, backend_alias='default')
+        store.set('in_1', 'context')
+        store.invalidate('in_1')
+        self.assertIsNone(store.get('in_1'))
+
+
+class SingleFlightTests(SimpleTestCase):
+    def test_concurrent_callers_share_one_load(self):
+        flight = cache.SingleFlight()
+        started, release = threading.Event(), threading.Event()
+        calls = []
+
+        def loader():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return 'accounts'
+
+        results = []
+        leader = threading.Thread(target=lambda: results.append(flight.do('token', loader)))
+        leader.start()
+        started.wait(5)
+        followers = [threading.Thread(target=lambda: results.append(flight.do('token', loader))) for _ in range(3)]
+        for follower in followers:
+            follower.start()
+        while flight.coalesced < 3:
+            time.sleep(0.001)
+        release.set()
+        for thread in [leader, *followers]:
+            thread.join(5)
+        self.assertEqual((results, len(calls)), (['accounts'] * 4, 1))
+        # the next call loads again
+        self.assertEqual(flight.do('token', lambda: 'fresh'), 'fresh')
+
+    def test_error_is_raised_and_not_kept(self):
+        flight = cache.SingleFlight()
+        with self.assertRaises(ValueError):
+            flight.do('token', mock.Mock(side_effect=ValueError('upstream down')))
+        self.assertEqual(flight.do('token', lambda: 'recovered'), 'recovered')
+
+
+class TokenBucketTests(SimpleTestCase):
+    def test_background_calls_leave_the_reserve_to_interactive_ones(self):
+        bucket = rate_limit.TokenBucket(rate=0.001, burst=5, background_reserve=0.2)
+        for _ in range(4):
+            bucket.acquire(rate_limit.BACKGROUND, deadline=time.monotonic())
+        with self.assertRaises(rate_limit.UpstreamRateLimited):
+            bucket.acquire(rate_limit.BACKGROUND, deadline=time.monotonic())
+        bucket.acquire(rate_limit.INTERACTIVE, deadline=time.monotonic())
+        stats = bucket.stats()
+        self.assertEqual((stats['background_granted'], stats['background_rejected']), (4, 1))
+        self.assertEqual(stats['interactive_granted'], 1)
+
+    def test_waiting_interactive_call_goes_first(self):
+        bucket = rate_limit.TokenBucket(rate=20, burst=1, background_reserve=0)
+        bucket.acquire(rate_limit.INTERACTIVE, deadline=time.monotonic())
+        granted = []
+
+        def take(priority: int):
+            bucket.acquire(priority, deadline=time.monotonic() + 2)
+            granted.append(rate_limit.LANES[priority])
+
+        interactive = threading.Thread(target=take, args=(rate_limit.INTERACTIVE,))
+        interactive.start()
+        while not bucket.stats()['interactive_waiting']:
+            time.sleep(0.001)
+        background = threading.Thread(target=take, args=(rate_limit.BACKGROUND,))
+        background.start()
+        interactive.join(5)
+        background.join(5)
+        self.assertEqual(granted, ['interactive', 'background'])
+        self.assertEqual(bucket.stats()['background_throttled'], 1)
+
+    def test_blocked_bucket_lets_nothing_through(self):
+        bucket = rate_limit.TokenBucket(rate=100, burst=10)
+        bucket.block(60)
+        with self.assertRaises(rate_limit.UpstreamRateLimited):
+            bucket.acquire(rate_limit.INTERACTIVE, deadline=time.monotonic() + 0.05)
+
+    def test_lane_schedules_the_calls_made_inside_it(self):
+        scheduler = rate_limit.UpstreamScheduler(
+            {'stripe': {'rate': 100, 'burst': 10, 'endpoints': {'Invoice.modify': {'rate': 100, 'burst': 10}}}},
+        )
+        with rate_limit.lane(rate_limit.BACKGROUND):
+            scheduler.acquire('stripe', 'Invoice.modify')
+        scheduler.acquire('stripe', 'Invoice.retrieve')
+        stats = scheduler.stats()
+        self.assertEqual(stats['stripe.Invoice.modify']['background_granted'], 1)
+        self.assertEqual((stats['stripe']['background_granted'], stats['stripe']['interactive_granted']), (1, 1))
+
+    def test_rate_limited_call_is_retried_after_retry_after(self):
+        call = mock.Mock(side_effect=[stripe.error.RateLimitError('slow down', headers={'Retry-After': '0'}), 'ok'])
+        self.assertEqual(rate_limit.call_with_rate_limit('stripe', 'Invoice.retrieve', call), 'ok')
+        self.assertEqual(call.call_count, 2)
+
+
+class LazyUpstreamProxyTests(SimpleTestCase):
+    def test_client_is_built_once_by_the_first_call(self):
+        sdk = mock.Mock()
+        sdk.Invoice.retrieve.return_value = {'id': 'in_1'}
+        factory = mock.Mock(side_effect=lambda: time.sleep(0.01) or sdk)
+        proxy = upstream.LazyUpstreamProxy(factory, upstream='stripe')
+        factory.assert_not_called()
+
+        with mock.patch.object(upstream, 'call_upstream', side_effect=lambda name, endpoint, func, *args: (
+                (name, endpoint, func(*args)))):
+            results = []
+            threads = [threading.Thread(target=lambda: results.append(proxy.Invoice.retrieve('in_1')))
+                       for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(5)
+        self.assertEqual(factory.call_count, 1)
+        self.assertEqual(results, [('stripe', 'Invoice.retrieve', {'id': 'in_1'})] * 4)
+
+    def test_dunder_lookups_do_not_build_the_client(self):
+        factory = mock.Mock()
+        proxy = upstream.LazyUpstreamProxy(factory, upstream='plaid')
+        self.assertFalse(hasattr(proxy, '__wrapped__'))
+        factory.assert_not_called()
+
+
+class CircuitBreakerTests(SimpleTestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch.object(circuit_breaker, 'time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.breaker = circuit_breaker.CircuitBreaker(
+            'stripe', failure_rate=0.5, minimum_calls=4, window=30, open_seconds=15, half_open_calls=1,
+        )
+
+    def fail(self, error: Exception = None):
+        with self.assertRaises(Exception):
+            self.breaker.call(mock.Mock(side_effect=error or stripe.error.APIConnectionError('reset')))
+
+    def test_opens_at_the_failure_rate_once_enough_calls_were_made(self):
+        self.fail()
+        self.fail()
+        self.fail()
+        self.assertEqual(self.breaker.state, circuit_breaker.CLOSED)
+        self.breaker.call(lambda: 'ok')
+        self.fail()
+        self.assertEqual(self.breaker.state, circuit_breaker.OPEN)
+        with self.assertRaises(circuit_breaker.CircuitOpenError):
+            self.breaker.call(mock.Mock())
+        self.assertEqual(self.breaker.stats()['rejected'], 1)
+
+    def test_request_errors_and_old_calls_do_not_count(self):
+        for _ in range(4):
+            self.fail(stripe.error.CardError('declined', None, 'card_declined'))
+        self.assertEqual(self.breaker.state, circuit_breaker.CLOSED)
+        self.fail()
+        self.fail()
+        self.clock.now += 31
+        self.breaker.call(lambda: 'ok')
+        self.fail()
+        self.assertEqual(self.breaker.state, circuit_breaker.CLOSED)
+
+    def test_probe_closes_or_reopens_the_breaker(self):
+        for _ in range(4):
+            self.fail()
+        self.clock.now += 15
+        self.fail()
+        self.assertEqual(self.breaker.state, circuit_breaker.OPEN)
+        self.clock.now += 15
+        self.assertEqual(self.breaker.call(lambda: 'ok'), 'ok')
+        self.assertEqual(self.breaker.state, circuit_breaker.CLOSED)
+
+    def test_half_open_breaker_lets_one_probe_through(self):
+        for _ in range(4):
+            self.fail()
+        self.clock.now += 15
+        self.breaker.allow()
+        with self.assertRaises(circuit_breaker.CircuitOpenError):
+            self.breaker.allow()
+
+    def test_rate_limited_calls_are_not_counted(self):
+        self.fail(rate_limit.UpstreamRateLimited('stripe'))
+        self.fail(stripe.error.RateLimitError('slow down', http_status=429))
+        self.assertEqual(self.breaker.stats()['calls_in_window'], 0)
+        for _ in range(2):
+            self.fail()
+        self.breaker.call(lambda: 'ok')
+        self.fail()
+        self.assertEqual(self.breaker.state, circuit_breaker.OPEN)
+        # a probe turned away by the rate limiter leaves its place to the next call
+        self.clock.now += 15
+        self.fail(rate_limit.UpstreamRateLimited('stripe'))
+        self.assertEqual(self.breaker.call(lambda: 'ok'), 'ok')
+        self.assertEqual(self.breaker.state, circuit_breaker.CLOSED)
+
+
+@override_settings(SESSION_CACHE_ALIAS='default')
+class CheckoutSessionStoreTests(SimpleTestCase):
+    def setUp(self):
+        self.addCleanup(caches['default'].clear)
+        session = SessionStore()
+        session.update({'invoice_id': 'in_1', 'link_token': 'link-1', 'next': '/payment/'})
+        session.save()
+        self.session_key = session.session_key
+
+    def test_session_round_trips_checkout_and_other_keys(self):
+        session = SessionStore(self.session_key)
+        self.assertEqual(dict(session.items()), {'invoice_id': 'in_1', 'link_token': 'link-1', 'next': '/payment/'})
+
+    def test_unchanged_session_is_not_written(self):
+        session = SessionStore(self.session_key)
+        session['invoice_id'] = 'in_1'
+        with mock.patch.object(session._cache, 'set') as cache_set:
+            session.save()
+        cache_set.assert_not_called()
+        session['account_id'] = 'acc_1'
+        session.save()
+        self.assertEqual(SessionStore(self.session_key)['account_id'], 'acc_1')
+
+    def test_session_deleted_meanwhile_is_not_saved_again(self):
+        session = SessionStore(self.session_key)
+        session['account_id'] = 'acc_1'
+        SessionStore(self.session_key).delete()
+        with self.assertRaises(UpdateError):
+            session.save()
+        self.assertFalse(SessionStore().exists(self.session_key))
+
+
+class MetricsViewTests(SimpleTestCase):
+    view = staticmethod(instrumentation.MetricsView.as_view())
+
+    def get(self, **headers):
+        return self.view(RequestFactory().get('/metrics/', **headers))
+
+    def test_metrics_need_the_token(self):
+        with mock.patch.object(instrumentation, 'METRICS_API_TOKEN', 'metrics-token'):
+            self.assertEqual(self.get().status_code, 403)
+            self.assertEqual(self.get(HTTP_AUTHORIZATION='Bearer other').status_code, 403)
+            response = self.get(HTTP_AUTHORIZATION='Bearer metrics-token')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('timings', json.loads(response.content))
+
+    def test_metrics_are_off_without_a_token(self):
+        with mock.patch.object(instrumentation, 'METRICS_API_TOKEN', ''):
+            self.assertEqual(self.get(HTTP_AUTHORIZATION='Bearer ').status_code, 403)
+
+
+class BackgroundHandlerTests(SimpleTestCase):
+    def handler(self, stream, queue_size: int = 10) -> logging.Logger:
+        handler = structured_logging.BackgroundHandler(stream, queue_size=queue_size)
+        handler.setFormatter(structured_logging.JsonFormatter())
+        self.addCleanup(handler.close)
+        test_logger = logging.Logger('checkout.test')
+        test_logger.addHandler(handler)
+        return test_logger
+
+    def test_records_are_written_as_json(self):
+        stream = io.StringIO()
+        test_logger = self.handler(stream)
+        token = structured_logging.set_request_id('req-1')
+        try:
+            test_logger.warning('invoice.%s', 'read', extra={'invoice_id': 'in_1'})
+        finally:
+            structured_logging.reset_request_id(token)
+        test_logger.handlers[0].close()
+        entry = json.loads(stream.getvalue())
+        self.assertEqual({key: entry[key] for key in ('level', 'logger', 'event', 'invoice_id', 'request_id')}, {
+            'level': 'WARNING', 'logger': 'checkout.test', 'event': 'invoice.read', 'invoice_id': 'in_1',
+            'request_id': 'req-1',
+        })
+
+    def test_records_over_the_queue_size_are_dropped(self):
+        stream = io.StringIO()
+        test_logger = self.handler(stream, queue_size=2)
+        handler = test_logger.handlers[0]
+        # nothing is written while the listener is stopped
+        handler.listener.stop()
+        for number in range(5):
+            test_logger.warning('event %d', number)
+        self.assertEqual(handler.stats(), {'queued': 2, 'dropped': 3})
+        self.assertIn(handler.stats(), structured_logging.logging_stats()['handlers'])
+        handler.listener.start()
+        handler.close()
+        self.assertEqual([json.loads(line)['event'] for line in stream.getvalue().splitlines()], ['event 0', 'event 1'])
+
+    @skipUnless(hasattr(os, 'fork'), 'needs os.fork')
+    def test_forked_worker_writes_its_records(self):
+        with tempfile.TemporaryFile('w+') as stream:
+            test_logger = self.handler(stream)
+            pid = os.fork()
+            if not pid:
+                try:
+                    test_logger.warning('child')
+                    test_logger.handlers[0].close()
+                finally:
+                    os._exit(0)
+            os.waitpid(pid, 0)
+            stream.seek(0)
+            self.assertEqual([json.loads(line)['event'] for line in stream.read().splitlines()], ['child'])
+
+
+class UpstreamPoolTests(SimpleTestCase):
+    def test_pool_threads_close_their_database_connections(self):
+        events = []
+        with mock.patch.object(concurrency, 'close_old_connections', lambda: events.append('close')):
+            concurrency.gather_upstream({'snapshot': lambda: events.append('call')})
+            self.assertEqual(events, ['close', 'call', 'close'])
+            events.clear()
+            list(concurrency.map_upstream(lambda item: events.append('call'), range(1), window=2))
+            self.assertEqual(events, ['close', 'call', 'close'])
+
+    def single_thread_pool(self) -> threading.Event:
+        """ Runs the upstream calls one at a time, the first one holds the thread until the returned event is set """
+        release = threading.Event()
+        executor = concurrency.ThreadPoolExecutor(max_workers=1)
+        patcher = mock.patch.object(concurrency, 'upstream_executor', executor)
+        patcher.start()
+        self.addCleanup(executor.shutdown)
+        self.addCleanup(release.set)
+        self.addCleanup(patcher.stop)
+        return release
+
+    def test_slow_call_times_out_and_queued_calls_are_cancelled(self):
+        release = self.single_thread_pool()
+        ran = []
+        results = concurrency.gather_upstream({
+            'slow': lambda: release.wait(),
+            'queued': lambda: ran.append('queued'),
+        }, timeout=0.05)
+        self.assertEqual(results, {
+            'slow': {'error': 'upstream call timed out'}, 'queued': {'error': 'upstream call timed out'},
+        })
+        release.set()
+        concurrency.upstream_executor.shutdown()
+        self.assertEqual(ran, [])
+
+    def test_error_cancels_the_calls_not_finished(self):
+        release = self.single_thread_pool()
+
+        def fail():
+            raise stripe.error.APIConnectionError('reset')
+
+        results = concurrency.gather_upstream({'fail': fail, 'queued': release.wait})
+        self.assertIsInstance(results['fail']['error'], stripe.error.APIConnectionError)
+        self.assertEqual(results['queued'], {'error': 'upstream call was cancelled'})
+
+    def test_async_gather_reports_like_gather(self):
+        release = self.single_thread_pool()
+        ran = []
+
+        async def gather(calls: dict, timeout: float = 1) -> dict:
+            return await concurrency.async_gather_upstream(calls, timeout=timeout)
+
+        results = async_to_sync(gather)({'fast': lambda: 1, 'error': lambda: {'error': 'declined'}})
+        self.assertEqual(results, {'fast': 1, 'error': {'error': 'declined'}})
+        results = async_to_sync(gather)({'slow': release.wait, 'queued': lambda: ran.append('queued')}, 0.05)
+        self.assertEqual(results, {
+            'slow': {'error': 'upstream call timed out'}, 'queued': {'error': 'upstream call timed out'},
+        })
+        release.set()
+        concurrency.upstream_executor.shutdown()
+        self.assertEqual(ran, [])
+
+
+seen = []
+
+
+class RecordingMiddleware(concurrency.HybridMiddleware):
+    """ Appends its name to `seen` when it is called and when its process_view runs """
+    name = ''
+
+    def sync_call(self, request):
+        seen.append(self.name)
+        return self.get_response(request)
+
+    async def async_call(self, request):
+        seen.append(self.name)
+        return await self.get_response(request)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        seen.append(f'{self.name}.process_view')
+
+
+class OuterMiddleware(RecordingMiddleware):
+    name = 'outer'
+
+
+class InnerMiddleware(RecordingMiddleware):
+    name = 'inner'
+
+
+class LeanMiddleware(RecordingMiddleware):
+    name = 'lean'
+
+
+urlpatterns = [
+    path('lean/', lean_endpoints.lean_endpoint(lambda request: HttpResponse('lean'))),
+    path('full/', lambda request: HttpResponse('full')),
+]
+
+
+@override_settings(ROOT_URLCONF='utils.tests', MIDDLEWARE=[
+    'utils.tests.OuterMiddleware', 'utils.lean_endpoints.LeanEndpointMiddleware', 'utils.tests.InnerMiddleware',
+])
+@mock.patch.object(lean_endpoints, 'LEAN_ENDPOINT_MIDDLEWARE', ['utils.tests.LeanMiddleware'])
+class LeanEndpointMiddlewareTests(SimpleTestCase):
+    lean = ['outer', 'lean', 'lean.process_view']
+    full = ['outer', 'inner', 'outer.process_view', 'inner.process_view']
+
+    def setUp(self):
+        lean_endpoints.lean_match.cache_clear()
+        self.addCleanup(lean_endpoints.lean_match.cache_clear)
+        self.addCleanup(seen.clear)
+
+    def served(self, response) -> list:
+        self.assertEqual(response.status_code, 200)
+        served = list(seen)
+        seen.clear()
+        return served
+
+    def test_lean_endpoints_skip_the_middleware_after_it(self):
+        self.assertEqual(self.served(self.client.get('/lean/')), self.lean)
+        self.assertEqual(self.served(self.client.get('/full/')), self.full)
+
+    async def test_lean_endpoints_skip_the_middleware_after_it_under_asgi(self):
+        self.assertEqual(self.served(await self.async_client.get('/lean/')), self.lean)
+        self.assertEqual(self.served(await self.async_client.get('/full/')), self.full)
+
+    def test_lean_chain_is_lean_endpoint_middleware(self):
+        def chain(middleware) -> list:
+            handler, names = middleware._lean_response, []
+            while hasattr(handler, 'get_response'):
+                names.append(f'{type(handler).__module__}.{type(handler).__name__}')
+                handler = handler.get_response
+            return names
+
+        async def get_response(request):
+            pass
+
+        with mock.patch.object(lean_endpoints, 'LEAN_ENDPOINT_MIDDLEWARE', settings.LEAN_ENDPOINT_MIDDLEWARE):
+            for response in (lambda request: None, get_response):
+                middleware = lean_endpoints.LeanEndpointMiddleware(response)
+                self.assertEqual(chain(middleware), settings.LEAN_ENDPOINT_MIDDLEWARE)
+
+
+class ScriptedPlaid(http.server.BaseHTTPRequestHandler):
+    """ Answers with the next status of the server's `statuses` (200 once they run out), recording the paths """
+    protocol_version = 'HTTP/1.1'
+    error = {'error_type': 'API_ERROR', 'error_code': 'INTERNAL_SERVER_ERROR', 'error_message': 'down',
+             'display_message': None, 'request_id': 'req-1', 'causes': []}
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.server.paths.append(self.path)
+        status = self.server.statuses.pop(0) if self.server.statuses else 200
+        if status == 200:
+            body = {'request_id': 'req-1'}
+        elif status == 429:
+            body = {**self.error, 'error_type': 'RATE_LIMIT_EXCEEDED', 'error_code': 'ACCOUNTS_LIMIT'}
+        else:
+            body = self.error
+        body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        if status == 429:
+            self.send_header('Retry-After', '1')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@mock.patch.object(transport, 'UPSTREAM_RETRY_BACKOFF', 0)
+class PooledPlaidClientTests(SimpleTestCase):
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), ScriptedPlaid)
+        self.server.statuses, self.server.paths = [], []
+        threading.Thread(target=self.server.serve_forever, args=(0.01,), daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        # the client of the app stays in the pool stats
+        patcher = mock.patch.dict(transport._sessions)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        with mock.patch.object(transport, 'PLAID_API_BASE', f'http://127.0.0.1:{self.server.server_port}'):
+            self.client = transport.PooledPlaidClient(client_id='client', secret='secret', environment='sandbox')
+        self.addCleanup(self.client.session.close)
+
+    def post(self, path: str, statuses: list):
+        self.server.statuses, self.server.paths = list(statuses), []
+        return self.client._post(path, {}, is_json=True)
+
+    def test_only_idempotent_paths_are_retried(self):
+        self.assertEqual(self.post('/accounts/get', [503]), {'request_id': 'req-1'})
+        self.assertEqual(self.server.paths, ['/accounts/get'] * 2)
+        with self.assertRaises(PlaidError):
+            self.post('/item/public_token/exchange', [503])
+        self.assertEqual(self.server.paths, ['/item/public_token/exchange'])
+
+    def test_rate_limited_calls_are_left_to_the_rate_limiter(self):
+        with self.assertRaises(PlaidError) as raised:
+            self.post('/accounts/get', [429])
+        self.assertEqual(len(self.server.paths), 1)
+        self.assertEqual(rate_limit.retry_after(raised.exception), 1)
+
+    def test_retries_stop_at_the_limit(self):
+        with mock.patch.object(transport, 'UPSTREAM_MAX_RETRIES', 2), self.assertRaises(PlaidError):
+            self.post('/accounts/get', [500, 502, 503, 504])
+        self.assertEqual(len(self.server.paths), 3)
+        self.assertEqual(self.server.statuses, [504])
+
+    def test_connection_errors_of_idempotent_paths_are_retried(self):
+        with mock.patch.object(self.client.session, 'post', side_effect=requests.ConnectionError('reset')) as post, \
+                self.assertRaises(requests.ConnectionError):
+            self.client._post('/accounts/get', {}, is_json=True)
+        self.assertEqual(post.call_count, transport.UPSTREAM_MAX_RETRIES + 1)
+
+    def test_pool_stats_of_the_client_session(self):
+        self.post('/accounts/get', [])
+        self.post('/accounts/get', [])
+        stats = transport.pool_stats()['plaid:127.0.0.1']
+        self.assertEqual(stats['maxsize'], transport.UPSTREAM_POOL_MAXSIZE)
+        # one kept-alive connection served both requests and is back in the pool
+        self.assertEqual((stats['connections_created'], stats['requests'], stats['in_use'], stats['idle']),
+                         (1, 2, 0, 1))
+        self.assertEqual(stats['saturation'], 0)
+
+
+class BrokerTests(SimpleTestCase):
+    def test_published_messages_reach_the_subscribers_of_the_topic(self):
+        broker = pubsub.Broker(queue_size=4)
+
+        async def scenario():
+            with broker.subscribe('invoice:in_1') as first, broker.subscribe('invoice:in_1') as second, \
+                    broker.subscribe('invoice:in_2') as other:
+                self.assertEqual(broker.publish('invoice:in_1', b'paid'), 2)
+                # sync views publish from their own thread
+                await asyncio.get_running_loop().run_in_executor(None, broker.publish, 'invoice:in_1', b'void')
+                messages = [await asyncio.wait_for(subscription.get(), 1) for subscription in (first, first, second)]
+                self.assertEqual(messages, [b'paid', b'void', b'paid'])
+                self.assertTrue(other.queue.empty())
+
+        asyncio.run(scenario())
+        self.assertEqual(broker.stats(), {'topics': 0, 'subscribers': 0, 'published': 2, 'delivered': 4, 'rejected': 0})
+        self.assertFalse(broker.has_subscribers('invoice:in_1'))
+        self.assertEqual(broker.publish('invoice:in_1', b'paid'), 0)
+
+    def test_slow_subscriber_loses_its_oldest_messages(self):
+        broker = pubsub.Broker(queue_size=2)
+
+        async def scenario():
+            with broker.subscribe('invoice:in_1') as subscription:
+                for message in (b'1', b'2', b'3'):
+                    broker.publish('invoice:in_1', message)
+                await asyncio.sleep(0)
+                return subscription.dropped, [subscription.queue.get_nowait() for _ in range(2)]
+
+        self.assertEqual(asyncio.run(scenario()), (1, [b'2', b'3']))
+
+    def test_subscribers_over_the_limit_are_rejected(self):
+        broker = pubsub.Broker(max_subscribers=1)
+
+        async def scenario():
+            with broker.subscribe('invoice:in_1'):
+                with self.assertRaises(pubsub.TooManySubscribers):
+                    with broker.subscribe('invoice:in_2'):
+                        pass
+                self.assertFalse(broker.has_subscribers('invoice:in_2'))
+            # a subscription that went away frees its place
+            with broker.subscribe('invoice:in_2'):
+                pass
+
+        asyncio.run(scenario())
+        self.assertEqual((broker.stats()['rejected'], broker.stats()['subscribers']), (1, 0))
+
+
+class PayloadBudgetTests(SimpleTestCase):
+    def test_response_sizes_are_measured_in_the_block_only(self):
+        response = mock.Mock(content=b'x' * 300, headers={'Content-Length': '4096'})
+        payload_budget.measure_response(response)
+        with payload_budget.measure_payload() as sizes:
+            payload_budget.measure_response(response)
+            # a streamed body is not read, its announced length is taken
+            payload_budget.measure_response(response, stream=True)
+        self.assertEqual(sizes, [300, 4096])
+
+    def test_oversized_payload_is_counted_and_logged(self):
+        budgets = payload_budget.PayloadBudgets({'plaid': {'budget': 1000, 'endpoints': {'Accounts.get': 100}}})
+        budgets.record('plaid', 'Item.get', 600)
+        with self.assertLogs('utils.payload_budget', 'WARNING') as logs:
+            budgets.record('plaid', 'Accounts.get', 150)
+        budgets.record('plaid', 'Accounts.get', 50)
+        self.assertEqual(logs.records[0].msg, 'upstream.payload_over_budget')
+        self.assertEqual(budgets.stats(), {
+            'plaid.Accounts.get': {'count': 2, 'total_bytes': 200, 'max_bytes': 150, 'over_budget': 1,
+                                   'budget_bytes': 100, 'mean_bytes': 100},
+            'plaid.Item.get': {'count': 1, 'total_bytes': 600, 'max_bytes': 600, 'over_budget': 0,
+                               'budget_bytes': 1000, 'mean_bytes': 600},
+        })
+
+
+@skipUnless(not tracemalloc.is_tracing(), 'tracemalloc is already tracing')
+class MemoryProfilerTests(SimpleTestCase):
+    def setUp(self):
+        self.profiler = memory_profiling.MemoryProfiler(sample_rate=1, top=3)
+        for patcher in (mock.patch.object(memory_profiling, 'profiler', self.profiler),
+                        mock.patch.object(self.profiler, 'flush')):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(self.profiler.stop)
+        self.request = RequestFactory().get('/metrics/')
+
+    def test_profiler_starts_and_stops_tracemalloc(self):
+        def view(request):
+            return HttpResponse(b'x' * 100000)
+
+        middleware = memory_profiling.MemoryProfilingMiddleware(view)
+        self.assertTrue(tracemalloc.is_tracing())
+        middleware(self.request)
+        profile = self.profiler.stats()['views']['metrics']
+        self.assertEqual(profile['count'], 1)
+        self.assertGreaterEqual(profile['retained_max'], 100000)
+
+        self.profiler.stop()
+        self.assertFalse(tracemalloc.is_tracing())
+        # requests are served unmeasured once it stopped
+        self.assertEqual(middleware(self.request).status_code, 200)
+        self.assertEqual(self.profiler.stats()['views']['metrics']['count'], 1)
+
+    def test_failing_request_does_not_hold_the_measurement(self):
+        def view(request):
+            raise ValueError('view failed')
+
+        middleware = memory_profiling.MemoryProfilingMiddleware(view)
+        with self.assertRaises(ValueError):
+            middleware(self.request)
+        state = self.profiler.begin()
+        self.assertIsNotNone(state)
+        self.profiler.end(state, self.request)
+        self.assertEqual(self.profiler.stats()['skipped'], 0)
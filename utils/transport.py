@@ -0,0 +1,129 @@
+import json
+import time
+import plaid
+import requests
+import stripe
+from plaid.errors import PlaidError
+from plaid.internal.utils import urljoin
+from plaid.version import __version__ as plaid_version
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from utils.instrumentation import register_collector
+from utils.payload_budget import measure_response
+from iDjango.settings import UPSTREAM_POOL_CONNECTIONS, UPSTREAM_POOL_MAXSIZE, UPSTREAM_POOL_BLOCK, \
+    UPSTREAM_MAX_RETRIES, UPSTREAM_RETRY_BACKOFF, UPSTREAM_HTTP_TIMEOUT, PLAID_IDEMPOTENT_PATHS, PLAID_API_BASE
+
+# 429s are retried after their Retry-After by utils.rate_limit.call_with_rate_limit only
+RETRY_STATUSES = (500, 502, 503, 504)
+
+_sessions = {}
+
+
+def build_session(name: str, max_retries: int = UPSTREAM_MAX_RETRIES) -> requests.Session:
+    """ Keep-alive session with one pooled adapter; urllib3 retries only idempotent methods """
+    retry = Retry(
+        total=max_retries,
+        backoff_factor=UPSTREAM_RETRY_BACKOFF,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=UPSTREAM_POOL_CONNECTIONS,
+        pool_maxsize=UPSTREAM_POOL_MAXSIZE,
+        pool_block=UPSTREAM_POOL_BLOCK,
+        max_retries=retry,
+    )
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.hooks['response'].append(measure_response)
+    _sessions[name] = session
+    return session
+
+
+def pool_stats() -> dict:
+    """ Connection pool saturation of every session built by build_session, keyed by '<name>:<host>' """
+    stats = {}
+    for name, session in _sessions.items():
+        adapter = session.get_adapter('https://')
+        pools = adapter.poolmanager.pools
+        for pool_key in pools.keys():
+            pool = pools.get(pool_key)
+            if pool is None or pool.pool is None:
+                continue
+            maxsize = pool.pool.maxsize
+            in_use = maxsize - pool.pool.qsize()
+            stats[f'{name}:{pool.host}'] = {
+                'maxsize': maxsize,
+                'in_use': in_use,
+                'idle': sum(1 for conn in list(pool.pool.queue) if conn is not None),
+                'saturation': in_use / maxsize if maxsize else 0,
+                'connections_created': pool.num_connections,
+                'requests': pool.num_requests,
+            }
+    return stats
+
+
+register_collector('connection_pools', pool_stats)
+
+
+class PooledPlaidClient(plaid.Client):
+    """ plaid.Client sending through a pooled keep-alive session instead of module-level requests.post """
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('timeout', UPSTREAM_HTTP_TIMEOUT)
+        super().__init__(*args, **kwargs)
+        self.api_base = PLAID_API_BASE or 'https://' + self.environment + '.plaid.com'
+        self.session = build_session('plaid')
+
+    def _post(self, path, data, is_json):
+        headers = {'User-Agent': f'Plaid Python v{plaid_version}'}
+        if self.api_version is not None:
+            headers['Plaid-Version'] = self.api_version
+        if self.client_app is not None:
+            headers['Plaid-Client-App'] = self.client_app
+        url = urljoin(self.api_base, path)
+        # Plaid only speaks POST, so retries are limited to endpoints that only read
+        attempts = UPSTREAM_MAX_RETRIES + 1 if path in PLAID_IDEMPOTENT_PATHS else 1
+        for attempt in range(attempts):
+            last_attempt = attempt + 1 == attempts
+            try:
+                response = self.session.post(url, json=data, headers=headers, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                if last_attempt:
+                    raise
+            else:
+                if last_attempt or response.status_code not in RETRY_STATUSES:
+                    return self._parse_response(response, is_json)
+            time.sleep(UPSTREAM_RETRY_BACKOFF * 2 ** attempt)
+
+    @staticmethod
+    def _parse_response(response, is_json: bool):
+        """ Same handling as plaid.internal.requester._http_request """
+        if not is_json and response.headers.get('Content-Type') != 'application/json':
+            return response.content
+        try:
+            response_body = json.loads(response.text)
+        except ValueError:
+            raise PlaidError.from_response({
+                'error_message': response.text,
+                'error_type': 'API_ERROR',
+                'error_code': 'INTERNAL_SERVER_ERROR',
+                'display_message': None,
+                'request_id': '',
+                'causes': [],
+            })
+        if response_body.get('error_type'):
+            error = PlaidError.from_response(response_body)
+            # read by utils.rate_limit on a RATE_LIMIT_EXCEEDED error
+            error.retry_after = response.headers.get('Retry-After')
+            raise error
+        return response_body
+
+
+def build_stripe_http_client() -> stripe.http_client.RequestsClient:
+    """ Stripe retries by itself (with idempotency keys), so its session does not retry in urllib3 """
+    stripe.max_network_retries = UPSTREAM_MAX_RETRIES
+    session = build_session('stripe', max_retries=0)
+    return stripe.http_client.RequestsClient(timeout=UPSTREAM_HTTP_TIMEOUT, session=session)
@@ -0,0 +1,75 @@
+import logging
+import threading
+import time
+
+from utils.circuit_breaker import call_with_breaker, CircuitOpenError
+from utils.instrumentation import span
+from utils.payload_budget import measure_payload, payload_budgets
+from utils.rate_limit import call_with_rate_limit
+
+logger = logging.getLogger(__name__)
+
+
+def call_upstream(upstream: str, endpoint: str, func, *args, **kwargs):
+    """ Every Plaid and Stripe API call goes through here """
+    started = time.perf_counter()
+    fields = {'upstream': upstream, 'endpoint': endpoint}
+    with span(f'{upstream}.{endpoint}'), measure_payload() as sizes:
+        try:
+            # an open breaker fails the call before it waits for a rate limit token
+            result = call_with_breaker(upstream, call_with_rate_limit, upstream, endpoint, func, *args, **kwargs)
+        except CircuitOpenError:
+            logger.warning('upstream.rejected', extra=fields)
+            raise
+        except Exception as e:
+            fields.update(latency_ms=round((time.perf_counter() - started) * 1000, 3), error_class=type(e).__name__)
+            logger.warning('upstream.error', extra=fields)
+            raise
+    fields['latency_ms'] = round((time.perf_counter() - started) * 1000, 3)
+    if sizes:
+        # the last response is the one the SDK parsed, earlier ones were retried
+        fields['response_bytes'] = sizes[-1]
+        payload_budgets.record(upstream, endpoint, sizes[-1])
+    logger.info('upstream.call', extra=fields)
+    return result
+
+
+class UpstreamProxy:
+    """ Wraps an SDK client (or module) so that client.Accounts.get(...) is made through call_upstream """
+
+    def __init__(self, target, upstream: str, endpoint: str = ''):
+        self._proxy_target = target
+        self._proxy_upstream = upstream
+        self._proxy_endpoint = endpoint
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            # functools.wraps, copy and pickle probe for dunders, they are not SDK endpoints
+            raise AttributeError(name)
+        endpoint = f'{self._proxy_endpoint}.{name}' if self._proxy_endpoint else name
+        proxy = UpstreamProxy(getattr(self._resolve_target(), name), self._proxy_upstream, endpoint)
+        # SDK attributes do not change, later lookups find the proxy without __getattr__
+        self.__dict__[name] = proxy
+        return proxy
+
+    def _resolve_target(self):
+        return self._proxy_target
+
+    def __call__(self, *args, **kwargs):
+        return call_upstream(self._proxy_upstream, self._proxy_endpoint, self._resolve_target(), *args, **kwargs)
+
+
+class LazyUpstreamProxy(UpstreamProxy):
+    """ UpstreamProxy building its SDK client with factory() on first use, once per process """
+
+    def __init__(self, factory, upstream: str):
+        super().__init__(None, upstream)
+        self._proxy_factory = factory
+        self._proxy_lock = threading.Lock()
+
+    def _resolve_target(self):
+        if self._proxy_target is None:
+            with self._proxy_lock:
+                if self._proxy_target is None:
+                    self._proxy_target = self._proxy_factory()
+        return self._proxy_target